@@ -4,20 +4,29 @@
 
 import glob
 import argparse
+import hashlib
+import multiprocessing
 import os
-import time
-import random
+import re
 import shutil
+import signal
+import tempfile
+import time
 from ase.calculators.dftb import Dftb
+from ase.calculators.socketio import SocketIOCalculator
 import ase.io
-from ase.optimize import LBFGS
 import numpy as np
-from func_timeout import func_set_timeout, FunctionTimedOut
 from ase.calculators.singlepoint import SinglePointCalculator
-from ase.calculators.calculator import CalculationFailed
+from ase.calculators.calculator import CalculationFailed, all_changes
 from ase.filters import FrechetCellFilter
 from ase.units import GPa
 
+from relax_tools import (
+    OPTIMIZERS, AsyncWriter, CampaignManifest, CostModel, LPTScheduler, PrefetchReader,
+    ProcessWatchdog, ResultCache, StartJournal, atomic_write, file_sizes, make_optimizer, plan_layouts, run_optimizer,
+    run_output, size_fields, snapshot, split_cores
+)
+
 
 TITLE = """\033[1;36m
  ______   ________  _________  ______
@@ -42,6 +51,12 @@ Examples:
 
     python DFTB_relax.py
 
+    python DFTB_relax.py -nc 16 --scratch /dev/shm
+
+    python DFTB_relax.py --plan_layout
+
+    python DFTB_relax.py --benchmark_layouts
+
 """
 
 
@@ -86,14 +101,183 @@ def options():
         help="Don't relax the cell parameters."
     )
 
+    parser.add_argument(
+        "--optimizer",
+        default="lbfgs",
+        choices=list(OPTIMIZERS),
+        help="Optimizer of the relaxation, it moves the atoms and the cell (default lbfgs)."
+    )
+
+    parser.add_argument(
+        "--manifest",
+        default="manifest.jsonl",
+        metavar="file",
+        help="Journal of the campaign, finished files are skipped when the job is restarted."
+    )
+
+    parser.add_argument(
+        "--history",
+        nargs="+",
+        default=[],
+        metavar="manifest",
+        help="Manifests of previous campaigns (glob patterns), their wall times are used with the\
+ current manifest to predict the cost of each structure. The longest are run first."
+    )
+
+    parser.add_argument(
+        "--move_inputs",
+        action="store_true",
+        default=False,
+        help="Move the input files to the input folder when they are done (old behaviour)."
+    )
+
+    parser.add_argument(
+        "--cache",
+        default=None,
+        metavar="file",
+        help="sqlite result cache, a structure already computed with the same settings is taken\
+ from it (it can be shared by several campaigns)."
+    )
+
+    parser.add_argument(
+        "--cache_max_entries",
+        type=int,
+        default=100000,
+        metavar="N",
+        help="Least used entries above N are evicted from the cache (default 100000)."
+    )
+
+    parser.add_argument(
+        "--cache_max_age",
+        type=float,
+        default=90.0,
+        metavar="days",
+        help="Entries older than this are evicted from the cache (default 90 days)."
+    )
+
+    parser.add_argument(
+        "-nc",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Number of DFTB+ processes run at the same time (default 1)."
+    )
+
+    parser.add_argument(
+        "-nt",
+        type=int,
+        default=None,
+        metavar="N",
+        help="OpenMP threads of each DFTB+ process, by default the available cores divided by -nc."
+    )
+
+    parser.add_argument(
+        "--plan_layout",
+        action="store_true",
+        default=False,
+        help="Choose the workers x threads from the number of atoms instead of -nc/-nt: few wide\
+ workers for the large cells, many narrow ones for the small cells."
+    )
+
+    parser.add_argument(
+        "--atoms_per_thread",
+        type=int,
+        default=16,
+        metavar="N",
+        help="Atoms per OpenMP thread of --plan_layout, the threads of a structure are a power of 2\
+ (default 16)."
+    )
+
+    parser.add_argument(
+        "--benchmark_layouts",
+        action="store_true",
+        default=False,
+        help="Run the first --benchmark_files structures with each layout (cores/t workers x t\
+ threads) and save the throughput in layout_benchmark.csv, nothing is written in the campaign."
+    )
+
+    parser.add_argument(
+        "--benchmark_files",
+        type=int,
+        default=8,
+        metavar="N",
+        help="Structures of --benchmark_layouts (default 8)."
+    )
+
+    parser.add_argument(
+        "--scratch",
+        default=None,
+        metavar="folder",
+        help="Folder of the scratch directories, each structure runs in its own directory removed at\
+ the end (default /dev/shm if it is available, else the temporary folder)."
+    )
+
+    parser.add_argument(
+        "--keep_outputs",
+        default=None,
+        metavar="folder",
+        help="Copy the DFTB+ files of the last step (dftb_in.hsd, detailed.out, charges.bin) of each\
+ structure to folder/<name>."
+    )
+
+    parser.add_argument(
+        "--socket",
+        action="store_true",
+        default=False,
+        help="Run one DFTB+ process per relaxation with the i-PI socket driver, the positions and\
+ cell of each step are sent through a UNIX socket instead of starting DFTB+ at each step."
+    )
+
+    parser.add_argument(
+        "--no_charge_restart",
+        action="store_false",
+        dest="restart_charges",
+        default=True,
+        help="Start the SCC cycle of each step from the neutral atoms, not from the charges of the\
+ previous step."
+    )
+
+    parser.add_argument(
+        "--charge_guess",
+        default=None,
+        metavar="folder",
+        help="Folder of converged charges by composition, a structure with the same atoms (same\
+ order) as a converged one starts from its charges."
+    )
+
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=1200.0,
+        metavar="s",
+        help="Time limit of each structure (default 1200 s), its DFTB+ processes are killed with their\
+ process group and it is recorded as killed in the manifest. 0 is no limit."
+    )
+
+    parser.add_argument(
+        "--kill_grace",
+        type=float,
+        default=10.0,
+        metavar="s",
+        help="Time between the SIGTERM and the SIGKILL of a DFTB+ process group (default 10 s)."
+    )
+
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=4,
+        metavar="K",
+        help="The next K structures are read in a background thread and the outputs are written by\
+ another one (default 4). 0 reads and writes in the main loop."
+    )
+
     return vars(parser.parse_args())
 
 
-@func_set_timeout(1200.0)
 def relax_config(
         atoms, tol=1e-3, max_steps=1000, relax_cell=True, strain_mask=None,
-        constant_volume=False, applied_P=0.1, hydrostatic_strain=False):
-    """Relax the structure."""
+        constant_volume=False, applied_P=0.1, hydrostatic_strain=False, optimizer="lbfgs"):
+    """Relax the structure (and its cell) with the optimizer."""
     print("atoms are", atoms)
     print("tol is", tol)
 
@@ -107,11 +291,14 @@ def relax_config(
             hydrostatic_strain=hydrostatic_strain
         )
         print("atom_cell is", atoms_cell)
+    else:
+        atoms_cell = atoms
 
-    opt = LBFGS(atoms)
-    opt.run(tol, max_steps)
+    opt = make_optimizer(optimizer, atoms_cell)
+    run_optimizer(opt, atoms_cell, tol, max_steps)
 
-    fmax = max(np.linalg.norm(atoms.get_forces(), axis=1))
+    # Forces of the optimized degrees of freedom, with the cell ones.
+    fmax = max(np.linalg.norm(atoms_cell.get_forces(), axis=1))
     good = True
     if fmax > tol:
         good = False
@@ -119,11 +306,325 @@ def relax_config(
     return good, atoms
 
 
+def scratch_root(path=None):
+    """Return the folder of the scratch directories: path, /dev/shm (tmpfs) or the temporary folder."""
+    if path is not None:
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+
+    return tempfile.gettempdir()
+
+
+# A row of the SCC table printed by DFTB+: iteration, total energy, energy change, charge error.
+SCC_ROW = re.compile(r"^\s*\d+(\s+-?\d+\.\d+E[+-]\d+){3}\s*$")
+
+
+def scc_iterations(outfile):
+    """Return the number of SCC iterations of each SCC cycle in the standard output of DFTB+."""
+    iterations = []
+    if not os.path.isfile(outfile):
+        return iterations
+
+    with open(outfile, "r") as f:
+        for line in f:
+            if "iSCC" in line:
+                iterations.append(0)
+            elif len(iterations) > 0 and SCC_ROW.match(line):
+                iterations[-1] += 1
+
+    return iterations
+
+
+class WarmStartDftb(Dftb):
+    """
+    Dftb that starts the SCC cycle of each step from the charges of the previous one.
+
+    If charges.bin (written by DFTB+ at the end of each SCC cycle, or copied from a charge guess)
+    is in the directory, the next step reads it (ReadInitialCharges). Without restart_charges only
+    a charges.bin seeded on purpose (seeded True, a charge guess) is read, by the first step. The
+    SCC iterations of each step are appended to scc_iterations. With a ProcessWatchdog DFTB+ is started in its own
+    process group, killed at the time limit.
+    """
+
+    def __init__(self, *args, restart_charges=True, watchdog=None, **kwargs):
+        """Same arguments as Dftb."""
+        super().__init__(*args, **kwargs)
+        self.restart_charges = restart_charges
+        self.seeded = False
+        self.watchdog = watchdog
+        self.scc_iterations = []
+
+    def execute(self):
+        """Run DFTB+ in the directory."""
+        if self.watchdog is None:
+            return super().execute()
+
+        command = self.command.replace("PREFIX", self.prefix)
+        errorcode = self.watchdog.popen(command, shell=True, cwd=self.directory).wait()
+        if errorcode:
+            raise CalculationFailed(
+                f"Calculator \"{self.name}\" failed with command \"{command}\" failed in"
+                f" {os.path.abspath(self.directory)} with error code {errorcode}"
+            )
+
+    def socket_client(self, atoms, properties=None, port=None, unixsocket=None):
+        """Write the input and start DFTB+ as the client of a SocketIOCalculator (launch_client)."""
+        self.write_input(atoms, properties=properties, system_changes=all_changes)
+        command = self.command.replace("PREFIX", self.prefix)
+
+        return self.watchdog.popen(command, shell=True, cwd=self.directory)
+
+    def write_input(self, atoms, properties=None, system_changes=None):
+        """Write dftb_in.hsd, reading the charges of the previous step if they exist."""
+        # Not with set(), it would reset the results.
+        if (self.restart_charges or self.seeded) and os.path.isfile(os.path.join(self.directory, "charges.bin")):
+            self.parameters["Hamiltonian_ReadInitialCharges"] = "Yes"
+        else:
+            self.parameters.pop("Hamiltonian_ReadInitialCharges", None)
+        self.seeded = False
+        super().write_input(atoms, properties, system_changes)
+
+    def read_results(self):
+        """Read the results and the SCC iterations of the step."""
+        super().read_results()
+        self.scc_iterations += scc_iterations(os.path.join(self.directory, self.prefix + ".out"))
+
+
+def charge_guess_file(folder, atoms, method):
+    """Return the file of the converged charges of the structures with the symbols of atoms (same order)."""
+    symbols = " ".join(atoms.get_chemical_symbols())
+    digest = hashlib.sha1(f"{method} {symbols}".encode()).hexdigest()[:12]
+
+    return os.path.join(folder, f"{method}_{atoms.get_chemical_formula()}_{digest}.bin")
+
+
+def make_calculator(label, method="GFN1-xTB", unixsocket=None, restart_charges=True):
+    """
+    Return the DFTB+ calculator, its files are written with the prefix label (it can contain a folder).
+
+    With unixsocket DFTB+ is configured as an i-PI client of the socket /tmp/ipi_<unixsocket>, it
+    is started once by a SocketIOCalculator, receives the positions and cell of each step and keeps
+    the parameters and the charges of the previous step in memory. restart_charges: see
+    WarmStartDftb.
+    """
+    parameters = {}
+    if unixsocket is not None:
+        parameters = {
+            "Driver_": "",
+            "Driver_Socket_": "",
+            "Driver_Socket_File": unixsocket,
+            # Until the socket is closed by SocketIOCalculator.
+            "Driver_Socket_MaxSteps": -1
+        }
+
+    return WarmStartDftb(
+        label=label,
+        restart_charges=restart_charges,
+        Hamiltonian_="xTB",
+        Hamiltonian_Method=method,
+        Hamiltonian_SCC='Yes',
+        Hamiltonian_SCCTolerance=1e-7,
+        Hamiltonian_MaxSCCIterations=5000,
+        Charge=0,
+        RestartFrequency=20,
+        kpts=(1, 1, 1),
+        **parameters
+    )
+
+
+def run_dftb(
+    struc, name, method="GFN1-xTB", only_sp=False, tol=1e-2, relax_cell=True, optimizer="lbfgs",
+    scratch=None, keep_outputs=None, socket=False, restart_charges=True, charge_guess=None,
+    timeout=1200.0, kill_grace=10.0
+):
+    """
+    Run DFTB+ on struc in its own scratch directory and return (good, struc).
+
+    The directory is created in scratch (scratch_root) and removed at the end, the returned
+    structure keeps the results in a SinglePointCalculator and the SCC iterations of each step in
+    info["scc_iterations"]. With keep_outputs the DFTB+ files of the last step are copied to
+    keep_outputs/name. With socket a relaxation uses one DFTB+ process for all its steps
+    (make_calculator), closed at the end. With charge_guess (folder) the first step starts from
+    the charges of the last converged structure with the same symbols, the converged charges of
+    this one are saved there.
+
+    The DFTB+ processes are killed (whole process group, SIGTERM and SIGKILL kill_grace s later)
+    timeout s after the start, info["timed_out"] tells it and info["cpu_time"] is the CPU time of
+    the processes.
+    """
+    workdir = tempfile.mkdtemp(prefix=name + "_", dir=scratch_root(scratch))
+    print(f"Scratch directory: {workdir}")
+    unixsocket = None
+    if socket and not only_sp:
+        # Unique for the workers of the pool, short: /tmp/ipi_<name> must fit in sun_path (108 bytes).
+        unixsocket = f"dftb_{os.getpid()}_{hashlib.sha1(name.encode()).hexdigest()[:12]}"
+        print(f"DFTB+ socket driver: /tmp/ipi_{unixsocket}")
+    dftb = make_calculator(os.path.join(workdir, name), method, unixsocket, restart_charges)
+    watchdog = ProcessWatchdog(timeout, grace=kill_grace)
+    dftb.watchdog = watchdog
+    calc = dftb
+    if unixsocket is not None:
+        # The socket also stops waiting for a client that never answers.
+        calc = SocketIOCalculator(launch_client=dftb.socket_client, unixsocket=unixsocket, timeout=timeout)
+    struc.calc = calc
+
+    guess = None
+    if charge_guess is not None:
+        guess = charge_guess_file(charge_guess, struc, method)
+        if os.path.isfile(guess):
+            print(f"Initial charges from {guess}")
+            shutil.copy(guess, os.path.join(workdir, "charges.bin"))
+            # Read by the first step, also with --no_charge_restart.
+            dftb.seeded = True
+
+    good = False
+    try:
+        try:
+            good, struc = compute(struc, only_sp, tol, relax_cell, optimizer, watchdog)
+            # Results copied before the directory is removed.
+            struc = snapshot(struc)
+        finally:
+            try:
+                if unixsocket is not None:
+                    # Ends the DFTB+ process and removes the socket.
+                    calc.close()
+            except OSError:
+                if not watchdog.killed:
+                    raise
+            finally:
+                # Nothing started for this structure keeps running.
+                watchdog.close()
+
+        struc.info["timed_out"] = watchdog.killed
+        struc.info["cpu_time"] = watchdog.cpu_time
+        print(
+            f"DFTB+ CPU time: {watchdog.cpu_time:.1f} s"
+            + (" (killed at the time limit)" if watchdog.killed else "")
+        )
+
+        if unixsocket is None:
+            iterations = dftb.scc_iterations
+        else:
+            # One process, its output has the SCC cycles of all the steps.
+            iterations = scc_iterations(os.path.join(workdir, name + ".out"))
+        struc.info["scc_iterations"] = iterations
+        if len(iterations) > 0:
+            print(
+                f"SCC iterations: {sum(iterations)} in {len(iterations)} steps"
+                f" (first {iterations[0]}, mean {np.mean(iterations):.1f})"
+            )
+
+        charges = os.path.join(workdir, "charges.bin")
+        if guess is not None and good and os.path.isfile(charges):
+            os.makedirs(charge_guess, exist_ok=True)
+            # Renamed, the workers of the pool may read it at the same time.
+            shutil.copy(charges, guess + f".{os.getpid()}")
+            os.replace(guess + f".{os.getpid()}", guess)
+
+        if keep_outputs is not None:
+            outdir = os.path.join(keep_outputs, name)
+            os.makedirs(outdir, exist_ok=True)
+            for fname in ["dftb_in.hsd", "detailed.out", "charges.bin", name + ".out"]:
+                if os.path.isfile(os.path.join(workdir, fname)):
+                    shutil.copy(os.path.join(workdir, fname), outdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return good, struc
+
+
+def compute(struc, only_sp=False, tol=1e-2, relax_cell=True, optimizer="lbfgs", watchdog=None):
+    """
+    Run the single point or the relaxation of struc with its calculator, return (good, struc).
+
+    Once the watchdog has killed DFTB+ any error of the calculator ends the structure (not good).
+    """
+    good = False
+    try:
+        if only_sp:
+            try:
+                E = struc.get_potential_energy()
+                good = True
+                print("E (eV) is", E, "----", "E/atom", E / len(struc))
+                # Crear un SinglePointCalculator solo con la energía
+                struc.calc = SinglePointCalculator(struc, energy=E)
+                struc.info = {}
+            except CalculationFailed:
+                print("Calculation failed!")
+
+        else:
+            try:
+                good, struc = relax_config(struc, tol=tol, relax_cell=relax_cell, optimizer=optimizer)
+            except ValueError:
+                good = False
+    except Exception as error:
+        if watchdog is None or not watchdog.killed:
+            raise
+        print(f"Stopped by the time limit: {error}")
+        good = False
+
+    return good, struc
+
+
+def run_dftb_or_fail(fname, struc, name, **dftb_kwargs):
+    """run_dftb that doesn't raise, a structure whose calculation failed is returned not good with info["error"]."""
+    try:
+        return run_dftb(struc, name, **dftb_kwargs)
+    except Exception as error:
+        print(f"{fname} failed: {error}")
+        # The calculator of the failed run is not written (nor sent back by the pool).
+        struc.calc = None
+        struc.info["error"] = f"{type(error).__name__}: {error}"
+        return False, struc
+
+
+def write_result(
+    fname, struc, good, only_sp=False, good_fol="completed", bad_fol="fail", input_fol="input",
+    manifest=None, move_input=False, writer=None, **fields
+):
+    """Write the structure of fname, update the manifest and move the input (in the thread of writer)."""
+    name = fname.split("/")[-1].split(".")[0]
+    output_fol = good_fol if good else bad_fol
+    outname = output_fol + "/" + name + ("_sp.extxyz" if only_sp else ".extxyz")
+    iterations = struc.info.pop("scc_iterations", None)
+    if iterations is not None:
+        fields.update(scc_iterations=sum(iterations), scc_steps=len(iterations))
+    if "cpu_time" in struc.info:
+        fields["cpu_time"] = struc.info.pop("cpu_time")
+    if struc.info.pop("timed_out", False):
+        fields.update(reason="timeout", killed=True)
+    if "error" in struc.info:
+        fields["error"] = struc.info.pop("error")
+
+    def output():
+        atomic_write(outname, struc)
+        print(f"writing final struc to {outname}")
+        if manifest is not None:
+            manifest.finish(fname, "done" if good else "fail", output=outname, **fields)
+        # move input file to inputs
+        if move_input and os.path.isfile(fname):
+            os.system(f"mv -v {fname} {input_fol}")
+
+    run_output(writer, output)
+
+
 def relax_fname(
     fname, method="GFN1-xTB", good_fol="completed", bad_fol="fail", input_fol="input",
-    only_sp=False, tol=1e-2, relax_cell=True
+    only_sp=False, tol=1e-2, relax_cell=True, manifest=None, move_input=False, cache=None,
+    optimizer="lbfgs", input_struc=None, writer=None, scratch=None, keep_outputs=None, socket=False,
+    restart_charges=True, charge_guess=None, timeout=1200.0, kill_grace=10.0
 ):
-    """."""
+    """
+    Run DFTB+ on the structure in fname and write the result.
+
+    input_struc is the structure of fname if it was already read, with an AsyncWriter the output,
+    the move of the input and the manifest update are done in its thread. DFTB+ runs in a scratch
+    directory of scratch (run_dftb, with the socket driver if socket, the charges of
+    restart_charges and charge_guess and the time limit timeout).
+    """
     # create the folders
     for fol in [good_fol, bad_fol, input_fol]:
         if not os.path.isdir(fol):
@@ -136,64 +637,246 @@ def relax_fname(
     name = fname.split("/")[-1].split(".")[0]
     print("="*60)
 
-    calc = Dftb(
-        label=name,
-        Hamiltonian_="xTB",
-        Hamiltonian_Method=method,
-        Hamiltonian_SCC='Yes',
-        Hamiltonian_SCCTolerance=1e-7,
-        Hamiltonian_MaxSCCIterations=5000,
-        Charge=0,
-        RestartFrequency=20,
-        kpts=(1, 1, 1)
+    struc = input_struc
+    if struc is None:
+        try:
+            struc = ase.io.read(fname)
+        except Exception as error:
+            print(f"failed to read {fname}: {error}")
+            if manifest is not None:
+                manifest.finish(fname, "fail", error="read")
+            return
+    outputs = dict(
+        only_sp=only_sp, good_fol=good_fol, bad_fol=bad_fol, input_fol=input_fol, manifest=manifest,
+        move_input=move_input, writer=writer
     )
 
-    struc = ase.io.read(fname)
-    struc.calc = calc
-
-    if only_sp:
-        outfile = name + "_sp.extxyz"
-        try:
-            E = struc.get_potential_energy()
-            output_fol = good_fol
-            print("E (eV) is", E, "----", "E/atom", E / len(struc))
-            # Crear un SinglePointCalculator solo con la energía
-            struc.calc = SinglePointCalculator(struc, energy=E)
-            struc.info = {}
-        except CalculationFailed:
-            print("Calculation failed!")
-            output_fol = bad_fol
+    key = None
+    if cache is not None:
+        key = cache.key(struc)
+        cached = cache.get(key)
+        if cached is not None:
+            struc = cached[0]
+            print(f"Result found in the cache {cache.path} (computed for {cached[1].get('fname')})")
+            write_result(fname, struc, True, wall_time=0.0, n_atoms=len(struc), cached=True, **outputs)
+            return
 
-    else:
-        good = False
-        try:
-            good, struc = relax_config(struc, tol=tol, relax_cell=relax_cell)
-        except FunctionTimedOut:
-            good = False
-        except ValueError:
-            good = False
-
-        # write final structure to relavent folder
-        if good:
-            output_fol = good_fol
-        else:
-            output_fol = bad_fol
+    start_time = time.time()
+    if manifest is not None:
+        manifest.start(fname, **size_fields(struc))
 
-        outfile = name + ".extxyz"
+    good, struc = run_dftb_or_fail(
+        fname, struc, name, method=method, only_sp=only_sp, tol=tol, relax_cell=relax_cell, optimizer=optimizer,
+        scratch=scratch, keep_outputs=keep_outputs, socket=socket, restart_charges=restart_charges,
+        charge_guess=charge_guess, timeout=timeout, kill_grace=kill_grace
+    )
 
-    outname = output_fol + "/" + outfile
-    ase.io.write(outname, struc)
-    print(f"writing final struc to {outname}")
+    if cache is not None and good:
+        cache.put(key, struc, fname=fname)
+    write_result(fname, struc, good, wall_time=time.time() - start_time, **outputs)
     print("Finished!")
 
-    # move input file to inputs
-    if os.path.isfile(fname):
-        # print("using shutil to move with", fname, input_fol)
-        # print("move with", fname, input_fol)
-        # try:
-        # shutil.move(fname, input_fol)
-        os.system(f"mv -v {fname} {input_fol}")
-        # os.system("rm -vf")
+
+# StartJournal queue of a worker process, set by init_worker.
+_WORKER_STARTED = None
+
+
+def worker_task(fname, dftb_kwargs):
+    """Read fname and run DFTB+ on it in a worker, return (fname, good, struc, wall time)."""
+    start_time = time.time()
+    print(f"File name: {fname} (worker {os.getpid()})")
+    try:
+        struc = ase.io.read(fname)
+    except Exception as error:
+        print(f"failed to read {fname}: {error}")
+        struc = None
+    if _WORKER_STARTED is not None:
+        _WORKER_STARTED.put((fname, None if struc is None else size_fields(struc)))
+    if struc is None:
+        return fname, False, None, time.time() - start_time
+
+    name = fname.split("/")[-1].split(".")[0]
+    # A failed structure goes to the fail folder, the worker takes the next one.
+    good, struc = run_dftb_or_fail(fname, struc, name, **dftb_kwargs)
+
+    return fname, good, struc, time.time() - start_time
+
+
+def _worker_task_star(args):
+    return worker_task(*args)
+
+
+def exit_on_sigterm(signum, frame):
+    """Exit on SIGTERM, the finally blocks of run_dftb kill the DFTB+ process groups."""
+    raise SystemExit(128 + signum)
+
+
+def set_threads(n_threads):
+    """Export the OpenMP threads of the DFTB+ processes started by this process."""
+    os.environ["OMP_NUM_THREADS"] = str(n_threads)
+    # One DFTB+ per worker, the threads don't move between the cores of the worker.
+    os.environ["OMP_PROC_BIND"] = "true"
+
+
+def init_worker(n_threads, cores_queue, started_queue=None):
+    """Pin the worker to its cores and export its threads, DFTB+ inherits both."""
+    global _WORKER_STARTED
+    _WORKER_STARTED = started_queue
+    try:
+        cores = cores_queue.get_nowait()
+        os.sched_setaffinity(0, cores)
+    except Exception:
+        # A worker restarted by the pool keeps the affinity of the parent.
+        cores = sorted(os.sched_getaffinity(0))
+
+    set_threads(n_threads)
+    # Pool.terminate sends SIGTERM, DFTB+ runs in its own session and doesn't get it.
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    print(f"Worker {os.getpid()} on cores {cores} with {n_threads} OpenMP threads")
+
+
+def make_pool(n_workers, n_threads, started_queue=None):
+    """Return a pool of n_workers with n_threads cores each, the workers report their files in started_queue."""
+    print(f"DFTB+ pool layout: {n_workers} workers x {n_threads} threads")
+    # spawn, the reader and writer threads of this process are not forked.
+    ctx = multiprocessing.get_context("spawn")
+    cores_queue = ctx.Queue()
+    for cores in split_cores(n_workers, n_threads):
+        cores_queue.put(cores)
+
+    return ctx.Pool(
+        processes=n_workers, initializer=init_worker, initargs=(n_threads, cores_queue, started_queue)
+    )
+
+
+def run_pool(
+    files, n_workers, dftb_kwargs, good_fol="completed", bad_fol="fail", input_fol="input",
+    manifest=None, move_inputs=False, cache=None, scheduler=None, writer=None, prefetch=0,
+    n_threads=None
+):
+    """
+    Run the files in a pool of n_workers DFTB+ processes with n_threads OpenMP threads each.
+
+    Each structure runs in its own scratch directory (run_dftb with dftb_kwargs), the results come
+    back through the pool and are written here as in relax_fname. The cache is only used by this
+    process, the files found in it are not sent to the workers.
+    """
+    for fol in [good_fol, bad_fol, input_fol]:
+        os.makedirs(fol, exist_ok=True)
+
+    only_sp = dftb_kwargs.get("only_sp", False)
+    outputs = dict(
+        only_sp=only_sp, good_fol=good_fol, bad_fol=bad_fol, input_fol=input_fol, manifest=manifest,
+        move_input=move_inputs, writer=writer
+    )
+
+    keys = {}
+    if cache is not None:
+        pending = []
+        for fname, struc in PrefetchReader(files, prefetch):
+            try:
+                if struc is None:
+                    struc = ase.io.read(fname)
+            except Exception:
+                # The worker reports the file.
+                pending.append(fname)
+                continue
+            keys[fname] = cache.key(struc)
+            cached = cache.get(keys[fname])
+            if cached is None:
+                pending.append(fname)
+                continue
+            print(f"{fname}: result found in the cache {cache.path} (computed for {cached[1].get('fname')})")
+            write_result(fname, cached[0], True, wall_time=0.0, n_atoms=len(cached[0]), cached=True, **outputs)
+            if scheduler is not None:
+                scheduler.finish(fname)
+        files = pending
+
+    if len(files) == 0:
+        return
+
+    if n_threads is None:
+        n_threads = max(1, len(os.sched_getaffinity(0)) // n_workers)
+    n_workers = min(n_workers, len(files))
+    print(f"DFTB+ pool: {n_workers} workers, scratch in {scratch_root(dftb_kwargs.get('scratch'))}")
+    tasks = [(fname, dftb_kwargs) for fname in files]
+    total_files = len(files)
+    count = 0
+    # The files are marked running when a worker takes them.
+    journal = StartJournal(manifest, multiprocessing.get_context("spawn")) if manifest is not None else None
+    with make_pool(n_workers, n_threads, journal.queue if journal is not None else None) as pool:
+        for fname, good, struc, execution_time in pool.imap_unordered(_worker_task_star, tasks, chunksize=1):
+            count += 1
+            if journal is not None:
+                journal.wait(fname)
+            if scheduler is not None:
+                scheduler.finish(fname, execution_time)
+            if struc is None:
+                if manifest is not None:
+                    manifest.finish(fname, "fail", error="read")
+                continue
+
+            if cache is not None and good and fname in keys:
+                cache.put(keys[fname], struc, fname=fname)
+            write_result(fname, struc, good, wall_time=execution_time, n_atoms=len(struc), **outputs)
+
+            print("="*60)
+            print(f"File number: {count}/{total_files} - done in {execution_time:.3f} s")
+            if scheduler is not None:
+                print(scheduler.report())
+            print("="*60)
+    if journal is not None:
+        journal.close()
+
+
+def benchmark_layouts(files, dftb_kwargs, n_cores, output="layout_benchmark.csv"):
+    """
+    Run files with each layout of n_cores (n_cores/t workers x t threads, t a power of 2).
+
+    The results are not written, the throughput of each layout is printed and saved in output.
+    """
+    n_atoms = [len(ase.io.read(fname)) for fname in files]
+    layouts = []
+    n_threads = 1
+    while n_threads <= n_cores:
+        layouts.append((n_cores // n_threads, n_threads))
+        n_threads *= 2
+
+    rows = []
+    for n_workers, n_threads in layouts:
+        print("="*60)
+        start_time = time.time()
+        n_good = 0
+        with make_pool(min(n_workers, len(files)), n_threads) as pool:
+            tasks = [(fname, dftb_kwargs) for fname in files]
+            for fname, good, struc, execution_time in pool.imap_unordered(_worker_task_star, tasks, chunksize=1):
+                n_good += good
+                print(f"{fname}: good = {good}, {execution_time:.3f} s")
+        wall_time = time.time() - start_time
+        rows.append({
+            "workers": n_workers,
+            "threads": n_threads,
+            "files": len(files),
+            "good": n_good,
+            "atoms": sum(n_atoms),
+            "wall_time": wall_time,
+            "files_per_hour": 3600 * len(files) / wall_time
+        })
+
+    print("="*60)
+    print(f"{'workers':>8s} {'threads':>8s} {'good':>6s} {'time (s)':>10s} {'files/h':>10s}")
+    for row in rows:
+        print(
+            f"{row['workers']:8d} {row['threads']:8d} {row['good']:3d}/{row['files']:<2d}"
+            f" {row['wall_time']:10.3f} {row['files_per_hour']:10.1f}"
+        )
+
+    columns = list(rows[0])
+    with open(output, "w") as f:
+        f.write(",".join(columns) + "\n")
+        for row in rows:
+            f.write(",".join(str(row[column]) for column in columns) + "\n")
+    print(f"Layout benchmark saved in {output} ({sum(n_atoms) / len(files):.1f} atoms per structure)")
 
 
 def main():
@@ -203,28 +886,148 @@ def main():
 
     files = glob.glob("*.cif")
     files += glob.glob("*.extxyz")
-    random.shuffle(files)
+
+    n_cores = len(os.sched_getaffinity(0))
+    dftb_kwargs = {
+        "method": args["method"],
+        "only_sp": args["single_point"],
+        "tol": args["tol"],
+        "relax_cell": args["no_relax_cell"],
+        "optimizer": args["optimizer"],
+        "scratch": args["scratch"],
+        "keep_outputs": args["keep_outputs"],
+        "socket": args["socket"],
+        "restart_charges": args["restart_charges"],
+        "charge_guess": args["charge_guess"],
+        "timeout": args["timeout"] if args["timeout"] > 0 else None,
+        "kill_grace": args["kill_grace"]
+    }
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    if args["benchmark_layouts"]:
+        benchmark_layouts(sorted(files)[:args["benchmark_files"]], dftb_kwargs, n_cores)
+        return
+
+    # Files already finished in a previous run are skipped.
+    run_start = time.time()
+    manifest = CampaignManifest(args["manifest"])
+    files = manifest.pending(files)
+
+    cache = None
+    if args["cache"] is not None:
+        settings = {
+            "code": "DFTB+",
+            "method": args["method"],
+            "single_point": args["single_point"]
+        }
+        if not args["single_point"]:
+            settings.update({
+                "tol": float(args["tol"]),
+                "relax_cell": args["no_relax_cell"],
+                "optimizer": args["optimizer"]
+            })
+        cache = ResultCache(
+            args["cache"],
+            settings=settings,
+            max_entries=args["cache_max_entries"],
+            max_age=args["cache_max_age"]
+        )
+        print(f"Result cache {args['cache']}: {len(cache)} entries")
+
+    sizes = file_sizes(files, manifest=manifest)
+    layouts = None
+    if args["plan_layout"] and len(files) > 0:
+        # Largest first, the wide layouts come first.
+        layouts = plan_layouts(
+            sorted(files, key=lambda fname: -(sizes[fname][0] or 0)), sizes, n_cores, args["atoms_per_thread"]
+        )
+
+    # Longest expected first, a large cell never starts at the end of the allocation. The remaining
+    # time is predicted with the workers of the layouts.
+    cost_model = CostModel.from_manifests(args["history"], records=manifest.records.values())
+    scheduler = LPTScheduler(files, cost_model, n_workers=args["nc"], sizes=sizes, layouts=layouts)
+    files = scheduler.order()
+    print(scheduler.report())
     print("="*60)
-    total_files = len(files)
-    count = 0
-    for file in files:
-        count += 1
-        start_time = time.time()
-        print("Doing something!")
-        relax_fname(
-            file,
-            method=args["method"],
-            only_sp=args["single_point"],
-            tol=args["tol"],
-            relax_cell=args["no_relax_cell"]
+    # Outputs, moves of the inputs and manifest updates are done in a background thread.
+    writer = AsyncWriter(max_pending=4 * args["prefetch"]) if args["prefetch"] > 0 else None
+    if layouts is not None:
+        for n_workers, n_threads, group in layouts:
+            run_pool(
+                scheduler.order(group),
+                n_workers,
+                dftb_kwargs,
+                manifest=manifest,
+                move_inputs=args["move_inputs"],
+                cache=cache,
+                scheduler=scheduler,
+                writer=writer,
+                prefetch=args["prefetch"],
+                n_threads=n_threads
+            )
+
+    elif args["nc"] > 1 and len(files) > 0:
+        run_pool(
+            files,
+            args["nc"],
+            dftb_kwargs,
+            manifest=manifest,
+            move_inputs=args["move_inputs"],
+            cache=cache,
+            scheduler=scheduler,
+            writer=writer,
+            prefetch=args["prefetch"],
+            n_threads=args["nt"]
         )
-        end_time = time.time()
-        execution_time = end_time - start_time
 
-        print("="*60)
-        print(f"File number: {count}/{total_files} - done in {execution_time:.3f} s")
-        print("="*60)
-    print("MACE job done!")
+    else:
+        set_threads(args["nt"] if args["nt"] is not None else n_cores)
+        total_files = len(files)
+        count = 0
+        for file, input_struc in PrefetchReader(files, args["prefetch"]):
+            count += 1
+            start_time = time.time()
+            print("Doing something!")
+            relax_fname(
+                file,
+                manifest=manifest,
+                move_input=args["move_inputs"],
+                cache=cache,
+                input_struc=input_struc,
+                writer=writer,
+                **dftb_kwargs
+            )
+            end_time = time.time()
+            execution_time = end_time - start_time
+            scheduler.finish(file, execution_time)
+
+            print("="*60)
+            print(f"File number: {count}/{total_files} - done in {execution_time:.3f} s")
+            print(scheduler.report())
+            print("="*60)
+
+    if writer is not None:
+        failed = writer.close()
+        print(f"Outputs written in background: {writer.n_done}, failed: {failed}")
+
+    records = [record for record in manifest.records.values() if record.get("time", 0) >= run_start]
+    cpu_time = sum(record.get("cpu_time") or 0.0 for record in records)
+    killed = [record for record in records if record.get("killed")]
+    print(f"DFTB+ CPU time of this run: {cpu_time:.1f} s, killed by the time limit: {len(killed)}")
+    for record in killed:
+        print(f"    {record['file']}: killed after {record['wall_time']:.1f} s ({record['cpu_time']:.1f} CPU s)")
+
+    records = [record for record in manifest.records.values() if record.get("scc_steps")]
+    if len(records) > 0:
+        iterations = sum(record["scc_iterations"] for record in records)
+        steps = sum(record["scc_steps"] for record in records)
+        print(f"SCC iterations: {iterations} in {steps} steps ({iterations / steps:.1f} per step)")
+
+    print("Campaign state:", manifest.summary())
+    manifest.close()
+    if cache is not None:
+        print("Result cache:", cache.summary())
+        cache.close()
+    print("DFTB+ job done!")
 
 
 if __name__ == '__main__':
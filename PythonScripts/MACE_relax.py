@@ -11,7 +11,8 @@ James Darby, modified by Orlando Villegas.
 import glob
 import argparse
 import copy
-import random
+import multiprocessing
+from collections import deque
 import os
 import shutil
 import time
@@ -22,18 +23,32 @@ warnings.simplefilter(action='ignore', category=DeprecationWarning)
 import numpy as np
 from func_timeout import func_set_timeout, FunctionTimedOut
 from mace.calculators import mace_mp
+from mace import data as mace_data
+from mace.tools import torch_geometric, torch_tools
+from torch_dftd.torch_dftd3_calculator import TorchDFTD3Calculator
 
 import ase.io
-from ase.units import GPa
+from ase.units import GPa, Bohr
+from ase.calculators.mixing import SumCalculator
+from ase.calculators.singlepoint import SinglePointCalculator
+from ase.calculators.calculator import Calculator, all_changes
+from ase.neighborlist import primitive_neighbor_list
+from ase.stress import full_3x3_to_voigt_6_stress
 from ase.constraints import FixSymmetry
 from ase.spacegroup.symmetrize import check_symmetry, refine_symmetry
 # from ase.constraints import FixAtoms
 from ase.filters import FrechetCellFilter
 
-# from ase.optimize.precon import PreconLBFGS
-from ase.optimize import LBFGS
 import torch
 
+from relax_tools import (
+    OPTIMIZERS, AsyncWriter, CachedFixSymmetry, CampaignManifest, CostModel, GammaHessian,
+    LPTScheduler, MemoryModel, PeakMemory, PrefetchReader, RelaxCheckpoint, ResultCache,
+    StartJournal, StepProfiler, SymmetryCache, SymmetryReducedFilter, atomic_write, available_memory,
+    carry_optimizer_state, estimate_edges, file_hash, file_sizes, make_optimizer, profile_summary, run_optimizer,
+    run_output, size_fields, snapshot, split_cores, symmetry_reduced_filter, warm_start_optimizer
+)
+
 # warnings.filterwarnings("ignore", category=DeprecationWarning)
 # warnings.filterwarnings(
 #     'ignore',
@@ -67,6 +82,10 @@ Examples:
 
 """
 
+# Default model, it can be changed with --model_file (use "medium" for the MACE-MP foundation model).
+# MODEL_FILE = "/home/ovillegas/Documents/test_MACE_vs_MProject/2023-12-03-mace-128-L1_epoch-199.model"
+MODEL_FILE = "/home/ovillegas/Documents/test_MACE_vs_MProject/2024-01-07-mace-128-L2_epoch-199.model"
+
 
 def options():
     """Generate command line interface."""
@@ -85,6 +104,18 @@ def options():
         metavar="val GPa"
     )
 
+    parser.add_argument(
+        "--pressures",
+        type=float,
+        nargs="+",
+        default=None,
+        metavar="GPa",
+        help="Pressure sweep, each structure is relaxed at the first pressure (all the stages) and\
+ then at the next ones, each starting from the geometry and the optimizer history of the previous\
+ one. The structure at each pressure is written as <name>_<P>GPa and the enthalpies are saved in\
+ pressure_sweep.csv (replaces --pressure)."
+    )
+
     # parser.add_argument(
     #     "--time_limit", "-t",
     #     default=5000,
@@ -105,6 +136,16 @@ def options():
         default=False
     )
 
+    parser.add_argument(
+        "--symmetry_reduced",
+        action="store_true",
+        default=False,
+        help="Keep the symmetry by relaxing only the free Wyckoff parameters and the lattice\
+ parameters allowed by the space group, instead of all the coordinates projected by FixSymmetry.\
+ The full relaxation is used if the symmetry cannot be found. Faster on strained cells with few free\
+ parameters, it can be slower on rattled structures (off by default)."
+    )
+
     parser.add_argument(
         "--tolerance",
         type=np.float64,
@@ -112,6 +153,23 @@ def options():
         metavar="val"
     )
 
+    parser.add_argument(
+        "--optimizer",
+        default="lbfgs",
+        choices=list(OPTIMIZERS),
+        help="Optimizer of the relaxations, it moves the atoms and the cell (with --relax_cell).\
+ The batched relaxation supports lbfgs and fire (default lbfgs)."
+    )
+
+    parser.add_argument(
+        "--mixed_precision",
+        type=float,
+        default=None,
+        metavar="fmax",
+        help="Pre-relax with a float32 model until the max force is below fmax (eV/A), then\
+ finish with the float64 model and --tolerance."
+    )
+
     parser.add_argument(
         "--double_relax",
         action="store_true",
@@ -120,17 +178,54 @@ def options():
  (2) relaxes without constraint."
     )
 
-    # parser.add_argument(
-    #     "-nc",
-    #     type=int,
-    #     default=1
-    # )
+    parser.add_argument(
+        "--stability_check",
+        action="store_true",
+        default=False,
+        help="After the relaxation, compute the Gamma-point Hessian by finite displacements of\
+ the symmetry-irreducible atoms (batched model calls) and flag the imaginary modes. Unstable\
+ structures are displaced along the softest mode and relaxed again without symmetry."
+    )
 
-    # parser.add_argument(
-    #     "-nt",
-    #     type=int,
-    #     default=1
-    # )
+    parser.add_argument(
+        "--stability_delta",
+        type=float,
+        default=0.01,
+        metavar="A",
+        help="Finite displacement of the Hessian (default 0.01 A)."
+    )
+
+    parser.add_argument(
+        "--stability_threshold",
+        type=float,
+        default=0.1,
+        metavar="THz",
+        help="Modes below -threshold are imaginary (default 0.1 THz)."
+    )
+
+    parser.add_argument(
+        "--stability_follow",
+        type=int,
+        default=2,
+        metavar="N",
+        help="Displace and re-relax along the soft mode at most N times (default 2)."
+    )
+
+    parser.add_argument(
+        "-nc",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Number of worker processes, each one loads its own model (default 1)."
+    )
+
+    parser.add_argument(
+        "-nt",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Torch threads per worker, by default the available cores divided by -nc."
+    )
 
     parser.add_argument(
         "--use_gpu",
@@ -139,12 +234,199 @@ def options():
         help="Configure MACE to use GPU. By default is CPU setup."
     )
 
+    parser.add_argument(
+        "--model_file",
+        default=MODEL_FILE,
+        metavar="path",
+        help="MACE model file, \"small\", \"medium\" or \"large\" load the MACE-MP foundation models."
+    )
+
+    parser.add_argument(
+        "--no_dispersion",
+        action="store_false",
+        default=True,
+        dest="dispersion",
+        help="Don't add the D3 dispersion correction."
+    )
+
+    parser.add_argument(
+        "--dispersion_mode",
+        default="full",
+        choices=["full", "final", "reduced"],
+        help="D3 at every step (full, default), only in the final polishing stage (final) or with\
+ the --d3_cutoff cutoff plus a long range tail correction (reduced)."
+    )
+
+    parser.add_argument(
+        "--d3_cutoff",
+        type=float,
+        default=20.0,
+        metavar="val Bohr",
+        help="D3 cutoff of --dispersion_mode reduced (default 20 Bohr, full D3 uses 40 Bohr)."
+    )
+
+    parser.add_argument(
+        "--neighbor_skin",
+        type=float,
+        default=0.0,
+        metavar="val A",
+        help="Verlet skin of the MACE and D3 neighbour lists, they are reused between steps until\
+ the atoms move more than half of it (0 rebuilds them at each step, default)."
+    )
+
     parser.add_argument(
         "--single_point",
         action="store_true",
         default=False
     )
 
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        metavar="N",
+        help="With --single_point, number of structures evaluated in the same model call."
+    )
+
+    parser.add_argument(
+        "--max_batch_atoms",
+        type=int,
+        default=5000,
+        metavar="N",
+        help="Maximum number of atoms in a batch of single points (default 5000)."
+    )
+
+    parser.add_argument(
+        "--batch_relax",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Relax N structures at the same time, each optimizer step is a single batched model call."
+    )
+
+    parser.add_argument(
+        "--abort_energy",
+        type=float,
+        default=None,
+        metavar="dE",
+        help="Reject a relaxation when its E/atom is dE eV above the best E/atom of the same\
+ composition (after --abort_min_steps steps)."
+    )
+
+    parser.add_argument(
+        "--abort_stagnation",
+        type=int,
+        default=None,
+        metavar="W",
+        help="Reject a relaxation when the max force has not decreased by 10%% in the last W steps."
+    )
+
+    parser.add_argument(
+        "--abort_min_steps",
+        type=int,
+        default=50,
+        metavar="N",
+        help="Steps before the early abort policies are applied (default 50)."
+    )
+
+    parser.add_argument(
+        "--checkpoint_interval",
+        type=int,
+        default=20,
+        metavar="K",
+        help="Save a checkpoint every K steps, a relaxation stopped by the time limit is continued\
+ from it in the next run (0 to disable, default 20)."
+    )
+
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=4,
+        metavar="K",
+        help="The next K structures are read in a background thread and the outputs (with the moves of\
+ the inputs and the manifest) are written by another one, the relaxations don't wait for the\
+ filesystem (default 4). 0 reads and writes in the main loop."
+    )
+
+    parser.add_argument(
+        "--memory_budget",
+        type=float,
+        default=None,
+        metavar="GB",
+        help="Memory of the run (default: 80%% of the available RAM, 90%% of the free GPU memory with\
+ --use_gpu), divided between the workers. A structure expected to need more (atoms and edges within\
+ the model cutoff) is relaxed alone with a float32 model at the end, or deferred if it still does not\
+ fit. 0 disables the guard."
+    )
+
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="profile",
+        default=None,
+        metavar="folder",
+        help="Record the time of the model, symmetry, cell filter and optimizer in each step, with\
+ fmax, energy and step length, in folder/<name>.npz (default folder: profile). A summary table is\
+ printed at the end."
+    )
+
+    parser.add_argument(
+        "--manifest",
+        default="manifest.jsonl",
+        metavar="file",
+        help="Journal of the campaign, finished files are skipped when the job is restarted."
+    )
+
+    parser.add_argument(
+        "--history",
+        nargs="+",
+        default=[],
+        metavar="manifest",
+        help="Manifests of previous campaigns (glob patterns), their wall times are used with the\
+ current manifest to predict the cost of each structure. The longest are run first."
+    )
+
+    parser.add_argument(
+        "--move_inputs",
+        action="store_true",
+        default=False,
+        help="Move the input files to the input folder when they are done (old behaviour)."
+    )
+
+    parser.add_argument(
+        "--cache",
+        default=None,
+        metavar="file",
+        help="sqlite result cache, a structure already computed with the same settings is taken\
+ from it (it can be shared by several campaigns)."
+    )
+
+    parser.add_argument(
+        "--cache_max_entries",
+        type=int,
+        default=100000,
+        metavar="N",
+        help="Least used entries above N are evicted from the cache (default 100000)."
+    )
+
+    parser.add_argument(
+        "--cache_max_age",
+        type=float,
+        default=90.0,
+        metavar="days",
+        help="Entries older than this are evicted from the cache (default 90 days)."
+    )
+
+    parser.add_argument(
+        "--symmetry_cache",
+        default="none",
+        metavar="file",
+        help="sqlite cache of the spglib datasets, shared with SymmetrizeStructures.py and\
+ RemoveDuplicatesFilter.py. It only helps when the same structures are analysed again (another\
+ script or a rerun on the same inputs), default \"none\" (the stages of a relaxation still share\
+ the operations in memory)."
+    )
+
     parser.add_argument(
         "--format_output",
         default="extxyz",
@@ -155,13 +437,713 @@ def options():
     return vars(parser.parse_args())
 
 
+class RelaxationSuspended(Exception):
+    """The time limit stopped a relaxation that can continue from its checkpoint."""
+
+    pass
+
+
+class RelaxationRejected(Exception):
+    """An AbortPolicy stopped a hopeless relaxation, the message is the reason."""
+
+    pass
+
+
+class AbortPolicy:
+    """
+    Early termination of hopeless relaxations.
+
+    check is attached to the optimizer, it raises RelaxationRejected when test returns a reason.
+    Subclasses implement test(step, energy, fmax) (energy per atom in eV). spawn returns the copy
+    used by a new structure, the state shared between structures (best energies) is kept.
+    """
+
+    def spawn(self):
+        """Return the policy of a new structure."""
+        return copy.copy(self)
+
+    def start(self, atoms):
+        """Reset the state of the structure."""
+        pass
+
+    def test(self, step, energy, fmax):
+        """Return the reason to stop the relaxation, None to continue."""
+        return None
+
+    def finish(self, atoms):
+        """Update the shared state with a relaxation that was not rejected."""
+        pass
+
+    def check(self, atoms, opt):
+        """Observer of the optimizer."""
+        fmax = np.sqrt((atoms.get_forces()**2).sum(axis=1).max())
+        reason = self.test(opt.nsteps, atoms.get_potential_energy() / len(atoms), fmax)
+        if reason is not None:
+            print(f"Relaxation rejected at step {opt.nsteps}: {reason}")
+            raise RelaxationRejected(reason)
+
+
+class EnergyAbovePolicy(AbortPolicy):
+    """Reject when E/atom is delta eV above the best E/atom of the same composition."""
+
+    def __init__(self, delta=0.5, min_steps=50):
+        self.delta = delta
+        self.min_steps = min_steps
+        # Best E/atom by empirical formula, shared by all the structures of the process.
+        self.best = {}
+        self.formula = None
+
+    def start(self, atoms):
+        self.formula = atoms.get_chemical_formula(empirical=True)
+
+    def test(self, step, energy, fmax):
+        best = self.best.get(self.formula)
+        if step >= self.min_steps and best is not None and energy > best + self.delta:
+            return f"E/atom {energy:.4f} eV is {energy - best:.3f} eV above the best {best:.4f} eV"
+
+        return None
+
+    def finish(self, atoms):
+        energy = atoms.get_potential_energy() / len(atoms)
+        self.best[self.formula] = min(energy, self.best.get(self.formula, np.inf))
+
+
+class ForceStagnationPolicy(AbortPolicy):
+    """Reject when the max force has not decreased by factor in the last window steps."""
+
+    def __init__(self, window=100, factor=0.9, min_steps=50):
+        self.window = window
+        self.factor = factor
+        self.min_steps = min_steps
+        self.history = deque(maxlen=window + 1)
+
+    def start(self, atoms):
+        self.history = deque(maxlen=self.window + 1)
+
+    def test(self, step, energy, fmax):
+        self.history.append(fmax)
+        if step < self.min_steps or len(self.history) <= self.window:
+            return None
+
+        if min(self.history) > self.factor * self.history[0]:
+            return f"fmax {fmax:.2e} stagnated during {self.window} steps"
+
+        return None
+
+
+class CombinedPolicy(AbortPolicy):
+    """Apply several policies, the first reason found stops the relaxation."""
+
+    def __init__(self, policies):
+        self.policies = policies
+
+    def spawn(self):
+        return CombinedPolicy([policy.spawn() for policy in self.policies])
+
+    def start(self, atoms):
+        for policy in self.policies:
+            policy.start(atoms)
+
+    def test(self, step, energy, fmax):
+        for policy in self.policies:
+            reason = policy.test(step, energy, fmax)
+            if reason is not None:
+                return reason
+
+        return None
+
+    def finish(self, atoms):
+        for policy in self.policies:
+            policy.finish(atoms)
+
+
+def build_abort_policy(abort_energy=None, abort_stagnation=None, min_steps=50):
+    """Return the policy selected in the command line, None if there is none."""
+    policies = []
+    if abort_energy is not None:
+        policies.append(EnergyAbovePolicy(abort_energy, min_steps=min_steps))
+    if abort_stagnation is not None:
+        policies.append(ForceStagnationPolicy(abort_stagnation, min_steps=min_steps))
+
+    if len(policies) == 0:
+        return None
+    elif len(policies) == 1:
+        return policies[0]
+
+    return CombinedPolicy(policies)
+
+
+class SkinNeighborList:
+    """
+    Neighbour list with a Verlet skin.
+
+    The pairs are searched with cutoff + skin and reused while they still contain every pair within
+    cutoff: twice the largest displacement (relative to the affine deformation of the cell) plus
+    the stretch of the cell must stay below the skin. `pairs` filters the cached pairs at the
+    current geometry, so the result is the same as a new search.
+    """
+
+    def __init__(self, cutoff, skin=0.5):
+        """Cutoff and skin in A."""
+        self.cutoff = cutoff
+        self.skin = skin
+        self.positions = None
+        self.cell = None
+        self.pbc = None
+        self.n_builds = 0
+        self.n_calls = 0
+
+    def needs_update(self, positions, cell, pbc):
+        """Return True if the cached pairs are not valid for this geometry."""
+        if self.positions is None or len(positions) != len(self.positions):
+            return True
+
+        if np.any(pbc != self.pbc):
+            return True
+
+        # cell = cell_0 @ deformation
+        deformation = np.linalg.solve(self.cell, cell)
+        strain = np.linalg.norm(deformation - np.eye(3), 2)
+        displacement = positions - self.positions @ deformation
+        max_displacement = np.sqrt((displacement**2).sum(axis=1).max())
+
+        return 2 * max_displacement + strain * (self.cutoff + self.skin) >= self.skin
+
+    def update(self, positions, cell, pbc):
+        """Search the pairs again if needed, returns True if they were searched."""
+        self.n_calls += 1
+        if not self.needs_update(positions, cell, pbc):
+            return False
+
+        self.i, self.j, self.S = primitive_neighbor_list(
+            "ijS", pbc, cell, positions, self.cutoff + self.skin
+        )
+        self.positions = positions.copy()
+        self.cell = cell.copy()
+        self.pbc = pbc.copy()
+        self.n_builds += 1
+
+        return True
+
+    def pairs(self, positions, cell, pbc):
+        """Return i, j and the cell shifts S of the pairs within cutoff."""
+        self.update(positions, cell, pbc)
+        distances = positions[self.j] - positions[self.i] + self.S @ cell
+        within = (distances**2).sum(axis=1) <= self.cutoff**2
+
+        return self.i[within], self.j[within], self.S[within]
+
+
+class SkinTorchDFTD3Calculator(TorchDFTD3Calculator):
+    """TorchDFTD3Calculator that reuses its pair list with a Verlet skin (periodic cells)."""
+
+    def __init__(self, skin=1.0, max_lists=256, **kwargs):
+        """Same parameters as TorchDFTD3Calculator."""
+        super().__init__(**kwargs)
+        self.skin = skin
+        self.max_lists = max_lists
+        self.neighbor_lists = {}
+        self._current = None
+
+    def _preprocess_atoms(self, atoms):
+        # One list by structure, batch_calculate preprocesses several of them.
+        self._current = None
+        if all(atoms.pbc):
+            self._current = get_neighbor_list(self.neighbor_lists, atoms, self.cutoff, self.skin, self.max_lists)
+
+        return super()._preprocess_atoms(atoms)
+
+    def _calc_edge_index(self, pos, cell=None, pbc=None):
+        if self._current is None or cell is None:
+            return super()._calc_edge_index(pos, cell, pbc)
+
+        i, j, S = self._current.pairs(
+            pos.detach().cpu().numpy(),
+            cell.detach().cpu().numpy(),
+            pbc.detach().cpu().numpy()
+        )
+        edge_index = torch.tensor(np.stack([i, j], axis=0), dtype=torch.long, device=pos.device)
+
+        return edge_index, torch.tensor(S, dtype=pos.dtype, device=pos.device)
+
+
+def get_neighbor_list(neighbor_lists, atoms, cutoff, skin, max_lists=256):
+    """
+    Return the SkinNeighborList of a structure from the neighbor_lists dictionary.
+
+    The lists are kept by id(atoms); a reused id only costs a new search, the list checks the
+    geometry before giving its pairs.
+    """
+    key = id(atoms)
+    if key not in neighbor_lists:
+        if len(neighbor_lists) >= max_lists:
+            del neighbor_lists[next(iter(neighbor_lists))]
+        neighbor_lists[key] = SkinNeighborList(cutoff, skin)
+
+    return neighbor_lists[key]
+
+
+class D3TailCalculator(Calculator):
+    """
+    Long range D3 energy beyond the reduced cutoff.
+
+    At the first geometry of a structure the tail dE_0 = E_full - E_reduced and the stress
+    dS_0 = S_full - S_reduced are evaluated with both cutoffs and saved in atoms.info["d3_tail"]
+    (dE_0, V_0, dS_0 in Voigt order). As for a homogeneous system the tail is then
+    E = dE_0 V_0 / V and S = dS_0 (V_0 / V)^2, without forces. dS_0 is not -dE_0/V_0: the reduced
+    calculator also misses the virial of the removed C6/r^6 shell, about -2 dE_0/V_0.
+    """
+
+    implemented_properties = ["energy", "free_energy", "forces", "stress"]
+
+    def __init__(self, d3_full, d3_reduced, **kwargs):
+        """D3 calculators with the full and the reduced cutoffs."""
+        Calculator.__init__(self, **kwargs)
+        self.d3_full = d3_full
+        self.d3_reduced = d3_reduced
+
+    def tail(self, atoms):
+        """Return the energy and the stress (Voigt) of the tail."""
+        if atoms.cell.rank < 3:
+            return 0.0, np.zeros(6)
+
+        # Also recomputed for an entry without the stress.
+        if len(atoms.info.get("d3_tail", ())) != 8:
+            full = self.d3_full.batch_calculate([atoms], properties=["energy", "stress"])[0]
+            reduced = self.d3_reduced.batch_calculate([atoms], properties=["energy", "stress"])[0]
+            atoms.info["d3_tail"] = np.concatenate([
+                [full["energy"] - reduced["energy"], atoms.get_volume()],
+                np.asarray(full["stress"]) - np.asarray(reduced["stress"])
+            ])
+
+        tail = atoms.info["d3_tail"]
+        delta_0, volume_0, stress_0 = tail[0], tail[1], np.asarray(tail[2:8])
+        ratio = volume_0 / atoms.get_volume()
+
+        return delta_0 * ratio, stress_0 * ratio ** 2
+
+    def calculate(self, atoms=None, properties=["energy"], system_changes=all_changes):
+        Calculator.calculate(self, atoms, properties, system_changes)
+        energy, stress = self.tail(atoms)
+        self.results = {
+            "energy": energy,
+            "free_energy": energy,
+            "forces": np.zeros((len(atoms), 3)),
+            "stress": stress
+        }
+
+
+class SessionCalculator(Calculator):
+    """ASE calculator that evaluates the structure with MACESession.evaluate_batch."""
+
+    implemented_properties = ["energy", "free_energy", "forces", "stress"]
+
+    def __init__(self, session, dispersion=True, **kwargs):
+        """Use the models of session, D3 is included if dispersion is True."""
+        Calculator.__init__(self, **kwargs)
+        self.session = session
+        self.dispersion = dispersion
+
+    def calculate(self, atoms=None, properties=["energy"], system_changes=all_changes):
+        Calculator.calculate(self, atoms, properties, system_changes)
+        compute_stress = atoms.cell.rank == 3
+        res = self.session.evaluate_batch(
+            [atoms],
+            compute_stress=compute_stress,
+            dispersion=self.dispersion
+        )[0]
+        self.results = {
+            "energy": res["energy"],
+            "free_energy": res["energy"],
+            "forces": res["forces"]
+        }
+        if compute_stress:
+            self.results["stress"] = res["stress"]
+
+
+class MACESession:
+    """
+    Persistent MACE calculator shared by all the structures of a run.
+
+    The model and the D3 dispersion module are built only once, `attach` clears the results of the
+    previous structure before giving the calculator to the next one.
+
+    With skin > 0 the neighbour lists of MACE and D3 are SkinNeighborList objects reused between
+    steps, the calculator is then a SessionCalculator that builds the graphs from them.
+
+    dispersion_mode is "full" (D3 always), "final" (the relaxation stages ask for D3 with
+    attach(atoms, dispersion=True), only the last one does it) or "reduced" (D3 with d3_cutoff
+    and a D3TailCalculator). It is "none" without dispersion.
+    """
+
+    def __init__(
+        self, model_file="medium", device="cpu", default_dtype="float64", dispersion=True, skin=0.0,
+        dispersion_mode="full", d3_cutoff=20.0 * Bohr
+    ):
+        """Load the model and build the calculators."""
+        self.model_file = model_file
+        self.device = device
+        self.default_dtype = default_dtype
+        self.dispersion = dispersion
+        self.dispersion_mode = dispersion_mode if dispersion else "none"
+        self.d3_cutoff = d3_cutoff
+        self.skin = skin
+        self.neighbor_lists = {}
+        self.graph_templates = {}
+        self._low_precision = None
+
+        t_i = time.time()
+        self.mace_calc = mace_mp(
+            model=model_file,
+            dispersion=False,
+            default_dtype=default_dtype,
+            device=device
+        )
+
+        self.d3_calc = None
+        self.d3_tail = None
+        if dispersion:
+            # Same setup used by mace_mp(dispersion=True).
+            d3_kwargs = {
+                "device": device,
+                "damping": "bj",
+                "xc": "pbe",
+                "dtype": torch.float32 if default_dtype == "float32" else torch.float64,
+                "cutoff": 40.0 * Bohr
+            }
+            if dispersion_mode == "reduced":
+                d3_full = TorchDFTD3Calculator(**d3_kwargs)
+                # The coordination numbers are short ranged, cnthr is reduced too.
+                d3_kwargs["cutoff"] = d3_cutoff
+                d3_kwargs["cnthr"] = min(d3_cutoff, 40.0 * Bohr)
+            if skin > 0:
+                self.d3_calc = SkinTorchDFTD3Calculator(skin=skin, **d3_kwargs)
+            else:
+                self.d3_calc = TorchDFTD3Calculator(**d3_kwargs)
+            if dispersion_mode == "reduced":
+                self.d3_tail = D3TailCalculator(d3_full, self.d3_calc)
+                self.calculator = SumCalculator([self.mace_calc, self.d3_calc, self.d3_tail])
+            else:
+                self.calculator = SumCalculator([self.mace_calc, self.d3_calc])
+        else:
+            self.calculator = self.mace_calc
+        self.calculator_no_d3 = self.mace_calc
+
+        if skin > 0:
+            # MACE and D3 are evaluated together from the cached neighbour lists.
+            self.calculator = SessionCalculator(self)
+            self.calculator_no_d3 = SessionCalculator(self, dispersion=False)
+
+        print(
+            f"MACE session ready ({model_file}, {default_dtype}, {device}, D3 {self.dispersion_mode})"
+            f" in {time.time() - t_i:.3f} s"
+        )
+
+    def low_precision(self):
+        """Return a float32 session of the same model, it is built the first time it is needed."""
+        if self.default_dtype == "float32":
+            return self
+
+        if self._low_precision is None:
+            self._low_precision = MACESession(
+                self.model_file,
+                device=self.device,
+                default_dtype="float32",
+                dispersion=self.dispersion,
+                skin=self.skin,
+                dispersion_mode=self.dispersion_mode,
+                d3_cutoff=self.d3_cutoff
+            )
+
+        return self._low_precision
+
+    @property
+    def calcs(self):
+        """Return all the calculators of the session."""
+        return [
+            calc for calc in (self.mace_calc, self.d3_calc, self.d3_tail, self.calculator, self.calculator_no_d3)
+            if calc is not None
+        ]
+
+    def reset(self):
+        """Forget the results and the atoms of the previous structure."""
+        # Same as Calculator.reset, SumCalculator does not implement it.
+        for calc in self.calcs:
+            calc.atoms = None
+            calc.results = {}
+
+    def attach(self, atoms, dispersion=True):
+        """Assign the session calculator to a new structure, without D3 if dispersion is False."""
+        self.reset()
+        atoms.calc = self.calculator if dispersion else self.calculator_no_d3
+        return atoms
+
+    def neighbor_summary(self):
+        """Return the number of searches and evaluations of the skin neighbour lists."""
+        lists = {"MACE": self.neighbor_lists}
+        if isinstance(self.d3_calc, SkinTorchDFTD3Calculator):
+            lists["D3"] = self.d3_calc.neighbor_lists
+
+        summary = []
+        for name, neighbor_lists in lists.items():
+            n_builds = sum(nl.n_builds for nl in neighbor_lists.values())
+            n_calls = sum(nl.n_calls for nl in neighbor_lists.values())
+            summary.append(f"{name}: {n_builds} neighbour searches for {n_calls} evaluations")
+
+        return ", ".join(summary)
+
+    def atoms_to_graph(self, atoms):
+        """Build the MACE graph of a structure."""
+        if self.skin > 0 and all(atoms.pbc):
+            return self._skin_graph(atoms)
+
+        return self._new_graph(atoms)
+
+    def _skin_graph(self, atoms):
+        """Build the graph from the SkinNeighborList of the structure."""
+        neighbor_list = get_neighbor_list(self.neighbor_lists, atoms, self.mace_calc.r_max, self.skin)
+        template = self.graph_templates.get(id(atoms))
+        if template is None or not np.array_equal(template[0], atoms.numbers):
+            # Node attributes and the other fields don't change during the relaxation.
+            if len(self.graph_templates) >= len(self.neighbor_lists):
+                self.graph_templates.pop(next(iter(self.graph_templates)))
+            template = (atoms.numbers.copy(), self._new_graph(atoms))
+            self.graph_templates[id(atoms)] = template
+
+        positions = atoms.get_positions()
+        cell = atoms.cell.array
+        i, j, S = neighbor_list.pairs(positions, cell, atoms.pbc)
+
+        # Shallow copy, the tensors that change are replaced.
+        graph = copy.copy(template[1])
+        dtype = graph["positions"].dtype
+        graph["positions"] = torch.tensor(positions, dtype=dtype)
+        graph["cell"] = torch.tensor(cell, dtype=dtype)
+        graph["edge_index"] = torch.tensor(np.stack([i, j], axis=0), dtype=torch.long)
+        graph["unit_shifts"] = torch.tensor(S, dtype=dtype)
+        graph["shifts"] = torch.tensor(S @ cell, dtype=dtype)
+        if "volume" in graph.keys:
+            graph["volume"] = torch.linalg.det(graph["cell"])
+            graph["rcell"] = 2 * torch.pi * torch.linalg.inv(graph["cell"].mT)
+
+        return graph
+
+    def _new_graph(self, atoms):
+        """Build the MACE graph of a structure with a new neighbour search."""
+        graph_kwargs = {}
+        heads = getattr(self.mace_calc, "available_heads", None)
+        if heads is not None:
+            graph_kwargs["heads"] = heads
+
+        with torch_tools.default_dtype(self.default_dtype):
+            config = mace_data.config_from_atoms(atoms)
+            graph = mace_data.AtomicData.from_config(
+                config,
+                z_table=self.mace_calc.z_table,
+                cutoff=self.mace_calc.r_max,
+                **graph_kwargs
+            )
+
+        return graph
+
+    def evaluate_batch(self, atoms_list, compute_stress=True, dispersion=True):
+        """
+        Evaluate several structures with a single model call.
+
+        The graphs of all the structures are packed in one disjoint batch. Returns a list with the
+        energy, forces and stress (Voigt, eV/A^3) of each structure, D3 included if dispersion.
+        """
+        graphs = [self.atoms_to_graph(atoms) for atoms in atoms_list]
+        batch = torch_geometric.Batch.from_data_list(graphs).to(self.device)
+        ptr = batch.ptr.cpu().numpy()
+
+        energy = np.zeros(len(atoms_list))
+        forces = np.zeros((ptr[-1], 3))
+        stress = np.zeros((len(atoms_list), 3, 3))
+        # Committee models are averaged as MACECalculator does.
+        models = self.mace_calc.models
+        for model in models:
+            out = model(batch.clone().to_dict(), compute_stress=compute_stress, training=False)
+            energy += out["energy"].detach().cpu().numpy() / len(models)
+            forces += out["forces"].detach().cpu().numpy() / len(models)
+            if compute_stress:
+                stress += out["stress"].detach().cpu().numpy() / len(models)
+
+        results = []
+        for i in range(len(atoms_list)):
+            res = {
+                "energy": energy[i],
+                "forces": forces[ptr[i]:ptr[i + 1]].copy()
+            }
+            if compute_stress:
+                res["stress"] = full_3x3_to_voigt_6_stress(stress[i])
+            results.append(res)
+
+        if self.d3_calc is not None and dispersion:
+            properties = ["energy", "forces", "stress"] if compute_stress else ["energy", "forces"]
+            d3_results = self.d3_calc.batch_calculate(atoms_list, properties=properties)
+            for res, d3_res in zip(results, d3_results):
+                for prop in res:
+                    res[prop] = res[prop] + d3_res[prop]
+
+            if self.d3_tail is not None:
+                for atoms, res in zip(atoms_list, results):
+                    energy, stress = self.d3_tail.tail(atoms)
+                    res["energy"] = res["energy"] + energy
+                    if compute_stress:
+                        res["stress"] = res["stress"] + stress
+
+        return results
+
+
+def group_by_size(atoms_list, batch_size, max_batch_atoms=5000):
+    """
+    Split the structures in batches of similar number of atoms.
+
+    Returns a list of lists of indexes, each batch has at most batch_size structures and
+    max_batch_atoms atoms (a single larger structure is left alone in its batch).
+    """
+    order = sorted(range(len(atoms_list)), key=lambda i: len(atoms_list[i]))
+
+    batches = []
+    current = []
+    n_atoms = 0
+    for i in order:
+        natoms_i = len(atoms_list[i])
+        if len(current) > 0 and (len(current) >= batch_size or n_atoms + natoms_i > max_batch_atoms):
+            batches.append(current)
+            current = []
+            n_atoms = 0
+        current.append(i)
+        n_atoms += natoms_i
+
+    if len(current) > 0:
+        batches.append(current)
+
+    return batches
+
+
+def batch_single_point(atoms_list, session, batch_size=64, max_batch_atoms=5000, compute_stress=True):
+    """Return the single point results of a list of structures evaluated by batches."""
+    results = [None] * len(atoms_list)
+    for batch in group_by_size(atoms_list, batch_size, max_batch_atoms):
+        batch_results = session.evaluate_batch(
+            [atoms_list[i] for i in batch], compute_stress=compute_stress
+        )
+        for i, res in zip(batch, batch_results):
+            results[i] = res
+
+    return results
+
+
+def single_point_files(
+    files, session, batch_size=64, max_batch_atoms=5000, good_fol="completed", bad_fol="fail",
+    manifest=None, cache=None
+):
+    """Run the single points of a list of files by batches and write the results."""
+    for fol in [good_fol, bad_fol]:
+        if not os.path.isdir(fol):
+            try:
+                os.mkdir(fol)
+            except FileExistsError:
+                pass
+
+    # The files are read by chunks, several batches are formed in each chunk.
+    chunk_size = batch_size * 16
+    total_files = len(files)
+    count = 0
+    for i in range(0, total_files, chunk_size):
+        names = []
+        structures = []
+        keys = []
+        for fname in files[i:i + chunk_size]:
+            try:
+                struc = ase.io.read(fname)
+            except Exception:
+                print(f"failed to read {fname}")
+                if manifest is not None:
+                    manifest.finish(fname, "fail", error="read")
+                continue
+
+            if cache is not None:
+                key = cache.key(struc)
+                if write_cached(fname, key, cache, True, good_fol, manifest=manifest):
+                    continue
+                keys.append(key)
+            structures.append(struc)
+            names.append(fname)
+
+        if manifest is not None:
+            for fname, struc in zip(names, structures):
+                manifest.start(fname, **size_fields(struc))
+
+        start_time = time.time()
+        results = batch_single_point(structures, session, batch_size, max_batch_atoms)
+        execution_time = time.time() - start_time
+
+        for fname, struc, res in zip(names, structures, results):
+            E = res["energy"]
+            print(fname, "E (eV) is", E, "----", "E/atom", E / len(struc))
+            struc.info = {}
+            struc.calc = SinglePointCalculator(struc, **res)
+            outfile = fname.split("/")[-1].split(".")[0] + "_sp.extxyz"
+            atomic_write(good_fol + "/" + outfile, struc)
+            if manifest is not None:
+                manifest.finish(
+                    fname, "done",
+                    output=good_fol + "/" + outfile,
+                    wall_time=execution_time / len(structures)
+                )
+        if cache is not None:
+            for fname, key, struc in zip(names, keys, structures):
+                cache.put(key, struc, fname=fname)
+
+        count += len(files[i:i + chunk_size])
+        print("="*60)
+        print(f"File number: {count}/{total_files} - {len(structures)} single points in {execution_time:.3f} s")
+        print("="*60)
+
+
+# Symmetry datasets shared by the stages and the scripts, opened by open_symmetry_cache.
+_SYMMETRY_CACHE = None
+
+
+def open_symmetry_cache(path):
+    """Open the symmetry cache of this process (path None or "none": kept in memory only)."""
+    global _SYMMETRY_CACHE
+
+    if path is not None and path.lower() == "none":
+        path = None
+    _SYMMETRY_CACHE = SymmetryCache(path)
+    return _SYMMETRY_CACHE
+
+
+def get_symmetry(atoms, symprec=1.0e-6, verbose=False):
+    """check_symmetry with the symmetry cache if it is open."""
+    if _SYMMETRY_CACHE is not None:
+        return _SYMMETRY_CACHE.check(atoms, symprec, verbose=verbose)
+    return check_symmetry(atoms, symprec, verbose=verbose)
+
+
 @func_set_timeout(3600.0)
 def relax_config(
         atoms, relax_pos=True, relax_cell=True, tol=1e-3, method='lbfgs', max_steps=10000,
         constant_volume=False, refine_symmetry_tol=None, keep_symmetry=False, strain_mask=None,
         config_label=None, from_base_model=False, save_config=False, try_restart=False,
-        fix_cell_dependence=False, applied_P=0.0, hydrostatic_strain=False, **kwargs):
-    """Relaxes the structure and returns the state of relaxation and new structure."""
+        fix_cell_dependence=False, applied_P=0.0, hydrostatic_strain=False, checkpoint=None,
+        stage=2, abort_policy=None, stats=None, profiler=None, symmetry_reduced=False,
+        warm_start=None, **kwargs):
+    """
+    Relaxes the structure and returns the state of relaxation and new structure.
+
+    With a RelaxCheckpoint the optimizer history of the same stage is restored and saved every
+    checkpoint.interval steps. An AbortPolicy raises RelaxationRejected to stop hopeless cases.
+    The steps and time of the stage are appended to the stats list, a StepProfiler records the
+    time of each step. With symmetry_reduced the optimizer moves only the coordinates allowed by
+    the space group (SymmetryReducedFilter). A warm_start dictionary carries the optimizer history
+    from one call to the next one (its "state"), the pressure sweeps start from it.
+    """
+    t_i = time.time()
     print("atoms are", atoms)
     print("applied P is", applied_P)
     print("tol is", tol)
@@ -171,42 +1153,82 @@ def relax_config(
     print("E (eV) is", E, "----", "E/atom", E / len(atoms))
 
     print("relax_config symmetry before refinement at default tol 1.0e-6")
-    check_symmetry(atoms, 1.0e-6, verbose=True)
+    get_symmetry(atoms, 1.0e-6, verbose=True)
     if refine_symmetry_tol is not None:
         refine_symmetry(atoms, refine_symmetry_tol)
         print("relax_config symmetry after refinement")
-        check_symmetry(atoms, refine_symmetry_tol, verbose=True)
-    if keep_symmetry:
+        get_symmetry(atoms, refine_symmetry_tol, verbose=True)
+    atoms_cell = None
+    if symmetry_reduced:
+        if strain_mask is None and not constant_volume:
+            atoms_cell = symmetry_reduced_filter(
+                atoms,
+                relax_cell=relax_cell,
+                scalar_pressure=applied_P*GPa,
+                hydrostatic_strain=hydrostatic_strain,
+                symmetry_cache=_SYMMETRY_CACHE
+            )
+        if atoms_cell is None:
+            print("Symmetry-reduced relaxation not possible, full relaxation")
+        else:
+            print("Symmetry-reduced relaxation:", atoms_cell.describe())
+
+    if keep_symmetry and atoms_cell is None:
         print("relax_config trying to maintain symmetry")
-        atoms.set_constraint(FixSymmetry(atoms))
+        atoms.set_constraint(CachedFixSymmetry(atoms, cache=_SYMMETRY_CACHE))
 
     print("after keeping symmetry atoms are", atoms)
-    if method == 'lbfgs':
-        # if 'move_mask' in atoms.arrays:
-        #     atoms.set_constraint(FixAtoms(np.where(atoms.arrays['move_mask'] == 0)[0]))
-        if relax_cell:
-            print("setting atoms_cell")
-            atoms_cell = FrechetCellFilter(
-                            atoms,
-                            mask=strain_mask,
-                            constant_volume=constant_volume,
-                            scalar_pressure=applied_P*GPa,
-                            hydrostatic_strain=hydrostatic_strain
-                        )
-            print("atom_cell is", atoms_cell)
-        else:
-            atoms_cell = atoms
-        # atoms.info["n_minim_iter"] = 0
-
-        print("constructing opt...")
-        # opt = PreconLBFGS(atoms_cell, use_armijo=False, **kwargs)
-        # opt = LBFGS(atoms_cell, **kwargs)
-        opt = LBFGS(atoms, **kwargs)
+    # if 'move_mask' in atoms.arrays:
+    #     atoms.set_constraint(FixAtoms(np.where(atoms.arrays['move_mask'] == 0)[0]))
+    if atoms_cell is None and relax_cell:
+        print("setting atoms_cell")
+        atoms_cell = FrechetCellFilter(
+                        atoms,
+                        mask=strain_mask,
+                        constant_volume=constant_volume,
+                        scalar_pressure=applied_P*GPa,
+                        hydrostatic_strain=hydrostatic_strain
+                    )
+        print("atom_cell is", atoms_cell)
+    elif atoms_cell is None:
+        atoms_cell = atoms
+    # atoms.info["n_minim_iter"] = 0
+
+    print(f"constructing opt ({method})...")
+    # The optimizer moves the cell too when it is given the filter.
+    opt = make_optimizer(method, atoms_cell, **kwargs)
+
+    reduced = isinstance(atoms_cell, SymmetryReducedFilter)
+    if warm_start is not None and "state" in warm_start and not reduced:
+        if warm_start_optimizer(opt, atoms_cell, warm_start["state"]):
+            print("Optimizer history taken from the previous relaxation")
+
+    if checkpoint is not None:
+        # The reduced coordinates start from the saved geometry, their old history does not apply.
+        if not reduced:
+            checkpoint.restore(opt, atoms_cell, stage=stage)
+        checkpoint.attach(atoms, opt, atoms_cell, stage=stage)
+
+    if abort_policy is not None:
+        abort_policy.start(atoms)
+        opt.attach(abort_policy.check, interval=1, atoms=atoms, opt=opt)
+
+    if profiler is not None:
+        profiler.attach(atoms, atoms_cell, opt, stage=stage, setup_time=time.time() - t_i)
 
-    else:
-        raise ValueError('unknown method %s!' % method)
     print(f"trying to run..., tolerance: {tol:.2e}")
-    opt.run(tol, max_steps)
+    try:
+        run_optimizer(opt, atoms_cell, tol, max_steps - opt.nsteps)
+    finally:
+        if profiler is not None:
+            profiler.detach()
+
+    if abort_policy is not None:
+        abort_policy.finish(atoms)
+
+    if warm_start is not None:
+        warm_start["state"] = carry_optimizer_state(opt, atoms_cell)
+        warm_start["steps"] = opt.nsteps
 
     """
 
@@ -224,20 +1246,443 @@ def relax_config(
 
     """
 
-    fmax = max(np.linalg.norm(atoms.get_forces(), axis=1))
+    # Forces of the optimized degrees of freedom, with the cell ones.
+    fmax = max(np.linalg.norm(atoms_cell.get_forces(), axis=1))
     good = True
     if fmax > tol:
         good = False
 
+    print(f"Stage {stage}: {opt.nsteps} steps in {time.time() - t_i:.3f} s, fmax {fmax:.2e}")
+    if stats is not None:
+        stats.append({
+            "stage": stage,
+            "steps": opt.nsteps,
+            "time": time.time() - t_i,
+            "fmax": float(fmax),
+            "energy": float(atoms.get_potential_energy()),
+            "pressure": applied_P
+        })
+
     return good, atoms
 
 
-def relax_fname(
-    fname, model_file, relax_arg_dict, good_fol="completed", bad_fol="fail", input_fol="input",
-    device="cpu", only_sp=False, format_output="extxyz", double_relax=False
+class BatchRelaxer:
+    """
+    Relax many structures at the same time with batched model calls.
+
+    Each structure keeps its own cell filter and optimizer, but every optimizer step evaluates all
+    the active structures with a single MACESession.evaluate_batch call. Converged, timed out or
+    failed structures leave the batch and the next ones in the queue take their slots. Only the
+    optimizers that take a step from the given forces (METHODS) can be used.
+    """
+
+    METHODS = ["lbfgs", "fire"]
+
+    def __init__(
+        self, session, batch_size=32, tol=1e-4, max_steps=10000, relax_cell=True, applied_P=0.0,
+        keep_symmetry=False, strain_mask=None, constant_volume=False, hydrostatic_strain=False,
+        time_limit=3600.0, abort_policy=None, dispersion=True, method="lbfgs", symmetry_reduced=False,
+        **kwargs
+    ):
+        """Set the relaxation parameters, the same as relax_config (dispersion: D3 is used)."""
+        if method not in self.METHODS:
+            raise ValueError('unknown method %s!' % method)
+
+        self.session = session
+        self.method = method
+        self.symmetry_reduced = symmetry_reduced
+        self.dispersion = dispersion
+        self.batch_size = batch_size
+        self.tol = tol
+        self.max_steps = max_steps
+        self.relax_cell = relax_cell
+        self.applied_P = applied_P
+        self.keep_symmetry = keep_symmetry
+        self.strain_mask = strain_mask
+        self.constant_volume = constant_volume
+        self.hydrostatic_strain = hydrostatic_strain
+        self.time_limit = time_limit
+        self.abort_policy = abort_policy
+
+    def _start(self, key, atoms):
+        """Prepare the optimizer of a structure that enters in the batch."""
+        atoms.set_constraint()
+        atoms_cell = None
+        if self.symmetry_reduced and self.strain_mask is None and not self.constant_volume:
+            atoms_cell = symmetry_reduced_filter(
+                atoms,
+                relax_cell=self.relax_cell,
+                scalar_pressure=self.applied_P*GPa,
+                hydrostatic_strain=self.hydrostatic_strain,
+                symmetry_cache=_SYMMETRY_CACHE
+            )
+        if self.keep_symmetry and atoms_cell is None:
+            atoms.set_constraint(CachedFixSymmetry(atoms, cache=_SYMMETRY_CACHE))
+
+        if atoms_cell is None and self.relax_cell:
+            atoms_cell = FrechetCellFilter(
+                atoms,
+                mask=self.strain_mask,
+                constant_volume=self.constant_volume,
+                scalar_pressure=self.applied_P*GPa,
+                hydrostatic_strain=self.hydrostatic_strain
+            )
+        elif atoms_cell is None:
+            atoms_cell = atoms
+
+        policy = None
+        if self.abort_policy is not None:
+            policy = self.abort_policy.spawn()
+            policy.start(atoms)
+
+        return {
+            "key": key,
+            "atoms": atoms,
+            "atoms_cell": atoms_cell,
+            "policy": policy,
+            "opt": make_optimizer(self.method, atoms_cell, logfile=None),
+            "steps": 0,
+            "start": time.time()
+        }
+
+    def run(self, items):
+        """
+        Relax the (key, atoms) pairs of items.
+
+        It is a generator, (key, good, atoms, steps) is returned as soon as a structure leaves the
+        batch. items can also be a generator, it is consumed only when a slot is free. The reason
+        of the structures stopped by the abort policy is saved in atoms.info["rejected"].
+        """
+        queue = iter(items)
+        active = deque()
+        exhausted = False
+        while True:
+            while not exhausted and len(active) < self.batch_size:
+                try:
+                    key, atoms = next(queue)
+                except StopIteration:
+                    exhausted = True
+                    break
+                active.append(self._start(key, atoms))
+
+            if len(active) == 0:
+                break
+
+            try:
+                results = self.session.evaluate_batch(
+                    [slot["atoms"] for slot in active],
+                    compute_stress=self.relax_cell,
+                    dispersion=self.dispersion
+                )
+            except RuntimeError as error:
+                # Evaluates one by one to find the structure that fails.
+                print("Batch evaluation failed:", error)
+                results = []
+                for slot in active:
+                    try:
+                        results.append(
+                            self.session.evaluate_batch([slot["atoms"]], self.relax_cell, self.dispersion)[0]
+                        )
+                    except RuntimeError:
+                        results.append(None)
+
+            remaining = deque()
+            for slot, res in zip(active, results):
+                atoms = slot["atoms"]
+                if res is None:
+                    print(f"{slot['key']}: model evaluation failed")
+                    yield slot["key"], False, atoms, slot["steps"]
+                    continue
+
+                atoms.calc = SinglePointCalculator(atoms, **res)
+                forces = slot["atoms_cell"].get_forces()
+                fmax = np.sqrt((forces**2).sum(axis=1).max())
+
+                reason = None
+                if slot["policy"] is not None:
+                    reason = slot["policy"].test(
+                        slot["steps"],
+                        res["energy"] / len(atoms),
+                        np.sqrt((atoms.get_forces()**2).sum(axis=1).max())
+                    )
+
+                if fmax < self.tol:
+                    if slot["policy"] is not None:
+                        slot["policy"].finish(atoms)
+                    yield slot["key"], True, atoms, slot["steps"]
+                elif reason is not None:
+                    print(f"{slot['key']}: rejected at step {slot['steps']}, {reason}")
+                    atoms.info["rejected"] = reason
+                    yield slot["key"], False, atoms, slot["steps"]
+                elif slot["steps"] >= self.max_steps or time.time() - slot["start"] > self.time_limit:
+                    print(f"{slot['key']}: not converged after {slot['steps']} steps, fmax {fmax:.2e}")
+                    yield slot["key"], False, atoms, slot["steps"]
+                else:
+                    slot["opt"].step(forces)
+                    slot["steps"] += 1
+                    remaining.append(slot)
+
+            active = remaining
+
+
+def gamma_hessian(struc, session=None, delta=0.01, batch_size=64):
+    """Return the GammaHessian of struc, the displaced structures are evaluated in batches."""
+    hessian = GammaHessian(struc, delta=delta, symmetry_cache=_SYMMETRY_CACHE)
+    displaced = hessian.displacements()
+    if session is not None:
+        results = batch_single_point(displaced, session, batch_size=batch_size, compute_stress=False)
+        forces = [res["forces"] for res in results]
+    else:
+        forces = []
+        for atoms in displaced:
+            atoms.calc = struc.calc
+            forces.append(atoms.get_forces())
+    hessian.assemble(forces)
+
+    return hessian
+
+
+def stability_stage(
+    struc, relax_kwargs, session=None, stats=None, delta=0.01, threshold=0.1, follow=2,
+    amplitude=0.1, batch_size=64
 ):
-    """."""
-    # create the folders
+    """
+    Check the dynamical stability of a relaxed structure and follow its soft modes.
+
+    The modes below -threshold (THz) of the Gamma-point Hessian are imaginary. The structure is
+    then displaced along the softest one (max displacement amplitude, the sign with the lowest
+    energy) and relaxed again without symmetry (stage 3), at most follow times. The result is
+    saved in struc.info["stability"].
+    """
+    good = True
+    attempt = 0
+    while True:
+        t_i = time.time()
+        hessian = gamma_hessian(struc, session, delta=delta, batch_size=batch_size)
+        frequencies, patterns = hessian.modes()
+        soft = np.nonzero(frequencies < -threshold)[0]
+        print(
+            f"Stability: {6 * len(hessian.irreducible)} displacements ({len(hessian.irreducible)}"
+            f" irreducible atoms) in {time.time() - t_i:.3f} s, {len(soft)} imaginary modes,"
+            f" lowest frequencies (THz): {np.round(frequencies[:3], 3).tolist()}"
+        )
+        if len(soft) == 0 or attempt >= follow or not good:
+            break
+
+        attempt += 1
+        pattern = patterns[:, soft[0]].reshape(-1, 3)
+        pattern *= amplitude / np.linalg.norm(pattern, axis=1).max()
+        candidates = [hessian.atoms.copy(), hessian.atoms.copy()]
+        candidates[0].positions += pattern
+        candidates[1].positions -= pattern
+        if session is not None:
+            energies = [res["energy"] for res in batch_single_point(candidates, session, compute_stress=False)]
+        else:
+            energies = []
+            for atoms in candidates:
+                atoms.calc = struc.calc
+                energies.append(atoms.get_potential_energy())
+        print(f"Following the soft mode {frequencies[soft[0]]:.3f} THz, dE = {min(energies) - struc.get_potential_energy():.6f} eV")
+
+        struc.set_constraint()
+        struc.set_positions(candidates[int(np.argmin(energies))].get_positions())
+        try:
+            good, struc = relax_config(
+                struc,
+                stage=3,
+                stats=stats,
+                **dict(relax_kwargs, keep_symmetry=False, symmetry_reduced=False)
+            )
+        except (FunctionTimedOut, RuntimeError) as error:
+            print(f"Re-relaxation along the soft mode failed: {error}")
+            good = False
+
+    struc.info["stability"] = {
+        "stable": bool(len(soft) == 0),
+        "n_imaginary": int(len(soft)),
+        "min_frequency": float(frequencies.min()),
+        "follows": attempt
+    }
+
+    return good, struc
+
+
+def sweep_row(struc, pressure, steps, good):
+    """Return the enthalpy (eV), energy, volume and geometry of struc relaxed at pressure (GPa)."""
+    energy = struc.get_potential_energy()
+    volume = struc.get_volume()
+    return {
+        "pressure": pressure,
+        "enthalpy": float(energy + pressure * GPa * volume),
+        "energy": float(energy),
+        "volume": float(volume),
+        "steps": int(steps),
+        "good": bool(good),
+        "cell": struc.get_cell().array.tolist(),
+        "positions": struc.get_positions().tolist()
+    }
+
+
+def pressure_sweep(struc, relax_kwargs, pressures, warm_start, stats=None, abort_policy=None):
+    """
+    Relax struc (relaxed at pressures[0]) at the next pressures.
+
+    Each relaxation starts from the geometry and the optimizer history (warm_start, filled by
+    the previous relax_config) of the previous pressure. The rows of sweep_row are saved in
+    struc.info["pressure_sweep"], the sweep stops at the first relaxation that fails.
+    """
+    rows = [sweep_row(struc, pressures[0], warm_start.get("steps", 0), True)]
+    good = True
+    for pressure in pressures[1:]:
+        print(f"Pressure sweep: {pressure} GPa")
+        try:
+            good, struc = relax_config(
+                struc,
+                stage=2,
+                abort_policy=abort_policy,
+                stats=stats,
+                **dict(relax_kwargs, applied_P=pressure, warm_start=warm_start)
+            )
+        except FunctionTimedOut:
+            print("Funcition time out")
+            good = False
+        except RuntimeError:
+            print("Run time erro")
+            good = False
+        rows.append(sweep_row(struc, pressure, warm_start.get("steps", 0), good))
+        if not good:
+            break
+
+    print(f"{'P (GPa)':>8s} {'H/atom (eV)':>13s} {'V/atom (A^3)':>13s} {'steps':>6s}")
+    for row in rows:
+        print(
+            f"{row['pressure']:8.3f} {row['enthalpy'] / len(struc):13.6f} {row['volume'] / len(struc):13.4f}"
+            f" {row['steps']:6d}"
+        )
+    struc.info["pressure_sweep"] = rows
+
+    return good, struc
+
+
+def write_sweep(fname, struc, rows, good_fol="completed", format_output="extxyz"):
+    """Write the structure relaxed at each pressure of the sweep, return the rows without geometry."""
+    name = fname.split("/")[-1].split(".")[0]
+    for row in rows:
+        atoms = struc.copy()
+        atoms.set_constraint()
+        atoms.info = {"pressure": row["pressure"], "enthalpy": row["enthalpy"]}
+        atoms.set_cell(row.pop("cell"))
+        atoms.set_positions(row.pop("positions"))
+        atoms.calc = SinglePointCalculator(atoms, energy=row["energy"])
+        if row["good"]:
+            atomic_write(f"{good_fol}/{name}_{row['pressure']:g}GPa.{format_output}", atoms)
+
+    return rows
+
+
+def sweep_table(records, pressures, output="pressure_sweep.csv"):
+    """Print and save the enthalpy per atom of each structure at each pressure of the sweep."""
+    rows = []
+    for record in records:
+        sweep = record.get("pressure_sweep")
+        if sweep is None or record.get("n_atoms") is None:
+            continue
+        enthalpies = {row["pressure"]: row["enthalpy"] / record["n_atoms"] for row in sweep if row["good"]}
+        rows.append([record["file"].split("/")[-1].split(".")[0], record["n_atoms"]] + [
+            enthalpies.get(pressure) for pressure in pressures
+        ])
+
+    print("Enthalpy per atom (eV) vs pressure (GPa):")
+    print(f"{'structure':>24s} {'N':>5s}" + "".join(f" {pressure:>12g}" for pressure in pressures))
+    for row in rows:
+        print(f"{row[0][-24:]:>24s} {row[1]:5d}" + "".join(
+            f" {'-':>12s}" if value is None else f" {value:12.6f}" for value in row[2:]
+        ))
+
+    with open(output, "w") as f:
+        f.write(",".join(["structure", "n_atoms"] + [f"H_{pressure:g}GPa" for pressure in pressures]) + "\n")
+        for row in rows:
+            f.write(",".join("" if value is None else str(value) for value in row) + "\n")
+    print(f"Enthalpies saved in {output}")
+
+
+def relax_state(struc, good):
+    """Return the manifest state and the reason of rejection of a finished structure."""
+    reason = struc.info.get("rejected")
+    if reason is not None:
+        return "rejected", reason
+
+    return ("done" if good else "fail"), None
+
+
+def write_relaxed(
+    fname, struc, good, good_fol="completed", bad_fol="fail", input_fol="input", format_output="extxyz",
+    move_input=False, rejected_fol="rejected"
+):
+    """Write the final structure to the relavent folder and return its name."""
+    rejected = "rejected" in struc.info
+    struc.info = {}
+
+    if rejected:
+        output_fol = rejected_fol
+        os.makedirs(output_fol, exist_ok=True)
+    elif good:
+        output_fol = good_fol
+    else:
+        output_fol = bad_fol
+
+    outfile = fname.split("/")[-1].split(".")[0] + "." + format_output
+    outname = output_fol + "/" + outfile
+    print(f"writing final struc to {outname}")
+
+    atomic_write(outname, struc)
+    if move_input and os.path.isfile(fname):
+        print("using shutil to move with", fname, input_fol)
+        shutil.move(fname, input_fol)
+
+    return outname
+
+
+def write_cached(
+    fname, key, cache, only_sp=False, good_fol="completed", bad_fol="fail", input_fol="input",
+    format_output="extxyz", move_input=False, manifest=None, writer=None
+):
+    """Write the result of fname if key is in the cache, returns True if it was found."""
+    cached = cache.get(key)
+    if cached is None:
+        return False
+
+    struc, fields = cached
+    print(f"{fname}: result found in the cache {cache.path} (computed for {fields.get('fname')})")
+
+    def output():
+        if only_sp:
+            outname = good_fol + "/" + fname.split("/")[-1].split(".")[0] + "_sp.extxyz"
+            atomic_write(outname, struc)
+        else:
+            outname = write_relaxed(fname, struc, True, good_fol, bad_fol, input_fol, format_output, move_input)
+
+        if manifest is not None:
+            manifest.finish(fname, "done", output=outname, wall_time=0.0, n_atoms=len(struc), cached=True)
+
+    run_output(writer, output)
+
+    return True
+
+
+def relax_files_batched(
+    files, session, relax_arg_dict, batch_size=32, good_fol="completed", bad_fol="fail",
+    input_fol="input", format_output="extxyz", double_relax=False, manifest=None, move_inputs=False,
+    cache=None, scheduler=None, writer=None, prefetch=0
+):
+    """
+    Relax a list of files with BatchRelaxer, same stages as relax_fname.
+
+    With "mixed_fmax" in relax_arg_dict a float32 BatchRelaxer pre-relaxes the structures. With D3
+    in "final" mode only the last stage uses it, as in relax_structure. With "stability" each
+    relaxed structure goes through stability_stage. The files are read prefetch ahead and the
+    outputs written by writer, as in relax_fname.
+    """
     for fol in [good_fol, bad_fol, input_fol]:
         if not os.path.isdir(fol):
             try:
@@ -245,66 +1690,242 @@ def relax_fname(
             except FileExistsError:
                 pass
 
-    print("File name: {}".format(fname))
-    print("="*60)
-    # if model_file is not None:
-    #     calculator = MACECalculator(model_paths=model_file, device=device, default_dtype="float64")
-    # else:
-    #     calculator = mace_mp(
-    #         model="medium",
-    #         dispersion=False,
-    #         default_dtype="float64",
-    #         device=device
-    #     )
-
-    # print(help(MACECalculator))
-    calculator = mace_mp(model="medium", dispersion=True, default_dtype="float64", device=device)
-
-    good_read = False
-    if os.path.isfile(fname):
-        input_struc = ase.io.read(fname)
-        good_read = True
-
-    if not good_read:
-        print(f"failed to read {fname}")
-        return False
+    relax_kwargs = {
+        "tol": 1e-4,
+        "applied_P": 0.1,
+        "keep_symmetry": True,
+        "relax_cell": True
+    }
 
-    struc = copy.deepcopy(input_struc)
-    struc.calc = calculator
+    start_times = {}
+    keys = {}
 
-    if only_sp:
+    def read_files():
+        for fname, struc in PrefetchReader(files, prefetch):
+            try:
+                if struc is None:
+                    struc = ase.io.read(fname)
+            except Exception:
+                print(f"failed to read {fname}")
+                if manifest is not None:
+                    manifest.finish(fname, "fail", error="read")
+                continue
+            if cache is not None:
+                keys[fname] = cache.key(struc)
+                if write_cached(
+                    fname, keys[fname], cache, False, good_fol, bad_fol, input_fol, format_output,
+                    move_inputs, manifest, writer
+                ):
+                    continue
+            start_times[fname] = time.time()
+            if manifest is not None:
+                manifest.start(fname, **size_fields(struc))
+            yield fname, struc
+
+    def output(fname, struc, good, state, fields):
+        outname = write_relaxed(
+            fname, struc, good, good_fol, bad_fol, input_fol, format_output, move_inputs
+        )
+        if manifest is not None:
+            manifest.finish(fname, state, output=outname, **fields)
+
+    def finish(fname, struc, good):
+        state, reason = relax_state(struc, good)
+        stability = struc.info.pop("stability", None)
+        if cache is not None and state == "done":
+            cache.put(keys[fname], struc, fname=fname)
+        fields = dict(
+            wall_time=time.time() - start_times.pop(fname),
+            reason=reason,
+            stability=stability
+        )
+        run_output(writer, output, fname, struc if writer is None else snapshot(struc), good, state, fields)
+
+    relax_arg_dict = dict(relax_arg_dict)
+    mixed_fmax = relax_arg_dict.pop("mixed_fmax", None)
+    stability = relax_arg_dict.pop("stability", None)
+    relax_kwargs["method"] = relax_arg_dict.get("method", "lbfgs")
+    relax_kwargs["symmetry_reduced"] = relax_arg_dict.get("symmetry_reduced", False)
+    final_d3 = session.dispersion_mode == "final"
+    pre_relax = mixed_fmax is not None or (final_d3 and not double_relax)
+    if pre_relax:
+        pre_kwargs = dict(relax_kwargs) if double_relax else dict(relax_kwargs, **relax_arg_dict)
+        pre_session = session
+        if mixed_fmax is not None:
+            pre_kwargs["tol"] = mixed_fmax
+            pre_session = session.low_precision()
+        stage_0 = BatchRelaxer(pre_session, batch_size=batch_size, dispersion=not final_d3, **pre_kwargs)
+    if double_relax:
+        stage_1 = BatchRelaxer(session, batch_size=batch_size, dispersion=not final_d3, **relax_kwargs)
+        relax_arg_dict = dict(
+            relax_arg_dict, keep_symmetry=False, symmetry_reduced=False, relax_cell=True
+        )
+    relax_kwargs.update(relax_arg_dict)
+    stage_2 = BatchRelaxer(session, batch_size=batch_size, **relax_kwargs)
+
+    def stage_0_filter():
+        # Not converged pre-relaxations are also polished, only rejected ones are written.
+        for fname, good, struc, steps in stage_0.run(read_files()):
+            print(f"{fname}: {steps} pre-relaxation steps")
+            if "rejected" in struc.info:
+                finish(fname, struc, False)
+            else:
+                yield fname, struc
+
+    def stage_1_filter(items):
+        # Structures that fail the first stage are written directly.
+        for fname, good, struc, steps in stage_1.run(items):
+            if good:
+                yield fname, struc
+            else:
+                finish(fname, struc, False)
+
+    items = stage_0_filter() if pre_relax else read_files()
+    if double_relax:
+        items = stage_1_filter(items)
+
+    total_files = len(files)
+    count = 0
+    start_time = time.time()
+    for fname, good, struc, steps in stage_2.run(items):
+        count += 1
+        if good and stability is not None:
+            # The displaced structures of each candidate are evaluated in batches.
+            session.attach(struc)
+            good, struc = stability_stage(struc, relax_kwargs, session=session, **stability)
         E = struc.get_potential_energy()
-        print("E (eV) is", E, "----", "E/atom", E / len(struc))
-        output_fol = good_fol
-        outfile = fname.split("/")[-1].split(".")[0] + "_sp.extxyz"
-        outname = output_fol + "/" + outfile
-        ase.io.write(outname, struc)
-        print(f"writing final struc to {outname}")
-
-        return
-
+        print(f"{fname}: good = {good}, {steps} steps, E (eV) is {E} ---- E/atom {E / len(struc)}")
+        finish(fname, struc, good)
+        print(f"File number: {count}/{total_files} - {time.time() - start_time:.3f} s elapsed")
+        if scheduler is not None:
+            # The structures of a batch share the steps, only the order is used here.
+            scheduler.finish(fname)
+            print(scheduler.report())
+
+
+def relax_structure(
+    struc, relax_arg_dict, double_relax=False, checkpoint=None, session=None, stats=None,
+    profiler=None
+):
+    """
+    Run the relaxation stages of a structure that already has its calculator.
+
+    If checkpoint has a saved relaxation, the structure continues from it. RelaxationSuspended is
+    raised when the time limit stops a relaxation that has a checkpoint, RelaxationRejected when
+    the abort_policy of relax_arg_dict stops it.
+
+    With "mixed_fmax" in relax_arg_dict, a stage 0 relaxes the structure with the float32 model of
+    session until fmax < mixed_fmax, the next stages use the calculator of session. If the D3 of
+    session is in "final" mode only the last stage uses it (a stage 0 without D3 is added when it
+    is the only one). The steps and time of each stage are appended to the stats list, profiler
+    records the steps of all the stages. With "pressures" the relaxed structure goes through
+    pressure_sweep. With "stability" (stability_stage arguments) the relaxed structure is checked
+    with its Gamma-point Hessian.
+    """
     relax_kwargs = {
         "tol": 1e-4,
         "applied_P": 0.1,
         "keep_symmetry": True,
         "relax_cell": True
     }
+    relax_arg_dict = dict(relax_arg_dict)
+    mixed_fmax = relax_arg_dict.pop("mixed_fmax", None)
+    abort_policy = relax_arg_dict.pop("abort_policy", None)
+    stability = relax_arg_dict.pop("stability", None)
+    pressures = relax_arg_dict.pop("pressures", None)
+    warm_start = None
+    if pressures is not None:
+        # The last stage at the first pressure gives its history to the next pressures.
+        warm_start = {}
+        relax_arg_dict["applied_P"] = pressures[0]
+    # All the stages use the same optimizer and way of keeping the symmetry.
+    relax_kwargs["method"] = relax_arg_dict.get("method", "lbfgs")
+    relax_kwargs["symmetry_reduced"] = relax_arg_dict.get("symmetry_reduced", False)
+    final_d3 = False
+    if session is None:
+        mixed_fmax = None
+    else:
+        final_d3 = session.dispersion_mode == "final"
+
+    def label(stage, dtype, d3):
+        # relax_config appends the stats of the stages that finish.
+        if stats is not None and len(stats) > 0 and stats[-1]["stage"] == stage:
+            dispersion_mode = session.dispersion_mode if session is not None else "none"
+            stats[-1]["dtype"] = dtype
+            stats[-1]["d3"] = "full" if d3 and dispersion_mode == "final" else (dispersion_mode if d3 else "none")
+
+    pre_relax = mixed_fmax is not None or (final_d3 and not double_relax)
+    start_stage = 0 if pre_relax else 1
+    if checkpoint is not None and checkpoint.exists():
+        saved = checkpoint.read_atoms()
+        struc.set_cell(saved.get_cell())
+        struc.set_positions(saved.get_positions())
+        start_stage = checkpoint.stage()
+        print(f"Continue from {checkpoint.geometry_file} (stage {start_stage})")
+
+    if pre_relax and start_stage == 0:
+        # Pre-relaxation with the settings of the first stage, in float32 with a loose tolerance
+        # and/or without D3. Its result is polished by the next stages in any case.
+        pre_kwargs = dict(relax_kwargs) if double_relax else dict(relax_kwargs, **relax_arg_dict)
+        pre_session = session
+        if mixed_fmax is not None:
+            pre_kwargs["tol"] = mixed_fmax
+            pre_session = session.low_precision()
+        pre_session.attach(struc, dispersion=not final_d3)
+        try:
+            relax_config(
+                struc,
+                checkpoint=checkpoint,
+                stage=0,
+                abort_policy=abort_policy,
+                stats=stats,
+                profiler=profiler,
+                **pre_kwargs
+            )
+        except FunctionTimedOut:
+            print("Funcition time out")
+            if checkpoint is not None and checkpoint.exists():
+                raise RelaxationSuspended(checkpoint.geometry_file)
+        except RuntimeError:
+            print("Run time erro")
+        label(0, pre_session.default_dtype, not final_d3)
+
+        struc.set_constraint()
+        session.attach(struc)
+        print(f"Switching to {session.default_dtype}, D3 {session.dispersion_mode}")
 
     good_1 = True
-    if double_relax:
+    if double_relax and start_stage <= 1:
         good_1 = False
+        if final_d3:
+            session.attach(struc, dispersion=False)
         try:
-            good_1, struc = relax_config(struc, **relax_kwargs)
+            good_1, struc = relax_config(
+                struc,
+                checkpoint=checkpoint,
+                stage=1,
+                abort_policy=abort_policy,
+                stats=stats,
+                profiler=profiler,
+                **relax_kwargs
+            )
         except FunctionTimedOut:
             good_1 = False
             # struc = input_struc
             print("Funcition time out")
+            if checkpoint is not None and checkpoint.exists():
+                raise RelaxationSuspended(checkpoint.geometry_file)
         except RuntimeError:
             good_1 = False
             # struc = input_struc
             print("Run time erro")
         print(f"good = {good_1} and struc is {struc}")
+        if session is not None:
+            label(1, session.default_dtype, not final_d3)
+
+    if double_relax:
         relax_arg_dict["keep_symmetry"] = False
+        relax_arg_dict["symmetry_reduced"] = False
         relax_arg_dict["relax_cell"] = True
 
     good = False
@@ -312,42 +1933,521 @@ def relax_fname(
         # TESTING
         # Second optimization, Very tight
         relax_kwargs.update(relax_arg_dict)
+        if final_d3:
+            session.attach(struc)
+        if warm_start is not None:
+            relax_kwargs["warm_start"] = warm_start
 
         try:
             # good, struc = relax_config(struc, **relax_arg_dict)
-            good, struc = relax_config(struc, **relax_kwargs)
+            good, struc = relax_config(
+                struc,
+                checkpoint=checkpoint,
+                stage=2,
+                abort_policy=abort_policy,
+                stats=stats,
+                profiler=profiler,
+                **relax_kwargs
+            )
         except FunctionTimedOut:
             good = False
             # struc = input_struc
             print("Funcition time out")
+            if checkpoint is not None and checkpoint.exists():
+                raise RelaxationSuspended(checkpoint.geometry_file)
         except RuntimeError:
             good = False
             # struc = input_struc
             print("Run time erro")
+        if session is not None:
+            label(2, session.default_dtype, True)
+
+    if good and pressures is not None:
+        good, struc = pressure_sweep(
+            struc, relax_kwargs, pressures, relax_kwargs.pop("warm_start"), stats=stats,
+            abort_policy=abort_policy
+        )
+
+    if good and stability is not None:
+        good, struc = stability_stage(struc, relax_kwargs, session=session, stats=stats, **stability)
+        if session is not None:
+            label(3, session.default_dtype, True)
 
     print(f"good = {good} and struc is {struc}")
+    if stats is not None and len(stats) > 0:
+        print_stages(stats)
+
+    return good, struc
+
+
+def print_stages(stats):
+    """Print the steps, time, precision and D3 mode of the relaxation stages."""
+    print(
+        f"{'stage':>5s} {'dtype':>8s} {'D3':>8s} {'steps':>6s} {'time (s)':>9s} {'fmax':>9s}"
+        f" {'E (eV)':>16s}"
+    )
+    for stage in stats:
+        print(
+            f"{stage['stage']:5d} {stage.get('dtype', '-'):>8s} {stage.get('d3', '-'):>8s}"
+            f" {stage['steps']:6d} {stage['time']:9.3f} {stage['fmax']:9.2e} {stage['energy']:16.8f}"
+        )
+
+
+def memory_fields(peak, session, atoms):
+    """Return the peak memory (bytes) of the structure atoms and its estimated edges, for the manifest."""
+    volume = atoms.get_volume() if atoms.cell.rank == 3 else None
+    fields = {
+        "peak_rss": peak.peak(),
+        "n_edges": int(estimate_edges(len(atoms), volume, session.mace_calc.r_max)),
+        "dtype": session.default_dtype
+    }
+    message = f"Peak memory: {fields['peak_rss'] / 2**20:.0f} MB RSS"
+    if session.device == "cuda":
+        fields["peak_gpu"] = torch.cuda.max_memory_allocated()
+        message += f", {fields['peak_gpu'] / 2**20:.0f} MB GPU"
+    print(message + f" ({fields['n_edges']} edges)")
+
+    return fields
+
+
+def start_memory(session):
+    """Reset the peak memory of the process (and of the GPU) before a structure."""
+    peak = PeakMemory()
+    peak.start()
+    if session.device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+
+    return peak
+
+
+def memory_budget(args):
+    """Return the memory budget of the run in bytes, 0 if the guard is disabled."""
+    if args["memory_budget"] is not None:
+        return args["memory_budget"] * 2**30
+
+    if args["use_gpu"] and torch.cuda.is_available():
+        return 0.9 * torch.cuda.mem_get_info()[0]
+
+    return 0.8 * available_memory()
+
+
+def relax_fname(
+    fname, session, relax_arg_dict, good_fol="completed", bad_fol="fail", input_fol="input",
+    only_sp=False, format_output="extxyz", double_relax=False, manifest=None, move_input=False,
+    checkpoint_interval=20, cache=None, profile=None, input_struc=None, writer=None
+):
+    """
+    Relax the structure in fname using the calculator of the MACESession (profile: StepProfiler folder).
+
+    input_struc is the structure of fname if it was already read (PrefetchReader), with an
+    AsyncWriter the outputs and the manifest update are done in its thread.
+    """
+    # create the folders
+    for fol in [good_fol, bad_fol, input_fol]:
+        if not os.path.isdir(fol):
+            try:
+                os.mkdir(fol)
+            except FileExistsError:
+                pass
+
+    print("File name: {}".format(fname))
+    print("="*60)
+
+    good_read = input_struc is not None
+    if not good_read and os.path.isfile(fname):
+        input_struc = ase.io.read(fname)
+        good_read = True
+
+    if not good_read:
+        print(f"failed to read {fname}")
+        if manifest is not None:
+            manifest.finish(fname, "fail", error="read")
+        return False
+
+    key = None
+    if cache is not None:
+        key = cache.key(input_struc)
+        if write_cached(
+            fname, key, cache, only_sp, good_fol, bad_fol, input_fol, format_output, move_input, manifest,
+            writer
+        ):
+            return
+
+    start_time = time.time()
+    if manifest is not None:
+        manifest.start(fname, **size_fields(input_struc))
+
+    struc = copy.deepcopy(input_struc)
+    session.attach(struc)
+    peak = start_memory(session)
+
+    if only_sp:
+        E = struc.get_potential_energy()
+        print("E (eV) is", E, "----", "E/atom", E / len(struc))
+        output_fol = good_fol
+        outfile = fname.split("/")[-1].split(".")[0] + "_sp.extxyz"
+        outname = output_fol + "/" + outfile
+        if cache is not None:
+            cache.put(key, struc, fname=fname)
+        fields = dict(wall_time=time.time() - start_time, **memory_fields(peak, session, input_struc))
+
+        def output_sp(struc):
+            atomic_write(outname, struc)
+            print(f"writing final struc to {outname}")
+            if manifest is not None:
+                manifest.finish(fname, "done", output=outname, **fields)
+
+        # The session calculator is reused by the next structure, its results are copied.
+        run_output(writer, output_sp, struc if writer is None else snapshot(struc))
+
+        return
+
+    checkpoint = None
+    if checkpoint_interval > 0:
+        checkpoint = RelaxCheckpoint(fname.split("/")[-1].split(".")[0], interval=checkpoint_interval)
+
+    profiler = None
+    if profile is not None:
+        profiler = StepProfiler(fname.split("/")[-1].split(".")[0], folder=profile)
+
+    stats = []
+    try:
+        good, struc = relax_structure(
+            struc, relax_arg_dict,
+            double_relax=double_relax,
+            checkpoint=checkpoint,
+            session=session,
+            stats=stats,
+            profiler=profiler
+        )
+    except RelaxationSuspended:
+        if profiler is not None:
+            profiler.save()
+        print(f"Relaxation suspended, it will continue from {checkpoint.geometry_file}")
+        if manifest is not None:
+            manifest.update(
+                fname, state="suspended",
+                checkpoint=checkpoint.state_file,
+                wall_time=time.time() - start_time
+            )
+        return
+    except RelaxationRejected as error:
+        good = False
+        struc.info["rejected"] = str(error)
+
+    if checkpoint is not None:
+        checkpoint.clear()
+    if profiler is not None:
+        print(f"Step profile written to {profiler.save()}")
+
     E = struc.get_potential_energy()
     print("E (eV) is", E, "----", "E/atom", E / len(struc))
-    struc.info = {}
 
-    # write final structure to relavent folder
-    if good:
-        output_fol = good_fol
-    else:
-        output_fol = bad_fol
+    state, reason = relax_state(struc, good)
+    stability = struc.info.pop("stability", None)
+    sweep = struc.info.pop("pressure_sweep", None)
+    if cache is not None and state == "done":
+        cache.put(key, struc, fname=fname)
+    fields = dict(
+        wall_time=time.time() - start_time,
+        n_atoms=len(struc),
+        reason=reason,
+        stages=stats,
+        stability=stability,
+        **memory_fields(peak, session, input_struc)
+    )
 
-    outfile = fname.split("/")[-1].split(".")[0] + "." + format_output
-    outname = output_fol + "/" + outfile
-    print(f"writing final struc to {outname}")
+    def output(struc, sweep):
+        if sweep is not None:
+            sweep = write_sweep(fname, struc, sweep, good_fol, format_output)
+        outname = write_relaxed(fname, struc, good, good_fol, bad_fol, input_fol, format_output, move_input)
+        if manifest is not None:
+            manifest.finish(fname, state, output=outname, pressure_sweep=sweep, **fields)
 
-    ase.io.write(outname, struc)
-    if os.path.isfile(fname):
-        print("using shutil to move with", fname, input_fol)
-        shutil.move(fname, input_fol)
+    run_output(writer, output, struc if writer is None else snapshot(struc), sweep)
 
     return
 
 
+# MACESession, AbortPolicy and StartJournal queue of a worker process, set by init_worker.
+_WORKER_SESSION = None
+_WORKER_POLICY = None
+_WORKER_STARTED = None
+
+
+def init_worker(
+    session_kwargs, n_threads, cores_queue, abort_policy=None, symmetry_cache=None, started_queue=None
+):
+    """Pin the worker to its cores, set the torch threads and load the model once."""
+    global _WORKER_SESSION, _WORKER_POLICY, _WORKER_STARTED
+
+    try:
+        cores = cores_queue.get_nowait()
+        os.sched_setaffinity(0, cores)
+    except Exception:
+        # A worker restarted by the pool keeps the affinity of the parent.
+        cores = sorted(os.sched_getaffinity(0))
+
+    torch.set_num_threads(n_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+    print(f"Worker {os.getpid()} on cores {cores} with {n_threads} torch threads")
+    _WORKER_SESSION = MACESession(**session_kwargs)
+    # Each worker keeps its own best energies.
+    _WORKER_POLICY = abort_policy
+    _WORKER_STARTED = started_queue
+    open_symmetry_cache(symmetry_cache)
+
+
+def worker_task(
+    fname, relax_arg_dict, only_sp=False, double_relax=False, checkpoint_interval=20, profile=None
+):
+    """
+    Relax (or single point) a file in a worker process.
+
+    Nothing is written here, the structure is returned to the main process with the results in
+    a SinglePointCalculator. Only the step profile (profile folder) is written by the worker.
+    """
+    start_time = time.time()
+    try:
+        struc = ase.io.read(fname)
+    except Exception:
+        print(f"failed to read {fname}")
+        struc = None
+    if _WORKER_STARTED is not None:
+        _WORKER_STARTED.put((fname, None if struc is None else size_fields(struc)))
+    if struc is None:
+        return fname, None, None, time.time() - start_time
+
+    input_struc = struc.copy()
+    _WORKER_SESSION.attach(struc)
+    peak = start_memory(_WORKER_SESSION)
+    if only_sp:
+        good = True
+        struc.get_potential_energy()
+    else:
+        checkpoint = None
+        if checkpoint_interval > 0:
+            checkpoint = RelaxCheckpoint(fname.split("/")[-1].split(".")[0], interval=checkpoint_interval)
+        if _WORKER_POLICY is not None:
+            relax_arg_dict = dict(relax_arg_dict, abort_policy=_WORKER_POLICY)
+        profiler = None
+        if profile is not None:
+            profiler = StepProfiler(fname.split("/")[-1].split(".")[0], folder=profile)
+        stats = []
+        try:
+            good, struc = relax_structure(
+                struc, relax_arg_dict,
+                double_relax=double_relax,
+                checkpoint=checkpoint,
+                session=_WORKER_SESSION,
+                stats=stats,
+                profiler=profiler
+            )
+        except RelaxationSuspended:
+            if profiler is not None:
+                profiler.save()
+            return fname, "suspended", None, time.time() - start_time
+        except RelaxationRejected as error:
+            good = False
+            struc.info["rejected"] = str(error)
+        except Exception as error:
+            print(f"{fname} failed: {error}")
+            good = False
+        if checkpoint is not None:
+            checkpoint.clear()
+        if profiler is not None:
+            profiler.save()
+        struc.info["stages"] = stats
+
+    # Only the results computed for struc itself, the session calculator may hold another structure.
+    results = {}
+    if struc.calc is not None and not struc.calc.check_state(struc):
+        results = {
+            prop: value for prop, value in struc.calc.results.items()
+            if prop in ["energy", "free_energy", "forces", "stress"]
+        }
+    if "energy" not in results:
+        print(f"{fname}: no energy computed for the final structure")
+        good = False
+    struc.calc = SinglePointCalculator(struc, **results)
+    # FixSymmetry is not needed after the relaxation.
+    struc.set_constraint()
+    struc.info["memory"] = memory_fields(peak, _WORKER_SESSION, input_struc)
+
+    return fname, good, struc, time.time() - start_time
+
+
+def run_pool(
+    files, session_kwargs, relax_arg_dict, n_workers, n_threads=None, only_sp=False,
+    double_relax=False, format_output="extxyz", good_fol="completed", bad_fol="fail",
+    input_fol="input", manifest=None, move_inputs=False, checkpoint_interval=20, abort_policy=None,
+    cache=None, scheduler=None, profile=None, symmetry_cache=None, writer=None, prefetch=0
+):
+    """
+    Run the files in a pool of n_workers processes with n_threads torch threads each.
+
+    Each worker builds its MACESession with session_kwargs. The results come back through the
+    result queue of the pool and are written here (in the thread of writer if it is given), the
+    cache is only used by this process and its keys are computed on the files read prefetch ahead
+    (the workers open the symmetry cache file themselves). The tasks are dispatched one by one in
+    the order of files, scheduler reports the remaining time.
+    """
+    for fol in [good_fol, bad_fol, input_fol]:
+        if not os.path.isdir(fol):
+            try:
+                os.mkdir(fol)
+            except FileExistsError:
+                pass
+
+    if n_threads is None:
+        n_threads = max(1, len(os.sched_getaffinity(0)) // n_workers)
+    print(f"Pool layout: {n_workers} workers x {n_threads} threads")
+
+    # spawn avoids forking the torch/OpenMP state of the main process.
+    ctx = multiprocessing.get_context("spawn")
+    cores_queue = ctx.Queue()
+    for cores in split_cores(n_workers, n_threads):
+        cores_queue.put(cores)
+
+    keys = {}
+    if cache is not None:
+        pending = []
+        for fname, atoms in PrefetchReader(files, prefetch):
+            try:
+                keys[fname] = cache.key(atoms if atoms is not None else ase.io.read(fname))
+            except Exception:
+                # The worker reports the file.
+                pending.append(fname)
+                continue
+            if not write_cached(
+                fname, keys[fname], cache, only_sp, good_fol, bad_fol, input_fol, format_output,
+                move_inputs, manifest, writer
+            ):
+                pending.append(fname)
+            elif scheduler is not None:
+                scheduler.finish(fname)
+        files = pending
+
+    tasks = [
+        (fname, relax_arg_dict, only_sp, double_relax, checkpoint_interval, profile) for fname in files
+    ]
+    # The files are marked running when a worker takes them.
+    journal = StartJournal(manifest, ctx) if manifest is not None else None
+    total_files = len(files)
+    count = 0
+    with ctx.Pool(
+        processes=n_workers,
+        initializer=init_worker,
+        initargs=(
+            session_kwargs, n_threads, cores_queue, abort_policy, symmetry_cache,
+            journal.queue if journal is not None else None
+        )
+    ) as pool:
+        for fname, good, struc, execution_time in pool.imap_unordered(_worker_task_star, tasks, chunksize=1):
+            count += 1
+            if journal is not None:
+                journal.wait(fname)
+            if scheduler is not None:
+                scheduler.finish(fname, execution_time)
+            if good == "suspended":
+                print(f"{fname}: relaxation suspended, it will continue from its checkpoint")
+                if manifest is not None:
+                    manifest.update(fname, state="suspended", wall_time=execution_time)
+                continue
+
+            if struc is None:
+                if manifest is not None:
+                    manifest.finish(fname, "fail", error="read")
+                continue
+
+            E = struc.calc.results.get("energy")
+            if E is None:
+                print(f"{fname}: good = {good}, no energy")
+            else:
+                print(f"{fname}: good = {good}, E (eV) is {E} ---- E/atom {E / len(struc)}")
+            state, reason = relax_state(struc, good)
+            stages = struc.info.pop("stages", None)
+            stability = struc.info.pop("stability", None)
+            memory = struc.info.pop("memory", {})
+            sweep = struc.info.pop("pressure_sweep", None)
+            if cache is not None and state == "done" and fname in keys:
+                cache.put(keys[fname], struc, fname=fname)
+
+            def output(fname, struc, good, state, fields, sweep):
+                if sweep is not None:
+                    sweep = write_sweep(fname, struc, sweep, good_fol, format_output)
+                if only_sp:
+                    struc.info = {}
+                    outname = good_fol + "/" + fname.split("/")[-1].split(".")[0] + "_sp.extxyz"
+                    atomic_write(outname, struc)
+                    print(f"writing final struc to {outname}")
+                else:
+                    outname = write_relaxed(
+                        fname, struc, good, good_fol, bad_fol, input_fol, format_output, move_inputs
+                    )
+
+                if manifest is not None:
+                    manifest.finish(fname, state, output=outname, pressure_sweep=sweep, **fields)
+
+            fields = dict(
+                wall_time=execution_time,
+                n_atoms=len(struc),
+                reason=reason,
+                stages=stages,
+                stability=stability,
+                **memory
+            )
+            run_output(writer, output, fname, struc, good, state, fields, sweep)
+
+            print("="*60)
+            print(f"File number: {count}/{total_files} - done in {execution_time:.3f} s")
+            if scheduler is not None:
+                print(scheduler.report())
+            print("="*60)
+    if journal is not None:
+        journal.close()
+
+
+def _worker_task_star(args):
+    return worker_task(*args)
+
+
+def result_settings(args):
+    """Return the settings that change the results, they are part of the result cache keys."""
+    model_file = args["model_file"]
+    settings = {
+        "code": "MACE",
+        "model": model_file if not os.path.isfile(model_file) else file_hash(model_file),
+        "dispersion": args["dispersion"],
+        "single_point": args["single_point"]
+    }
+    if args["dispersion"]:
+        # final ends with the full D3, its results are the same as full.
+        settings["dispersion_mode"] = "reduced" if args["dispersion_mode"] == "reduced" else "full"
+        if args["dispersion_mode"] == "reduced":
+            settings["d3_cutoff"] = args["d3_cutoff"]
+    if not args["single_point"]:
+        settings.update({
+            "tolerance": float(args["tolerance"]),
+            "pressure": args["pressure"] if args["pressures"] is None else args["pressures"],
+            "keep_symmetry": args["keep_symmetry"],
+            "relax_cell": args["relax_cell"],
+            "double_relax": args["double_relax"],
+            "optimizer": args["optimizer"],
+            "symmetry_reduced": args["symmetry_reduced"]
+        })
+        if args["stability_check"]:
+            settings["stability"] = [
+                args["stability_delta"], args["stability_threshold"], args["stability_follow"]
+            ]
+
+    return settings
+
+
 def main():
     """Run main function."""
     print(TITLE)
@@ -364,39 +2464,116 @@ def main():
     files += glob.glob("*.extxyz")
 
     assert len(files) != 0, "Files not found"
-    """
-    NOTE:
-    CAN PUT PATH TO MODEL FILE HERE IF YOU HAVE IT
-    """
-    # model_file = "/home/ovillegas/Documents/test_MACE_vs_MProject/2023-12-03-mace-128-L1_epoch-199.model"
-    model_file = "/home/ovillegas/Documents/test_MACE_vs_MProject/2024-01-07-mace-128-L2_epoch-199.model"
-    if not os.path.isfile(model_file):
+    model_file = args["model_file"]
+    if model_file not in ["small", "medium", "large"] and not os.path.isfile(model_file):
         print("Model file not found")
         exit()
 
-    # model_file = None
-    if model_file is not None:
-        print(f"model_file is {model_file}")
+    print(f"model_file is {model_file}")
 
     relax_kwargs = {
         "tol": args["tolerance"],
         "applied_P": args["pressure"],
         "keep_symmetry": args["keep_symmetry"],
-        "relax_cell": args["relax_cell"]
+        "relax_cell": args["relax_cell"],
+        "method": args["optimizer"],
+        "symmetry_reduced": args["symmetry_reduced"]
     }
+    print("Optimizer:", args["optimizer"])
+    if args["batch_relax"] > 1 and args["optimizer"] not in BatchRelaxer.METHODS:
+        print(f"The batched relaxation supports only {', '.join(BatchRelaxer.METHODS)}")
+        exit()
+    if args["pressures"] is not None:
+        if args["batch_relax"] > 1:
+            print("The pressure sweep is not available with the batched relaxation")
+            exit()
+        relax_kwargs["applied_P"] = args["pressures"][0]
+        relax_kwargs["pressures"] = args["pressures"]
+        print("Pressure sweep (GPa):", ", ".join(f"{pressure:g}" for pressure in args["pressures"]))
+    if args["stability_check"]:
+        relax_kwargs["stability"] = {
+            "delta": args["stability_delta"],
+            "threshold": args["stability_threshold"],
+            "follow": args["stability_follow"]
+        }
+        print(f"Stability check: imaginary modes below -{args['stability_threshold']} THz")
+    if args["mixed_precision"] is not None:
+        relax_kwargs["mixed_fmax"] = args["mixed_precision"]
+        print(f"Mixed precision: float32 until fmax < {args['mixed_precision']:.2e}, then float64")
+
+    abort_policy = build_abort_policy(
+        args["abort_energy"],
+        args["abort_stagnation"],
+        min_steps=args["abort_min_steps"]
+    )
+    if abort_policy is not None:
+        print("Early abort policy:", type(abort_policy).__name__)
 
     format_output = args["format_output"]
 
     is_singlepoint = args["single_point"]
     print("Is single point?:", is_singlepoint)
 
-    if len(files) > 0:
-        random.shuffle(files)
-        # Used for a CPUs set up:
-        # with Pool(args.nc) as pool:
-        #     items = [(fname, model_file, relax_kwargs) for fname in files_res]
-        #     pool.starmap(relax_fname,  items)
+    # Files already finished in a previous run are skipped.
+    manifest = CampaignManifest(args["manifest"])
+    files = manifest.pending(files)
+
+    cache = None
+    if args["cache"] is not None:
+        cache = ResultCache(
+            args["cache"],
+            settings=result_settings(args),
+            max_entries=args["cache_max_entries"],
+            max_age=args["cache_max_age"]
+        )
+        print(f"Result cache {args['cache']}: {len(cache)} entries")
+
+    symmetry_cache = None
+    if args["nc"] == 1:
+        symmetry_cache = open_symmetry_cache(args["symmetry_cache"])
+        if symmetry_cache.path is not None:
+            print(f"Symmetry cache {symmetry_cache.path}: {len(symmetry_cache)} datasets")
+
+    # Outputs, moves of the inputs and manifest updates are done in a background thread.
+    writer = AsyncWriter(max_pending=4 * args["prefetch"]) if args["prefetch"] > 0 else None
 
+    if len(files) > 0:
+        sizes = file_sizes(files, manifest=manifest)
+
+        # Structures too large for a worker are run alone in float32 at the end, or deferred.
+        low_memory = []
+        budget = memory_budget(args)
+        if budget > 0:
+            memory_model = MemoryModel.from_manifests(
+                args["history"],
+                records=manifest.records.values(),
+                key="peak_gpu" if args["use_gpu"] and torch.cuda.is_available() else "peak_rss"
+            )
+            files, low_memory, deferred, estimates = memory_model.plan(
+                sizes, files, budget / args["nc"], budget
+            )
+            print(
+                f"Memory budget {budget / 2**30:.1f} GB for {args['nc']} workers"
+                f" (model fitted on {memory_model.n_records} records)"
+            )
+            for fname in low_memory:
+                print(f"{fname}: {estimates[fname] / 2**30:.1f} GB expected, relaxed alone in float32 at the end")
+            for fname in deferred:
+                print(f"{fname}: {estimates[fname] / 2**30:.1f} GB expected, deferred")
+                manifest.update(fname, state="deferred", memory_estimate=estimates[fname])
+
+        # Longest expected first, a large cell never starts at the end of the allocation. The
+        # remaining time is predicted with the nc workers and the low memory files run alone.
+        layouts = None
+        if len(low_memory) > 0:
+            layouts = [(args["nc"], args["nt"], files), (1, args["nt"], low_memory)]
+        cost_model = CostModel.from_manifests(args["history"], records=manifest.records.values())
+        scheduler = LPTScheduler(
+            files + low_memory, cost_model, n_workers=args["nc"], sizes=sizes, layouts=layouts
+        )
+        files = scheduler.order(files)
+        low_memory = scheduler.order(low_memory)
+        print(scheduler.report())
         print("="*60)
         total_files = len(files)
 
@@ -406,19 +2583,163 @@ def main():
         if args["use_gpu"]:
             device = "cuda"
 
-        count = 0
-        for fname in files:
-            count += 1
-            start_time = time.time()
-            print("Doing something!", device)
-            relax_fname(fname, model_file, relax_kwargs, device=device, only_sp=is_singlepoint, format_output=format_output, double_relax=args["double_relax"])
-            end_time = time.time()
-            execution_time = end_time - start_time
-            print("="*60)
-            print(f"File number: {count}/{total_files} - done in {execution_time:.3f} s")
-            print("="*60)
-
-        print("MACE job done!")
+        session_kwargs = {
+            "model_file": model_file,
+            "device": device,
+            "dispersion": args["dispersion"],
+            "skin": args["neighbor_skin"],
+            "dispersion_mode": args["dispersion_mode"],
+            "d3_cutoff": args["d3_cutoff"] * Bohr
+        }
+
+        campaign_start = time.time()
+        if args["nc"] > 1 and len(files) > 0:
+            # Used for a CPUs set up, each worker loads its own model.
+            run_pool(
+                files,
+                session_kwargs,
+                relax_kwargs,
+                args["nc"],
+                n_threads=args["nt"],
+                only_sp=is_singlepoint,
+                double_relax=args["double_relax"],
+                format_output=format_output,
+                manifest=manifest,
+                move_inputs=args["move_inputs"],
+                checkpoint_interval=args["checkpoint_interval"],
+                abort_policy=abort_policy,
+                cache=cache,
+                scheduler=scheduler,
+                profile=args["profile"],
+                symmetry_cache=args["symmetry_cache"],
+                writer=writer,
+                prefetch=args["prefetch"]
+            )
+
+        elif args["nc"] == 1:
+            # The model is loaded only once and shared by all the structures.
+            session = MACESession(**session_kwargs)
+            if abort_policy is not None:
+                relax_kwargs["abort_policy"] = abort_policy
+
+            if is_singlepoint and args["batch_size"] > 1:
+                single_point_files(
+                    files,
+                    session,
+                    batch_size=args["batch_size"],
+                    max_batch_atoms=args["max_batch_atoms"],
+                    manifest=manifest,
+                    cache=cache
+                )
+
+            elif not is_singlepoint and args["batch_relax"] > 1:
+                if args["profile"] is not None:
+                    print("The steps of the batched relaxation are not profiled")
+                relax_files_batched(
+                    files,
+                    session,
+                    relax_kwargs,
+                    batch_size=args["batch_relax"],
+                    format_output=format_output,
+                    double_relax=args["double_relax"],
+                    manifest=manifest,
+                    move_inputs=args["move_inputs"],
+                    cache=cache,
+                    scheduler=scheduler,
+                    writer=writer,
+                    prefetch=args["prefetch"]
+                )
+
+            else:
+                count = 0
+                for fname, input_struc in PrefetchReader(files, args["prefetch"]):
+                    count += 1
+                    start_time = time.time()
+                    print("Doing something!", device)
+                    relax_fname(
+                        fname,
+                        session,
+                        relax_kwargs,
+                        only_sp=is_singlepoint,
+                        format_output=format_output,
+                        double_relax=args["double_relax"],
+                        manifest=manifest,
+                        move_input=args["move_inputs"],
+                        checkpoint_interval=args["checkpoint_interval"],
+                        cache=cache,
+                        profile=args["profile"],
+                        input_struc=input_struc,
+                        writer=writer
+                    )
+                    end_time = time.time()
+                    execution_time = end_time - start_time
+                    scheduler.finish(fname, execution_time)
+                    print("="*60)
+                    print(f"File number: {count}/{total_files} - done in {execution_time:.3f} s")
+                    print(scheduler.report())
+                    print("="*60)
+
+            if session.skin > 0:
+                print("Neighbour lists:", session.neighbor_summary())
+
+        if len(low_memory) > 0:
+            # One structure at a time with the whole budget.
+            if args["nc"] > 1:
+                low_session = MACESession(**dict(session_kwargs, default_dtype="float32"))
+            else:
+                low_session = session.low_precision()
+            if abort_policy is not None:
+                relax_kwargs["abort_policy"] = abort_policy
+            for count, fname in enumerate(low_memory, start=1):
+                start_time = time.time()
+                relax_fname(
+                    fname,
+                    low_session,
+                    relax_kwargs,
+                    only_sp=is_singlepoint,
+                    format_output=format_output,
+                    double_relax=args["double_relax"],
+                    manifest=manifest,
+                    move_input=args["move_inputs"],
+                    checkpoint_interval=args["checkpoint_interval"],
+                    # The float32 results are not kept with the float64 settings.
+                    cache=None,
+                    profile=args["profile"],
+                    writer=writer
+                )
+                execution_time = time.time() - start_time
+                scheduler.finish(fname, execution_time)
+                print("="*60)
+                print(f"Low memory file: {count}/{len(low_memory)} - done in {execution_time:.3f} s")
+                print(scheduler.report())
+                print("="*60)
+
+        if args["dispersion"]:
+            print(f"D3 {args['dispersion_mode']}: {total_files} files in {time.time() - campaign_start:.3f} s")
+
+        if args["profile"] is not None and not is_singlepoint:
+            print("Step profile (share of the step time):")
+            profile_summary([
+                os.path.join(args["profile"], fname.split("/")[-1].split(".")[0] + ".npz") for fname in files
+            ])
+
+    if writer is not None:
+        # The manifest is complete when the queued outputs are written.
+        failed = writer.close()
+        print(f"Outputs written in background: {writer.n_done}, failed: {failed}")
+
+    if args["pressures"] is not None and not is_singlepoint:
+        sweep_table(manifest.records.values(), args["pressures"])
+
+    print("Campaign state:", manifest.summary())
+    manifest.close()
+    if cache is not None:
+        print("Result cache:", cache.summary())
+        cache.close()
+    if symmetry_cache is not None:
+        print("Symmetry cache:", symmetry_cache.summary())
+        symmetry_cache.close()
+    print("MACE job done!")
 
 
 if __name__ == "__main__":
@@ -6,6 +6,9 @@ Filter used to remove equivalent structures.
 
 Create by Orlando Villegas - June 2024
 
+The standard cells of the pymatgen SpacegroupAnalyzer can be taken from a
+relax_tools.SymmetryCache (--symmetry_cache), shared with MACE_relax.py and SymmetrizeStructures.py.
+
 """
 
 import time
@@ -22,6 +25,8 @@ from pymatgen.alchemy.filters import RemoveDuplicatesFilter
 from pymatgen.core import Structure
 from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 
+from relax_tools import SymmetryCache
+
 
 def pymatgen2ase(struc):
     atoms = ase.Atoms(symbols=struc.atomic_numbers, cell=struc.lattice.matrix)
@@ -36,19 +41,33 @@ def ase2pymatgen(struc):
     return Structure(lattice, species, coordinates)
 
 
-def symmetrize_cell(struc, mode="C"):
+def symmetrize_cell(struc, mode="C", cache=None):
     """
     symmetrize structure from pymatgen, and return the struc in conventional/primitive setting
     Args:
     struc: ase type
     mode: output conventional or primitive cell
+    cache: SymmetryCache, the lattice, species and coordinates of the result are kept in it
     """
-    P_struc = ase2pymatgen(struc)
-    finder = SpacegroupAnalyzer(P_struc, symprec=0.06, angle_tolerance=5)
-    if mode == "C":
-        P_struc = finder.get_conventional_standard_structure()
+    def standard_structure():
+        finder = SpacegroupAnalyzer(ase2pymatgen(struc), symprec=0.06, angle_tolerance=5)
+        if mode == "C":
+            return finder.get_conventional_standard_structure()
+        return finder.get_primitive_standard_structure()
+
+    if cache is None:
+        P_struc = standard_structure()
     else:
-        P_struc = finder.get_primitive_standard_structure()
+        def compute():
+            P_struc = standard_structure()
+            return {
+                "lattice": P_struc.lattice.matrix.tolist(),
+                "species": [site.species_string for site in P_struc],
+                "coords": P_struc.frac_coords.tolist()
+            }
+
+        entry = cache.memo(f"SpacegroupAnalyzer {mode}", struc, compute, symprec=0.06, angle_tolerance=5)
+        P_struc = Structure(entry["lattice"], entry["species"], entry["coords"])
 
     # return pymatgen2ase(P_struc)
     return P_struc
@@ -116,6 +135,14 @@ a particular file is read using the [-i] option.",
         default="./rejected"
     )
 
+    fileinput.add_argument(
+        "--symmetry_cache",
+        help="sqlite cache of the spglib datasets (e.g. symmetry_cache.sqlite), useful when the files\
+ were already analysed by MACE_relax.py or SymmetrizeStructures.py. By default \"none\".",
+        type=str,
+        default="none"
+    )
+
     return vars(parser.parse_args())
 
 
@@ -145,6 +172,11 @@ def main():
     except FileExistsError:
         pass
 
+    cache = None
+    if args["symmetry_cache"].lower() != "none":
+        cache = SymmetryCache(args["symmetry_cache"])
+        print(f"\tSymmetry cache:          {cache.path} ({len(cache)} datasets)")
+
     print("--------------------------------------------\n")
 
     structs_for_test = {}
@@ -155,13 +187,17 @@ def main():
 
         ase_struct = read(file)
         # ase_struct_symm = symmetrize_structure(ase_struct, initial_symprec=1e-6, final_symprec=1e-8)
-        pymatgen_struct = symmetrize_cell(ase_struct, mode="P")
+        pymatgen_struct = symmetrize_cell(ase_struct, mode="P", cache=cache)
         # pymatgen_struct = AseAtomsAdaptor.get_structure(ase_struct_symm)
 
         # print(pymatgen_struct)
         structs_for_test[file] = pymatgen_struct.copy()
         # structs_for_test[file] = Structure.from_file(file)
 
+    if cache is not None:
+        print("Symmetry cache:", cache.summary())
+        cache.close()
+
     print("The database loads all the files.")
     print("The next step is to compare.")
     print("Analyzing...")
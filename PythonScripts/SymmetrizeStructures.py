@@ -5,8 +5,12 @@
 Symmetrizes and obtains primitive cell of a set of structures.
 
 Create by Orlando Villegas - Jul 2024
+
+With --symmetry_cache the results of the spglib calls are kept in a relax_tools.SymmetryCache, shared with
+MACE_relax.py and RemoveDuplicatesFilter.py.
 """
 
+import argparse
 import glob
 import os
 import spglib
@@ -15,12 +19,22 @@ import ase.io
 from ase.data import chemical_symbols
 import ase
 
+from relax_tools import SymmetryCache
+
 import warnings
 warnings.filterwarnings('ignore', category=UserWarning, module='ase.io.extxyz')
 
 
-def symmetrize_structure(file, initial_symprec=1e-3, final_symprec=1e-5, output="symm_out"):
-    """Read the structure."""
+def symmetrize_structure(
+    file, initial_symprec=1e-3, final_symprec=1e-5, output="symm_out", cache=None, symprec=1e-3
+):
+    """
+    Read the structure, write its standardized primitive cell.
+
+    symprec is the tolerance of the standardization, refinement and primitive search, the space
+    group is printed with initial_symprec. With a cache the result of each spglib call is taken
+    from it.
+    """
     atoms = ase.io.read(file)
     name = file.split("/")[-1].split(".")[0]
 
@@ -32,16 +46,32 @@ def symmetrize_structure(file, initial_symprec=1e-3, final_symprec=1e-5, output=
 
     # Standardize the cell to a conventional representation
     # This ensures the cell follows standard conventions based on symmetry
-    standarized_cell = spglib.standardize_cell(cell, to_primitive=True, no_idealize=False, symprec=1e-3)
+    if cache is not None:
+        standarized_cell = cache.spglib_cell(
+            "standardize_cell", cell, symprec, to_primitive=True, no_idealize=False
+        )
+    else:
+        standarized_cell = spglib.standardize_cell(cell, to_primitive=True, no_idealize=False, symprec=symprec)
 
     # Refine the primitive cell
     # Adjust atomic positions and lattice vectors for consistency with symmetry operations
-    refined_cell = spglib.refine_cell(standarized_cell, symprec=1e-3)
+    if cache is not None:
+        refined_cell = cache.spglib_cell("refine_cell", standarized_cell, symprec)
+    else:
+        refined_cell = spglib.refine_cell(standarized_cell, symprec=symprec)
 
     # Search primitive cell
-    prim_cell = spglib.find_primitive(refined_cell, symprec=1e-3, angle_tolerance=-1.0)
-
-    spacegroup = spglib.get_spacegroup(prim_cell, symprec=initial_symprec, symbol_type=0)
+    if cache is not None:
+        prim_cell = cache.spglib_cell("find_primitive", refined_cell, symprec, angle_tolerance=-1.0)
+        spacegroup = cache.memo(
+            "get_spacegroup",
+            prim_cell,
+            lambda: spglib.get_spacegroup(prim_cell, symprec=initial_symprec, symbol_type=0),
+            initial_symprec
+        )
+    else:
+        prim_cell = spglib.find_primitive(refined_cell, symprec=symprec, angle_tolerance=-1.0)
+        spacegroup = spglib.get_spacegroup(prim_cell, symprec=initial_symprec, symbol_type=0)
     print("Spacegroup refined cell:", spacegroup)
     print(f"N atoms init: {len(atoms)}")
 
@@ -57,9 +87,30 @@ def symmetrize_structure(file, initial_symprec=1e-3, final_symprec=1e-5, output=
     ase.io.write(f"{output}/{name}.cif", new_atoms, format="cif")
 
 
+def options():
+    """Generate command line interface."""
+    parser = argparse.ArgumentParser(
+        prog="SymmetrizeStructures",
+        usage="%(prog)s [-options]",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="Enjoy the program!"
+    )
+
+    parser.add_argument(
+        "--symmetry_cache",
+        help="sqlite cache of the spglib datasets (e.g. symmetry_cache.sqlite), useful when the files\
+ were already analysed by MACE_relax.py or RemoveDuplicatesFilter.py. By default \"none\".",
+        type=str,
+        default="none"
+    )
+
+    return vars(parser.parse_args())
+
+
 def main():
     """Run program."""
     start_time = time.time()
+    args = options()
 
     print("Structural symmetrizer for MOF")
     print("------------------------------")
@@ -77,15 +128,24 @@ def main():
     except FileExistsError:
         pass
 
+    cache = None
+    if args["symmetry_cache"].lower() != "none":
+        cache = SymmetryCache(args["symmetry_cache"])
+        print(f"\tSymmetry cache:          {cache.path} ({len(cache)} datasets)")
+
     n = len(structures)
     for i, struc in enumerate(structures, start=1):
         print("---------------------------------------------------")
         print("File:  %s  (%04d/%04d)" % (struc, i, n))
         print("---------------------------------------------------")
         print(struc)
-        symmetrize_structure(struc, initial_symprec=1e-6, final_symprec=1e-6, output=output_folder)
+        symmetrize_structure(struc, initial_symprec=1e-6, final_symprec=1e-6, output=output_folder, cache=cache)
         print("Done!")
 
+    if cache is not None:
+        print("Symmetry cache:", cache.summary())
+        cache.close()
+
     end_time = time.time()
     execution_time = end_time - start_time
     print("Done {:.3f}s".format(execution_time))
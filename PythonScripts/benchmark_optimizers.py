@@ -0,0 +1,252 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compare the optimizers of MACE_relax.py on a reference set of structures.
+
+Create by Orlando Villegas - 2024
+
+Each structure is relaxed from the same geometry with each optimizer (atoms and cell, as
+MACE_relax.py --relax_cell), the steps to convergence, wall time and final energy are printed in
+a table and saved in a csv file. By default the structures are the fixed reference set of
+reference_set (the MOF cells of the reference folder, strained and rattled, always the same
+geometries), so the results of two runs can be compared; other structures are given as files or
+with --glob.
+
+Usage:
+
+    python benchmark_optimizers.py --model_file model.model
+
+    python benchmark_optimizers.py my_mofs/*.cif --model_file model.model
+
+    python benchmark_optimizers.py --glob --model_file model.model
+
+"""
+
+import argparse
+import copy
+import glob
+import os
+import time
+
+import ase.io
+import numpy as np
+from func_timeout import FunctionTimedOut
+
+from MACE_relax import MODEL_FILE, MACESession, relax_config
+from relax_tools import OPTIMIZERS
+
+
+def options():
+    """Generate command line interface."""
+    parser = argparse.ArgumentParser(
+        prog="benchmark_optimizers",
+        usage="%(prog)s [files] [-options]",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="Enjoy the program!"
+    )
+
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="Structures to compare the optimizers on (default: the reference set of reference_set)."
+    )
+
+    parser.add_argument(
+        "--glob",
+        action="store_true",
+        default=False,
+        help="Use the *.cif and *.extxyz files of the folder instead of the reference set."
+    )
+
+    parser.add_argument(
+        "--optimizers",
+        nargs="+",
+        default=list(OPTIMIZERS),
+        choices=list(OPTIMIZERS),
+        help="Optimizers to compare (default all)."
+    )
+
+    parser.add_argument(
+        "--model_file",
+        default=MODEL_FILE,
+        metavar="path",
+        help="MACE model file, \"small\", \"medium\" or \"large\" load the MACE-MP foundation models."
+    )
+
+    parser.add_argument(
+        "--dispersion",
+        action="store_true",
+        default=False,
+        help="Add the D3 correction."
+    )
+
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1e-3,
+        metavar="val",
+        help="Max force of convergence, eV/A (default 1e-3)."
+    )
+
+    parser.add_argument(
+        "--pressure",
+        type=float,
+        default=0.0,
+        metavar="GPa",
+        help="Applied pressure (default 0)."
+    )
+
+    parser.add_argument(
+        "--max_steps",
+        type=int,
+        default=2000,
+        metavar="N",
+        help="Steps before a relaxation is counted as not converged (default 2000)."
+    )
+
+    parser.add_argument(
+        "--no_relax_cell",
+        action="store_false",
+        dest="relax_cell",
+        default=True,
+        help="Relax only the atomic positions."
+    )
+
+    parser.add_argument(
+        "--use_gpu",
+        action="store_true",
+        default=False
+    )
+
+    parser.add_argument(
+        "--output",
+        default="benchmark_optimizers.csv",
+        metavar="file",
+        help="csv file with the results (default benchmark_optimizers.csv)."
+    )
+
+    return vars(parser.parse_args())
+
+
+# MOF cells of the reference set, next to this script.
+REFERENCE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reference")
+
+
+def reference_set(folder=REFERENCE_FOLDER, strain=1.02, rattle=0.03):
+    """
+    Return the reference set, a list of (name, atoms) with fixed strains and rattles.
+
+    The structures are the MOF cells of folder (reference/README.md), the cell is scaled by strain
+    and the atoms are rattled with a fixed seed for each file.
+    """
+    reference = []
+    for seed, fname in enumerate(sorted(glob.glob(os.path.join(folder, "*.cif")))):
+        atoms = ase.io.read(fname)
+        atoms.set_cell(atoms.cell * strain, scale_atoms=True)
+        atoms.rattle(rattle, seed=seed)
+        reference.append((os.path.basename(fname)[:-4], atoms))
+
+    return reference
+
+
+def benchmark(structures, session, optimizers, **relax_kwargs):
+    """Relax each (name, atoms) of structures with each optimizer, return a list of results."""
+    results = []
+    for name, reference in structures:
+        for method in optimizers:
+            print("="*60)
+            print(f"{name}: {method}")
+            print("="*60)
+            atoms = copy.deepcopy(reference)
+            session.attach(atoms)
+            stats = []
+            start_time = time.time()
+            try:
+                good, atoms = relax_config(atoms, method=method, logfile=None, stats=stats, **relax_kwargs)
+            except (Exception, FunctionTimedOut) as error:
+                print(f"{name} failed with {method}: {error}")
+                good = False
+            wall_time = time.time() - start_time
+
+            stage = stats[-1] if len(stats) > 0 else {"steps": -1, "fmax": np.nan, "energy": np.nan}
+            results.append({
+                "structure": name,
+                "n_atoms": len(atoms),
+                "optimizer": method,
+                "converged": good,
+                "steps": stage["steps"],
+                "time": wall_time,
+                "fmax": stage["fmax"],
+                "energy": stage["energy"],
+                "volume": atoms.get_volume()
+            })
+
+    return results
+
+
+def print_results(results, optimizers):
+    """Print the results of each structure and the totals of each optimizer."""
+    print(
+        f"{'structure':>24s} {'optimizer':>16s} {'conv':>5s} {'steps':>6s} {'time (s)':>10s}"
+        f" {'fmax':>9s} {'E/atom (eV)':>13s}"
+    )
+    for res in results:
+        print(
+            f"{res['structure'][-24:]:>24s} {res['optimizer']:>16s} {str(res['converged']):>5s}"
+            f" {res['steps']:6d} {res['time']:10.3f} {res['fmax']:9.2e} {res['energy'] / res['n_atoms']:13.6f}"
+        )
+
+    print("-"*60)
+    print(f"{'optimizer':>16s} {'converged':>10s} {'steps':>8s} {'time (s)':>10s}")
+    for method in optimizers:
+        selection = [res for res in results if res["optimizer"] == method]
+        converged = sum(res["converged"] for res in selection)
+        steps = sum(res["steps"] for res in selection)
+        wall_time = sum(res["time"] for res in selection)
+        print(f"{method:>16s} {converged:5d}/{len(selection):<4d} {steps:8d} {wall_time:10.3f}")
+
+
+def main():
+    """Run main program."""
+    args = options()
+
+    files = args["files"]
+    if args["glob"]:
+        files += sorted(glob.glob("*.cif") + glob.glob("*.extxyz"))
+    if len(files) == 0:
+        structures = reference_set()
+        print(f"Reference set: {len(structures)} structures ({', '.join(name for name, _ in structures)})")
+    else:
+        structures = [(fname.split("/")[-1].split(".")[0], ase.io.read(fname)) for fname in files]
+        print(f"Structures: {len(structures)} files")
+    print("Optimizers:", ", ".join(args["optimizers"]))
+
+    session = MACESession(
+        model_file=args["model_file"],
+        device="cuda" if args["use_gpu"] else "cpu",
+        dispersion=args["dispersion"]
+    )
+
+    results = benchmark(
+        structures,
+        session,
+        args["optimizers"],
+        tol=args["tolerance"],
+        applied_P=args["pressure"],
+        max_steps=args["max_steps"],
+        relax_cell=args["relax_cell"],
+        keep_symmetry=True
+    )
+    print_results(results, args["optimizers"])
+
+    columns = ["structure", "n_atoms", "optimizer", "converged", "steps", "time", "fmax", "energy", "volume"]
+    with open(args["output"], "w") as f:
+        f.write(",".join(columns) + "\n")
+        for res in results:
+            f.write(",".join(str(res[column]) for column in columns) + "\n")
+    print(f"Results saved in {args['output']}")
+
+
+if __name__ == "__main__":
+    main()
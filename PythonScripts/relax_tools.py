@@ -0,0 +1,2132 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tools shared by the relaxation scripts (MACE_relax.py and DFTB_relax.py).
+
+Create by Orlando Villegas - 2024
+
+- PrefetchReader and AsyncWriter: the next inputs are read and the outputs written in background
+  threads, the relaxations don't wait for the filesystem.
+
+- CampaignManifest: JSON-lines journal with the state of each structure of a campaign, used to
+  restart a job without moving the input files.
+
+- RelaxCheckpoint: geometry, cell and optimizer history saved every K steps, a relaxation stopped
+  by the time limit is continued from it.
+
+- make_optimizer: the optimizers of the relaxations (lbfgs, fire, precon_lbfgs, bfgs_linesearch),
+  they drive the atoms or their cell filter.
+
+- ResultCache: sqlite cache of converged results keyed by a canonical hash of the input structure
+  and the calculator settings, the same structure is never computed twice.
+
+- CostModel and LPTScheduler: expected wall time of each structure fitted on the history of the
+  manifests, the longest jobs are started first and the remaining time is reported.
+
+- split_cores and plan_layouts: cores of the workers of a pool, and the number of workers x
+  threads of each group of structures chosen from their number of atoms.
+
+- MemoryModel and PeakMemory: peak memory expected from the number of atoms and edges within the
+  model cutoff (fitted on the manifests), and the measured peak RSS of each structure.
+
+- ProcessWatchdog: time limit of the external solver processes of a structure, the whole process
+  group is killed (SIGTERM then SIGKILL) and its CPU time is counted.
+
+- StepProfiler: wall time of the model, symmetry, cell filter and optimizer in each step of a
+  relaxation, with fmax, energy and step length, saved in a .npz file per structure.
+
+- SymmetryReducedFilter: relaxation in the free Wyckoff parameters and the lattice strains allowed
+  by the space group, the optimizer works with far fewer coordinates than FixSymmetry.
+
+- SymmetryCache: cache (in memory, in sqlite if asked) of the spglib analysis (space group, Wyckoff
+  positions, symmetry operations, spglib cells) shared by the relaxation and symmetry scripts, the
+  operations of a relaxation stage are reused by the next one while they still hold.
+
+- GammaHessian: finite-displacement Hessian at the Gamma point, only the atoms that are not
+  equivalent by symmetry are displaced, the frequencies tell minima from saddle points.
+
+"""
+
+import glob
+import hashlib
+import heapq
+import io
+import json
+import os
+import queue
+import re
+import resource
+import signal
+import sqlite3
+import subprocess
+import threading
+import time
+import traceback
+import weakref
+from types import SimpleNamespace
+
+import numpy as np
+import ase.io
+from ase import units
+from ase.calculators.singlepoint import SinglePointCalculator
+from ase.constraints import FixSymmetry
+from ase.filters import Filter
+from ase.spacegroup.symmetrize import prep_symmetry, refine_symmetry
+from ase.optimize import BFGSLineSearch, FIRE, LBFGS
+from ase.optimize.precon import PreconLBFGS
+
+
+def atomic_write(outname, atoms, **kwargs):
+    """Write a structure to a temporary file and rename it, a crash never leaves half a file."""
+    folder, outfile = os.path.split(outname)
+    # Same extension, ase.io guesses the format from it.
+    tmpname = os.path.join(folder, "." + outfile)
+    ase.io.write(tmpname, atoms, **kwargs)
+    os.replace(tmpname, outname)
+
+
+def snapshot(atoms):
+    """Return a copy of atoms with the results of its calculator, written while the calculator is reused."""
+    structure = atoms.copy()
+    if atoms.calc is not None:
+        results = {
+            prop: value for prop, value in atoms.calc.results.items()
+            if prop in ["energy", "free_energy", "forces", "stress"]
+        }
+        structure.calc = SinglePointCalculator(structure, **results)
+
+    return structure
+
+
+class PrefetchReader:
+    """
+    Read the next files of a list in a background thread.
+
+    Iterating gives (fname, atoms) in the order of files, atoms is None if the file couldn't be
+    read. At most depth structures wait in memory, the thread stops reading until they are used.
+    With depth 0 nothing is read (atoms is always None), the caller reads the files.
+    """
+
+    def __init__(self, files, depth=4, read=ase.io.read):
+        """Start reading the files."""
+        self.files = list(files)
+        self.read = read
+        self.depth = depth
+        if depth > 0:
+            self._queue = queue.Queue(maxsize=depth)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        for fname in self.files:
+            try:
+                atoms = self.read(fname)
+            except Exception as error:
+                print(f"failed to read {fname}: {error}")
+                atoms = None
+            self._queue.put((fname, atoms))
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        for fname in self.files:
+            yield self._queue.get() if self.depth > 0 else (fname, None)
+
+
+class AsyncWriter:
+    """
+    Run the outputs of the finished structures (writes, moves of the inputs, manifest updates) in
+    a background thread, in the order they are submitted.
+
+    All the outputs of a structure are submitted as one function with the manifest update at its
+    end: if a write fails the error is printed and the file stays running in the manifest, it is
+    run again at restart. close waits for the pending outputs.
+    """
+
+    def __init__(self, max_pending=16):
+        """Start the writer thread."""
+        self.n_done = 0
+        self.n_failed = 0
+        self._queue = queue.Queue(maxsize=max(1, max_pending))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            func, args, kwargs = task
+            try:
+                func(*args, **kwargs)
+                self.n_done += 1
+            except Exception:
+                self.n_failed += 1
+                print("Output failed:")
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+        self._queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs), it waits if max_pending outputs are already queued."""
+        self._queue.put((func, args, kwargs))
+
+    def flush(self):
+        """Wait until the queued outputs are done."""
+        self._queue.join()
+
+    def close(self):
+        """Wait for the queued outputs and stop the thread, return the number of failed outputs."""
+        self._queue.put(None)
+        self._thread.join()
+
+        return self.n_failed
+
+
+def run_output(writer, func, *args, **kwargs):
+    """Submit func to the AsyncWriter, or run it now if writer is None."""
+    if writer is None:
+        return func(*args, **kwargs)
+
+    writer.submit(func, *args, **kwargs)
+
+
+class CampaignManifest:
+    """
+    Journal of a relaxation campaign.
+
+    Each change of a structure is appended as a JSON line (file, state, attempts, wall_time,
+    output, ...), when the journal is read again the last line of each file wins. States:
+
+        queued     not started yet, its size (n_atoms, volume) is known.
+        running    the structure was started, if it is found at restart it was interrupted.
+        suspended  stopped by the time limit, it continues from its checkpoint in the next run.
+        done       relaxed (or single point) and written in the completed folder.
+        fail       finished without convergence, written in the fail folder.
+        rejected   stopped by an early abort policy (reason), written in the rejected folder.
+        deferred   expected to need more memory than available, not run (it is tried again).
+
+    Suspended files are not limited by max_attempts, they advance at each run. The journal can be
+    updated from the AsyncWriter thread.
+    """
+
+    FINISHED = ["done", "fail", "rejected"]
+
+    def __init__(self, path="manifest.jsonl", max_attempts=3):
+        """Read the journal if it exists."""
+        self.path = path
+        self.max_attempts = max_attempts
+        self.records = {}
+
+        if os.path.isfile(path):
+            with open(path, "r") as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line cut by a crash.
+                        continue
+                    self.records[record["file"]] = record
+
+        self._journal = open(path, "a")
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def state(self, fname):
+        """Return the last state of a file, None if it was never started."""
+        return self.records.get(fname, {}).get("state")
+
+    def is_finished(self, fname):
+        """Return True if the file doesn't need to be run again."""
+        record = self.records.get(fname)
+        if record is None:
+            return False
+
+        if record["state"] in self.FINISHED:
+            return True
+
+        if record["state"] == "suspended":
+            return False
+
+        return record.get("attempts", 0) >= self.max_attempts
+
+    def pending(self, files):
+        """Return the files that are not finished, interrupted ones are retried."""
+        pending = [fname for fname in files if not self.is_finished(fname)]
+        interrupted = [fname for fname in pending if self.state(fname) == "running"]
+        suspended = [fname for fname in pending if self.state(fname) == "suspended"]
+        print(f"Manifest {self.path}: {len(files) - len(pending)} files finished,", end=" ")
+        print(f"{len(interrupted)} interrupted, {len(suspended)} suspended, {len(pending)} to run")
+
+        return pending
+
+    def update(self, fname, **fields):
+        """Append the new state of a file to the journal."""
+        with self._lock:
+            record = dict(self.records.get(fname, {"file": fname, "attempts": 0}))
+            record.update(fields)
+            record["time"] = time.time()
+            self.records[fname] = record
+
+            self._journal.write(json.dumps(record) + "\n")
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+        return record
+
+    def queue(self, sizes):
+        """Record the sizes (dict of n_atoms, volume by file) of the files never started, in one write."""
+        lines = []
+        with self._lock:
+            for fname, (n_atoms, volume) in sizes.items():
+                if fname in self.records or n_atoms is None:
+                    continue
+                record = {
+                    "file": fname, "attempts": 0, "state": "queued", "n_atoms": n_atoms, "volume": volume,
+                    "time": time.time()
+                }
+                self.records[fname] = record
+                lines.append(json.dumps(record) + "\n")
+
+            if len(lines) > 0:
+                self._journal.writelines(lines)
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+
+    def start(self, fname, **fields):
+        """Mark a file as running and count the attempt."""
+        attempts = self.records.get(fname, {}).get("attempts", 0) + 1
+        return self.update(fname, state="running", attempts=attempts, **fields)
+
+    def finish(self, fname, state, output=None, wall_time=None, **fields):
+        """Record the final state of a file."""
+        return self.update(fname, state=state, output=output, wall_time=wall_time, **fields)
+
+    def summary(self):
+        """Return the number of files in each state."""
+        states = {}
+        for record in self.records.values():
+            states[record["state"]] = states.get(record["state"], 0) + 1
+
+        return states
+
+    def close(self):
+        """Close the journal."""
+        self._journal.close()
+
+
+class StartJournal:
+    """
+    Mark the files of a pool as running when a worker starts them, not when they are queued.
+
+    The workers put (fname, size_fields or None) in queue (a queue of the multiprocessing context ctx given to
+    them by the pool initializer), a thread of the main process records manifest.start: a job
+    stopped with files still in the queue doesn't count an attempt for them. wait(fname) is
+    called before the result of fname is recorded.
+    """
+
+    def __init__(self, manifest, ctx):
+        """Start the thread that reads the queue."""
+        self.manifest = manifest
+        self.queue = ctx.Queue()
+        self.started = set()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            fname, fields = item
+            self.manifest.start(fname, **(fields or {}))
+            with self._cond:
+                self.started.add(fname)
+                self._cond.notify_all()
+
+    def wait(self, fname, timeout=60.0):
+        """Wait until the start of fname is recorded."""
+        with self._cond:
+            self._cond.wait_for(lambda: fname in self.started, timeout)
+
+    def close(self):
+        """Stop the thread."""
+        self.queue.put(None)
+        self._thread.join()
+
+
+OPTIMIZERS = {
+    "lbfgs": LBFGS,
+    "fire": FIRE,
+    "precon_lbfgs": PreconLBFGS,
+    "bfgs_linesearch": BFGSLineSearch
+}
+
+
+def make_optimizer(method, optimizable, **kwargs):
+    """
+    Return the optimizer method of optimizable.
+
+    optimizable is the structure or its cell filter (FrechetCellFilter), the optimizer moves the
+    degrees of freedom of what it is given.
+    """
+    if method not in OPTIMIZERS:
+        raise ValueError('unknown method %s!' % method)
+
+    return OPTIMIZERS[method](optimizable, **kwargs)
+
+
+def run_optimizer(opt, optimizable, fmax, steps):
+    """Run opt until the forces of optimizable (the cell ones included) are below fmax."""
+    factor = getattr(optimizable, "exp_cell_factor", None)
+    if isinstance(opt, PreconLBFGS) and factor is not None:
+        # PreconLBFGS tests the stress (eV/A^3) instead of the cell forces of the filter.
+        return opt.run(fmax, steps, smax=fmax * factor / optimizable.atoms.get_volume())
+
+    return opt.run(fmax, steps)
+
+
+def get_lbfgs_state(opt):
+    """Return the history of an ase LBFGS optimizer."""
+    # Since ase 3.25 the history is kept in opt.state.
+    state = getattr(opt, "state", opt)
+    return {
+        "iteration": state.iteration,
+        "s": np.array(state.s),
+        "y": np.array(state.y),
+        "rho": np.array(state.rho),
+        "r0": np.array([]) if opt.r0 is None else np.array(opt.r0),
+        "f0": np.array([]) if opt.f0 is None else np.array(opt.f0),
+        "nsteps": opt.nsteps
+    }
+
+
+def set_lbfgs_state(opt, saved):
+    """Load the history saved by get_lbfgs_state in an ase LBFGS optimizer."""
+    state = getattr(opt, "state", opt)
+    state.iteration = int(saved["iteration"])
+    state.s = list(saved["s"])
+    state.y = list(saved["y"])
+    state.rho = list(saved["rho"])
+    opt.r0 = None if len(saved["r0"]) == 0 else saved["r0"]
+    opt.f0 = None if len(saved["f0"]) == 0 else saved["f0"]
+    opt.nsteps = int(saved["nsteps"])
+
+
+def get_optimizer_state(opt):
+    """
+    Return the history of an optimizer.
+
+    The LBFGS and FIRE histories are saved, the other optimizers only keep their number of steps
+    and start again from the saved geometry.
+    """
+    if isinstance(opt, LBFGS):
+        return dict(get_lbfgs_state(opt), kind="lbfgs")
+
+    if isinstance(opt, FIRE):
+        # The velocities are opt.v before ase 3.23.
+        vel = getattr(opt, "vel", getattr(opt, "v", None))
+        return {
+            "kind": "fire",
+            "vel": np.array([]) if vel is None else np.array(vel),
+            "dt": opt.dt,
+            "a": opt.a,
+            "Nsteps": opt.Nsteps,
+            "nsteps": opt.nsteps
+        }
+
+    return {"kind": type(opt).__name__, "nsteps": opt.nsteps}
+
+
+def set_optimizer_state(opt, saved):
+    """Load the history saved by get_optimizer_state, return False if it is from another optimizer."""
+    # Checkpoints without kind are from LBFGS.
+    kind = str(saved["kind"]) if "kind" in saved else "lbfgs"
+    if kind == "lbfgs" and isinstance(opt, LBFGS):
+        set_lbfgs_state(opt, saved)
+    elif kind == "fire" and isinstance(opt, FIRE):
+        vel = None if len(saved["vel"]) == 0 else np.array(saved["vel"])
+        if hasattr(opt, "vel"):
+            opt.vel = vel
+        else:
+            opt.v = vel
+        opt.dt = float(saved["dt"])
+        opt.a = float(saved["a"])
+        opt.Nsteps = int(saved["Nsteps"])
+        opt.nsteps = int(saved["nsteps"])
+    elif kind == type(opt).__name__:
+        opt.nsteps = int(saved["nsteps"])
+    else:
+        return False
+
+    return True
+
+
+def carry_optimizer_state(opt, optimizable=None):
+    """
+    Return the history of opt to warm start the relaxation of the same structure at other settings.
+
+    The last positions and forces of LBFGS are dropped, the forces of the next relaxation (another
+    pressure) are not comparable with them, only the curvature pairs are kept. The step count
+    starts again and the reference cell of the cell filter is kept with the history.
+    """
+    saved = get_optimizer_state(opt)
+    if saved["kind"] == "lbfgs":
+        saved["r0"] = np.array([])
+        saved["f0"] = np.array([])
+    saved["nsteps"] = 0
+    orig_cell = getattr(optimizable, "orig_cell", None)
+    if orig_cell is not None:
+        saved["orig_cell"] = np.array(orig_cell)
+
+    return saved
+
+
+def warm_start_optimizer(opt, optimizable, saved):
+    """Load a history of carry_optimizer_state, return False if it is from another optimizer."""
+    if not set_optimizer_state(opt, saved):
+        return False
+    if "orig_cell" in saved and hasattr(optimizable, "orig_cell"):
+        optimizable.orig_cell = saved["orig_cell"]
+
+    if isinstance(opt, LBFGS) and opt.r0 is None and getattr(opt, "state", opt).iteration > 0:
+        # Without r0 and f0 the first step must not add a curvature pair, the iteration count
+        # (number of pairs used by the next step) goes back by one.
+        update = opt.update
+
+        def skip_first_update(pos, forces, r0, f0):
+            getattr(opt, "state", opt).iteration -= 1
+            opt.update = update
+
+        opt.update = skip_first_update
+
+    return True
+
+
+class RelaxCheckpoint:
+    """
+    Checkpoint of a relaxation.
+
+    Every interval steps the geometry (extxyz, with the cell) and the optimizer history (npz) are
+    saved in folder. The stage of the relaxation (double relax) is saved with them, the history is
+    loaded only by the same stage.
+    """
+
+    def __init__(self, name, folder="checkpoints", interval=20):
+        """Name is used for the files of the checkpoint."""
+        self.name = name
+        self.folder = folder
+        self.interval = interval
+        self.geometry_file = os.path.join(folder, name + ".extxyz")
+        self.state_file = os.path.join(folder, name + "_opt.npz")
+
+    def exists(self):
+        """Return True if there is a checkpoint to continue from."""
+        return os.path.isfile(self.geometry_file) and os.path.isfile(self.state_file)
+
+    def read_atoms(self):
+        """Return the saved structure."""
+        atoms = ase.io.read(self.geometry_file)
+        # The npz file is written last, its geometry is the one of the optimizer history.
+        with np.load(self.state_file) as saved:
+            atoms.set_cell(saved["cell"])
+            atoms.set_positions(saved["positions"])
+
+        return atoms
+
+    def stage(self):
+        """Return the stage of the saved relaxation."""
+        with np.load(self.state_file) as saved:
+            return int(saved["stage"])
+
+    def save(self, atoms, opt, optimizable=None, stage=1):
+        """Save the geometry and the optimizer history."""
+        if not os.path.isdir(self.folder):
+            try:
+                os.mkdir(self.folder)
+            except FileExistsError:
+                pass
+
+        structure = atoms.copy()
+        structure.set_constraint()
+        atomic_write(self.geometry_file, structure)
+
+        saved = get_optimizer_state(opt)
+        saved["stage"] = stage
+        saved["positions"] = atoms.get_positions()
+        saved["cell"] = np.array(atoms.get_cell())
+        # Generalized coordinates of the cell filters are relative to this cell.
+        orig_cell = getattr(optimizable, "orig_cell", None)
+        if orig_cell is not None:
+            saved["orig_cell"] = np.array(orig_cell)
+
+        tmpname = os.path.join(self.folder, "." + self.name + "_opt.npz")
+        np.savez(tmpname, **saved)
+        os.replace(tmpname, self.state_file)
+
+    def restore(self, opt, optimizable=None, stage=1):
+        """Load the optimizer history if the checkpoint is from the same stage."""
+        if not self.exists() or self.stage() != stage:
+            return False
+
+        with np.load(self.state_file) as saved:
+            if not set_optimizer_state(opt, saved):
+                print(f"{self.state_file} is from another optimizer, only the geometry is used")
+                return False
+            if "orig_cell" in saved and hasattr(optimizable, "orig_cell"):
+                optimizable.orig_cell = saved["orig_cell"]
+
+        print(f"Optimizer restored from {self.state_file} ({opt.nsteps} steps)")
+        return True
+
+    def attach(self, atoms, opt, optimizable=None, stage=1):
+        """Save the checkpoint every interval steps of opt."""
+        if self.interval > 0:
+            opt.attach(self.save, interval=self.interval, atoms=atoms, opt=opt, optimizable=optimizable, stage=stage)
+
+    def clear(self):
+        """Remove the checkpoint files."""
+        for fname in [self.geometry_file, self.state_file]:
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+
+def structure_hash(atoms, settings=None, decimals=4):
+    """
+    Return a canonical hash of a structure and the calculator settings.
+
+    Species, cell and wrapped fractional positions are rounded to decimals and the atoms are
+    sorted, the same structure read from different files (atom order, periodic images) has the
+    same hash.
+    """
+    cell = np.round(atoms.cell.array, decimals) + 0.0
+    frac = atoms.get_scaled_positions(wrap=True)
+    # 0.99999 and 0.0 are the same position once rounded.
+    frac = np.round(frac, decimals) % 1.0 + 0.0
+    frac = np.round(frac, decimals) + 0.0
+    numbers = atoms.get_atomic_numbers()
+    order = np.lexsort((frac[:, 2], frac[:, 1], frac[:, 0], numbers))
+
+    sha = hashlib.sha256()
+    sha.update(np.ascontiguousarray(numbers[order], dtype=np.int64).tobytes())
+    sha.update(np.ascontiguousarray(atoms.pbc, dtype=np.int8).tobytes())
+    sha.update(" ".join(f"{x:.{decimals}f}" for x in cell.ravel()).encode())
+    sha.update(" ".join(f"{x:.{decimals}f}" for x in frac[order].ravel()).encode())
+    sha.update(json.dumps(settings, sort_keys=True, default=str).encode())
+
+    return sha.hexdigest()
+
+
+def file_hash(fname, block_size=1 << 20):
+    """Return the sha256 of a file (model files), used in the cache settings."""
+    sha = hashlib.sha256()
+    with open(fname, "rb") as data:
+        for block in iter(lambda: data.read(block_size), b""):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+class ResultCache:
+    """
+    Persistent cache of converged results.
+
+    The key is structure_hash(input structure, settings), the value is the final structure with
+    its energy, forces and stress (extxyz text). Several jobs can share the same sqlite file.
+    Entries older than max_age days and the least used ones above max_entries are evicted when
+    the cache is opened and closed.
+    """
+
+    def __init__(self, path="results_cache.sqlite", settings=None, max_entries=100000, max_age=90.0):
+        """Open (or create) the cache, settings is the part of the key that is not the structure."""
+        self.path = path
+        self.settings = settings
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+        self._db = sqlite3.connect(path, timeout=60.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, created REAL, accessed REAL, n_atoms INTEGER, "
+            "structure TEXT, fields TEXT)"
+        )
+        self._db.commit()
+        self.evict()
+
+    def key(self, atoms):
+        """Return the key of a structure with the settings of the cache."""
+        return structure_hash(atoms, self.settings)
+
+    def get(self, key):
+        """Return the cached structure (SinglePointCalculator) and its fields, None if missing."""
+        row = self._db.execute(
+            "SELECT structure, fields FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self._db.execute("UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key))
+        self._db.commit()
+        self.hits += 1
+
+        return ase.io.read(io.StringIO(row[0]), format="extxyz"), json.loads(row[1])
+
+    def put(self, key, atoms, **fields):
+        """Save the final structure and the results of its calculator."""
+        structure = snapshot(atoms)
+        structure.set_constraint()
+        structure.info = {}
+
+        text = io.StringIO()
+        ase.io.write(text, structure, format="extxyz")
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+            (key, now, now, len(structure), text.getvalue(), json.dumps(fields, default=str))
+        )
+        self._db.commit()
+
+    def evict(self):
+        """Remove the entries older than max_age days and the least used above max_entries."""
+        removed = 0
+        if self.max_age is not None:
+            removed += self._db.execute(
+                "DELETE FROM results WHERE created < ?", (time.time() - self.max_age * 86400.0,)
+            ).rowcount
+        if self.max_entries is not None:
+            removed += self._db.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed DESC "
+                "LIMIT -1 OFFSET ?)", (self.max_entries,)
+            ).rowcount
+        self._db.commit()
+        if removed > 0:
+            print(f"Result cache {self.path}: {removed} entries evicted")
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def summary(self):
+        """Return the hits and misses of this run."""
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self)}
+
+    def close(self):
+        """Evict the old entries and close the database."""
+        self.evict()
+        self._db.close()
+
+
+def size_fields(atoms):
+    """Return the manifest fields of the size of atoms (n_atoms, volume), used by LPTScheduler."""
+    return {"n_atoms": len(atoms), "volume": atoms.get_volume() if atoms.cell.rank == 3 else None}
+
+
+def structure_size(fname):
+    """Return the number of atoms and the volume of the structure in fname, (None, None) if unreadable."""
+    try:
+        atoms = ase.io.read(fname)
+    except Exception:
+        return None, None
+
+    fields = size_fields(atoms)
+    return fields["n_atoms"], fields["volume"]
+
+
+def _volume(cellpar):
+    """Return the volume of a cell given by a, b, c, alpha, beta, gamma (degrees)."""
+    a, b, c = cellpar[:3]
+    cos = np.cos(np.radians(cellpar[3:]))
+    return float(a * b * c * np.sqrt(1.0 - np.sum(cos ** 2) + 2.0 * np.prod(cos)))
+
+
+def _cif_number(value):
+    """Return the float of a CIF value, without its uncertainty (e.g. 25.832(3))."""
+    return float(value.split("(")[0])
+
+
+def _cif_size(fname):
+    """Return (n_atoms, volume) of a one-block CIF in P1 or with the multiplicities of its sites."""
+    cellpar = {}
+    loops = []
+    n_blocks = 0
+    space_group = None
+    with open(fname, "r") as cif:
+        loop = None
+        for line in cif:
+            line = line.strip()
+            if line.startswith("data_"):
+                n_blocks += 1
+                loop = None
+            elif line == "loop_":
+                loop = {"headers": [], "rows": []}
+                loops.append(loop)
+            elif line.startswith("_"):
+                tokens = line.split(None, 1)
+                if loop is not None and len(loop["rows"]) == 0 and len(tokens) == 1:
+                    loop["headers"].append(tokens[0])
+                    continue
+                loop = None
+                name = tokens[0].lower()
+                if name[:13] in ("_cell_length_", "_cell_angle_a", "_cell_angle_b", "_cell_angle_g"):
+                    cellpar[name] = _cif_number(tokens[1])
+                elif name in ("_symmetry_int_tables_number", "_space_group_it_number"):
+                    space_group = int(tokens[1])
+            elif loop is not None and line != "" and not line.startswith("#"):
+                loop["rows"].append(line)
+
+    names = [
+        "_cell_length_a", "_cell_length_b", "_cell_length_c", "_cell_angle_alpha", "_cell_angle_beta",
+        "_cell_angle_gamma"
+    ]
+    if n_blocks != 1 or any(name not in cellpar for name in names):
+        return None, None
+
+    n_operations = None
+    sites = None
+    for loop in loops:
+        headers = [header.lower() for header in loop["headers"]]
+        if "_symmetry_equiv_pos_as_xyz" in headers or "_space_group_symop_operation_xyz" in headers:
+            n_operations = len(loop["rows"])
+        elif "_atom_site_fract_x" in headers or "_atom_site_cartn_x" in headers:
+            # Rows can be split over lines, quoted labels have no spaces in the site loops.
+            tokens = " ".join(loop["rows"]).split()
+            if len(tokens) % len(headers) != 0:
+                return None, None
+            sites = [tokens[i:i + len(headers)] for i in range(0, len(tokens), len(headers))]
+            multiplicity = headers.index("_atom_site_symmetry_multiplicity") \
+                if "_atom_site_symmetry_multiplicity" in headers else None
+
+    if sites is None:
+        return None, None
+    if n_operations == 1 or (n_operations is None and space_group == 1):
+        n_atoms = len(sites)
+    elif multiplicity is not None:
+        n_atoms = sum(int(float(site[multiplicity])) for site in sites)
+    else:
+        # ase would expand the sites with the operations.
+        return None, None
+
+    return n_atoms, _volume([cellpar[name] for name in names])
+
+
+def _xyz_size(fname):
+    """Return (n_atoms, volume) from the first two lines (first frame) of an xyz or extxyz file."""
+    with open(fname, "r") as xyz:
+        n_atoms = int(xyz.readline())
+        comment = xyz.readline()
+
+    lattice = re.search(r'lattice="([^"]*)"', comment, flags=re.IGNORECASE)
+    if lattice is None:
+        return n_atoms, None
+
+    lattice = np.array(lattice.group(1).split(), dtype=float).reshape(3, 3)
+    return n_atoms, float(abs(np.linalg.det(lattice)))
+
+
+def _res_size(fname):
+    """Return (n_atoms, volume) of a SHELX/AIRSS res file (P1, as ase reads it)."""
+    cellpar = None
+    n_atoms = 0
+    atoms = False
+    with open(fname, "r") as res:
+        for line in res:
+            tokens = line.split()
+            if len(tokens) == 0:
+                continue
+            if tokens[0] == "CELL":
+                cellpar = [float(token) for token in tokens[2:8]]
+            elif tokens[0] == "SFAC":
+                atoms = True
+            elif tokens[0] == "END":
+                break
+            elif atoms and len(tokens) >= 5 and tokens[1].isdigit():
+                n_atoms += 1
+
+    if cellpar is None or n_atoms == 0:
+        return None, None
+
+    return n_atoms, _volume(cellpar)
+
+
+def header_size(fname):
+    """
+    Return the number of atoms and the volume of the structure in fname from its text, (None, None) if unknown.
+
+    Only the cell and the atom lines of cif (P1 or with site multiplicities), xyz/extxyz (first
+    frame) and res files are read, much faster than ase.io.read for large cells.
+    """
+    readers = {".cif": _cif_size, ".xyz": _xyz_size, ".extxyz": _xyz_size, ".res": _res_size}
+    reader = readers.get(os.path.splitext(fname)[1].lower())
+    if reader is None:
+        return None, None
+
+    try:
+        return reader(fname)
+    except (OSError, ValueError, IndexError, UnicodeDecodeError):
+        return None, None
+
+
+def file_sizes(files, records=None, manifest=None):
+    """
+    Return the (n_atoms, volume) of each file.
+
+    The size is taken from the manifest records (dict by file, n_atoms and volume of size_fields)
+    of the files already started or queued, the other files are parsed by header_size (read by
+    ase if it can't tell). With a manifest its records are used and the new sizes are queued in
+    it, the next runs don't read the files again.
+    """
+    if manifest is not None:
+        records = manifest.records
+    records = records if records is not None else {}
+    sizes = {}
+    new = {}
+    for fname in files:
+        record = records.get(fname, {})
+        if record.get("n_atoms"):
+            sizes[fname] = record["n_atoms"], record.get("volume")
+            continue
+
+        sizes[fname] = header_size(fname)
+        if sizes[fname][0] is None:
+            sizes[fname] = structure_size(fname)
+        new[fname] = sizes[fname]
+
+    if manifest is not None:
+        manifest.queue(new)
+
+    return sizes
+
+
+def format_time(seconds):
+    """Return a time in s as h:mm:ss."""
+    seconds = int(round(seconds))
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+class CostModel:
+    """
+    Expected wall time of a structure, t = a N^b (N/V / rho)^c.
+
+    a and b are fitted (log-log least squares) on the finished records of the manifests with
+    n_atoms and wall_time. The density term c = 1 accounts for the number of neighbours per atom,
+    rho is the median density of the structures to run. Without history (less than min_records)
+    a = 1 and b = 2, only the order of the jobs is meaningful then.
+    """
+
+    def __init__(self, records=(), min_records=5, density_exponent=1.0):
+        """Fit the model on the records of a manifest (dictionaries)."""
+        self.a = 1.0
+        self.b = 2.0
+        self.density_exponent = density_exponent
+        self.reference_density = None
+        self.n_records = 0
+
+        points = [
+            (record["n_atoms"], record["wall_time"]) for record in records
+            if record.get("state") in CampaignManifest.FINISHED and not record.get("cached")
+            and record.get("n_atoms") and record.get("wall_time")
+        ]
+        self.n_records = len(points)
+        if self.n_records >= min_records:
+            n_atoms, wall_time = np.log(np.array(points, dtype=float)).T
+            if np.ptp(n_atoms) > 0:
+                self.b, log_a = np.polyfit(n_atoms, wall_time, 1)
+            else:
+                log_a = np.mean(wall_time) - self.b * n_atoms[0]
+            self.a = np.exp(log_a)
+
+    @classmethod
+    def from_manifests(cls, paths, records=(), **kwargs):
+        """Fit the model on records and the journals of other manifests (glob patterns are accepted)."""
+        records = list(records)
+        for pattern in paths:
+            for path in glob.glob(pattern):
+                manifest = CampaignManifest(path)
+                records += list(manifest.records.values())
+                manifest.close()
+
+        return cls(records, **kwargs)
+
+    def predict(self, n_atoms, volume=None):
+        """Return the expected wall time in s."""
+        cost = self.a * n_atoms ** self.b
+        if volume is not None and self.reference_density is not None:
+            cost *= (n_atoms / volume / self.reference_density) ** self.density_exponent
+
+        return cost
+
+
+class LPTScheduler:
+    """
+    Longest expected processing time first.
+
+    The files are sorted by decreasing predicted cost, the workers take them in this order so a
+    large cell never arrives at the end of the allocation. The remaining time is the greedy
+    assignment of the pending files to n_workers, scaled by the ratio between the observed and
+    the predicted times of this run. With layouts (plan_layouts, groups run one after the other)
+    each group is assigned to its own workers.
+    """
+
+    def __init__(self, files, cost_model=None, n_workers=1, records=None, sizes=None, layouts=None):
+        """Predict the cost of each file, the sizes are given or taken from file_sizes(files, records)."""
+        self.cost_model = cost_model if cost_model is not None else CostModel()
+        self.n_workers = n_workers
+        self.layouts = layouts
+        if sizes is None:
+            sizes = file_sizes(files, records)
+        sizes = {fname: sizes[fname] for fname in files}
+        self.sizes = sizes
+
+        densities = [n / v for n, v in sizes.values() if n is not None and v]
+        if len(densities) > 0:
+            self.cost_model.reference_density = np.median(densities)
+
+        # Unreadable files fail immediately.
+        self.costs = {
+            fname: 0.0 if n_atoms is None else self.cost_model.predict(n_atoms, volume)
+            for fname, (n_atoms, volume) in sizes.items()
+        }
+        self.pending = dict(self.costs)
+        self._log_ratios = []
+
+    def order(self, files=None):
+        """Return the pending files (of files if given) from the longest to the shortest."""
+        files = self.pending if files is None else [fname for fname in files if fname in self.pending]
+        return sorted(files, key=lambda fname: -self.pending[fname])
+
+    def scale(self):
+        """Return the observed / predicted time ratio of this run (geometric mean)."""
+        if len(self._log_ratios) == 0:
+            return 1.0
+        return float(np.exp(np.mean(self._log_ratios)))
+
+    def finish(self, fname, wall_time=None):
+        """Remove a finished file, its time corrects the next predictions."""
+        cost = self.pending.pop(fname, None)
+        if cost and wall_time:
+            self._log_ratios.append(np.log(wall_time / cost))
+
+    def remaining_time(self):
+        """Return the predicted wall time to finish the pending files."""
+        layouts = self.layouts if self.layouts is not None else [(self.n_workers, None, None)]
+        total = 0.0
+        for n_workers, _, files in layouts:
+            workers = [0.0] * n_workers
+            for fname in self.order(files):
+                heapq.heapreplace(workers, workers[0] + self.pending[fname])
+            total += max(workers)
+
+        return total * self.scale()
+
+    def report(self):
+        """Return a line with the predicted remaining time."""
+        fitted = self.cost_model.n_records
+        if self.layouts is not None:
+            workers = ", ".join(
+                f"{n_workers}" + (f"x{n_threads}" if n_threads else "") for n_workers, n_threads, _ in self.layouts
+            )
+            workers = f"layouts of {workers} workers"
+        else:
+            workers = f"{self.n_workers} workers"
+        return (
+            f"Predicted remaining time: {format_time(self.remaining_time())} for {len(self.pending)} files"
+            f" ({workers}, model fitted on {fitted} records, scale {self.scale():.2f})"
+        )
+
+
+def split_cores(n_workers, n_threads):
+    """Return the group of cores assigned to each worker."""
+    cores = sorted(os.sched_getaffinity(0))
+    if n_workers * n_threads > len(cores):
+        print(f"Warning: {n_workers}x{n_threads} threads requested but only {len(cores)} cores available")
+
+    return [
+        [cores[(i * n_threads + j) % len(cores)] for j in range(n_threads)]
+        for i in range(n_workers)
+    ]
+
+
+def plan_threads(n_atoms, n_cores, atoms_per_thread=16):
+    """Return the threads of a process for a structure of n_atoms, a power of 2 up to n_cores."""
+    n_threads = 1
+    if n_atoms is None:
+        return n_threads
+
+    while 2 * n_threads <= n_cores and 2 * n_threads * atoms_per_thread <= n_atoms:
+        n_threads *= 2
+
+    return n_threads
+
+
+def plan_layouts(files, sizes, n_cores, atoms_per_thread=16):
+    """
+    Split the cores between workers x threads for each group of files.
+
+    The threads of each file are given by plan_threads, few wide workers for the large cells and
+    many narrow ones for the small cells. Returns a list of (n_workers, n_threads, files), the
+    groups keep the order of files (consecutive files with the same threads are grouped).
+    """
+    layouts = []
+    for fname in files:
+        n_threads = plan_threads(sizes.get(fname, (None, None))[0], n_cores, atoms_per_thread)
+        if len(layouts) > 0 and layouts[-1][1] == n_threads:
+            layouts[-1][2].append(fname)
+        else:
+            layouts.append((n_cores // n_threads, n_threads, [fname]))
+
+    return layouts
+
+
+def estimate_edges(n_atoms, volume, cutoff):
+    """Return the approximate number of edges within cutoff, N neighbours of density N/V per atom."""
+    if not volume:
+        return n_atoms * (n_atoms - 1)
+
+    return n_atoms * n_atoms / volume * 4.0 / 3.0 * np.pi * cutoff ** 3
+
+
+class MemoryModel:
+    """
+    Peak memory of a relaxation, M = base + per_edge E (bytes).
+
+    E is the number of edges of the graph (estimate_edges with the model cutoff), the activations
+    kept for the forces and the stress grow with it. base and per_edge are fitted (least squares)
+    on the float64 records of the manifests with n_edges and the peak (peak_rss, or peak_gpu), the
+    defaults are used with less than min_records. A float32 model needs half of the per edge
+    memory.
+
+    The structures over the budget of a worker are relaxed alone with a float32 model (plan), not
+    in chunks: the forces and the stress are the gradients of the energy of the whole graph, a
+    chunk would need a halo of num_interactions x cutoff and its own stress reduction. The float32
+    path halves the per edge memory with the same model code.
+    """
+
+    def __init__(self, records=(), cutoff=6.0, base=1.5e9, per_edge=40e3, min_records=5, key="peak_rss"):
+        """Fit the model on the records of a manifest (dictionaries), key is the measured peak."""
+        self.cutoff = cutoff
+        self.base = base
+        self.per_edge = per_edge
+
+        points = [
+            (record["n_edges"], record[key]) for record in records
+            if record.get("state") in CampaignManifest.FINISHED and record.get("dtype", "float64") == "float64"
+            and record.get("n_edges") and record.get(key)
+        ]
+        self.n_records = len(points)
+        if self.n_records >= min_records:
+            n_edges, peak = np.array(points, dtype=float).T
+            if np.ptp(n_edges) > 0:
+                per_edge, base = np.polyfit(n_edges, peak, 1)
+                if per_edge > 0:
+                    self.per_edge, self.base = per_edge, base
+            # The peak is never below the largest one measured for fewer edges.
+            self.base = max(self.base, np.max(peak - self.per_edge * n_edges))
+
+    @classmethod
+    def from_manifests(cls, paths, records=(), **kwargs):
+        """Fit the model on records and the journals of other manifests (glob patterns are accepted)."""
+        records = list(records)
+        for pattern in paths:
+            for path in glob.glob(pattern):
+                manifest = CampaignManifest(path)
+                records += list(manifest.records.values())
+                manifest.close()
+
+        return cls(records, **kwargs)
+
+    def edges(self, n_atoms, volume):
+        """Return the estimated number of edges."""
+        return estimate_edges(n_atoms, volume, self.cutoff)
+
+    def predict(self, n_atoms, volume, dtype="float64"):
+        """Return the expected peak memory in bytes."""
+        per_edge = self.per_edge / 2.0 if dtype == "float32" else self.per_edge
+        return self.base + per_edge * self.edges(n_atoms, volume)
+
+    def plan(self, sizes, files, budget, low_memory_budget=None):
+        """
+        Split files (sizes: n_atoms and volume of each one) by their expected memory.
+
+        Returns the files that fit in budget, the ones that fit in low_memory_budget with a float32
+        model (run alone at the end) and the deferred ones, with the estimate of each file (bytes).
+        """
+        if low_memory_budget is None:
+            low_memory_budget = budget
+
+        normal, low_memory, deferred = [], [], []
+        estimates = {}
+        for fname in files:
+            n_atoms, volume = sizes.get(fname, (None, None))
+            if n_atoms is None:
+                # Unreadable files fail in the normal path.
+                normal.append(fname)
+                continue
+            estimates[fname] = self.predict(n_atoms, volume)
+            if estimates[fname] <= budget:
+                normal.append(fname)
+            elif self.predict(n_atoms, volume, "float32") <= low_memory_budget:
+                low_memory.append(fname)
+            else:
+                deferred.append(fname)
+
+        return normal, low_memory, deferred, estimates
+
+
+def available_memory():
+    """Return the available physical memory in bytes (MemAvailable on Linux)."""
+    try:
+        with open("/proc/meminfo", "r") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+class PeakMemory:
+    """
+    Peak resident memory (RSS) of this process while a structure is computed.
+
+    On Linux the high-water mark of the kernel (VmHWM) is reset by start, otherwise the peak is
+    the one of the whole process (ru_maxrss).
+    """
+
+    def start(self):
+        """Reset the high-water mark."""
+        try:
+            with open("/proc/self/clear_refs", "w") as clear_refs:
+                clear_refs.write("5")
+        except OSError:
+            pass
+
+    def peak(self):
+        """Return the peak RSS in bytes since start."""
+        try:
+            with open("/proc/self/status", "r") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def group_cpu_time(pgid):
+    """Return the CPU time (s) of the running processes of the process group pgid."""
+    cpu_time = 0.0
+    for stat in glob.glob("/proc/[0-9]*/stat"):
+        try:
+            with open(stat, "r") as f:
+                # The command name is in parentheses and can contain spaces.
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if int(fields[2]) == pgid:
+            cpu_time += int(fields[11]) + int(fields[12])
+
+    return cpu_time / os.sysconf("SC_CLK_TCK")
+
+
+def children_cpu_time():
+    """Return the CPU time (s) of the finished child processes of this process."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class ProcessWatchdog:
+    """
+    Time limit of the external processes of a structure.
+
+    The processes are started with popen in their own session (process group). When timeout s
+    have passed since the start of the watchdog, each group gets SIGTERM and, grace s later,
+    SIGKILL: the solver and the processes it started don't survive the structure. A process
+    started after the limit raises TimeoutError. cpu_time is the CPU time of the finished children
+    of this process since the start, plus the one of the killed groups (one structure at a time
+    per process). close kills the groups that are still running.
+    """
+
+    def __init__(self, timeout=None, grace=10.0):
+        """Start the clock, timeout None is no limit."""
+        self.timeout = timeout
+        self.grace = grace
+        self.killed = False
+        self.start_time = time.time()
+        self._cpu_start = children_cpu_time()
+        self._killed_cpu = 0.0
+        self._procs = []
+        self._lock = threading.Lock()
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self.kill)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def remaining(self):
+        """Return the time left in s, None if there is no limit."""
+        if self.timeout is None:
+            return None
+
+        return self.timeout - (time.time() - self.start_time)
+
+    def popen(self, args, **kwargs):
+        """Start a process in a new process group, as subprocess.Popen."""
+        with self._lock:
+            remaining = self.remaining()
+            if self.killed or (remaining is not None and remaining <= 0):
+                self.killed = True
+                raise TimeoutError(f"time limit of {self.timeout} s reached")
+            proc = subprocess.Popen(args, start_new_session=True, **kwargs)
+            self._procs.append(proc)
+
+        return proc
+
+    @property
+    def cpu_time(self):
+        """CPU time (s) of the processes of the structure."""
+        return children_cpu_time() - self._cpu_start + self._killed_cpu
+
+    def _running(self):
+        # The process id of a session leader is its group id, the group lives while one of its
+        # processes does (the solver can outlive the shell that started it).
+        running = []
+        for proc in self._procs:
+            try:
+                os.killpg(proc.pid, 0)
+                running.append(proc)
+            except ProcessLookupError:
+                pass
+
+        return running
+
+    def _terminate(self, procs):
+        for proc in procs:
+            self._killed_cpu += group_cpu_time(proc.pid)
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        deadline = time.time() + self.grace
+        for proc in procs:
+            while time.time() < deadline:
+                try:
+                    os.killpg(proc.pid, 0)
+                except ProcessLookupError:
+                    break
+                time.sleep(0.1)
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            proc.wait()
+
+    def kill(self):
+        """Kill the running process groups, called by the timer at the time limit."""
+        with self._lock:
+            self.killed = True
+            procs = self._running()
+        if len(procs) > 0:
+            print(f"Time limit of {self.timeout} s reached: killing {len(procs)} process groups")
+        self._terminate(procs)
+
+    def close(self):
+        """Stop the timer (or wait for its kill) and kill the process groups that are still running."""
+        if self._timer is not None:
+            self._timer.cancel()
+            if self._timer.is_alive():
+                self._timer.join()
+        with self._lock:
+            procs = self._running()
+            self._procs = []
+        self._terminate(procs)
+
+
+class StepProfiler:
+    """
+    Wall time of the components of each optimizer step of a structure.
+
+    While a stage runs, the calculate method of the calculator (model), the adjust methods of
+    FixSymmetry (symmetry) and get_forces/set_positions of the cell filter (filter) are wrapped.
+    The times are exclusive (the model time is not counted in the filter) and the optimizer time
+    is the rest of the step. save writes the steps of all the stages to folder/name.npz.
+    """
+
+    COMPONENTS = ["model", "symmetry", "filter", "optimizer"]
+    FIELDS = ["stage", "step", "time"] + COMPONENTS + ["fmax", "energy", "step_length"]
+
+    def __init__(self, name, folder="profile"):
+        """Start an empty record."""
+        self.name = name
+        self.folder = folder
+        self.steps = {field: [] for field in self.FIELDS}
+        self.setup_stage = []
+        self.setup_time = []
+        self._wrapped = []
+        self._stack = []
+
+    @property
+    def path(self):
+        return os.path.join(self.folder, self.name + ".npz")
+
+    def _wrap(self, obj, method, component=None, capture=False):
+        """Replace obj.method by a timed version (instance attribute, removed by detach)."""
+        original = getattr(obj, method)
+
+        def timed(*args, **kwargs):
+            self._stack.append(component)
+            t_i = time.perf_counter()
+            try:
+                result = original(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - t_i
+                self._stack.pop()
+                if component is not None:
+                    self._timers[component] += elapsed
+                    # The caller only keeps its own time.
+                    for outer in reversed(self._stack):
+                        if outer is not None:
+                            self._timers[outer] -= elapsed
+                            break
+            if capture:
+                self._forces = result
+            return result
+
+        self._wrapped.append((obj, method, obj.__dict__.get(method)))
+        setattr(obj, method, timed)
+
+    def attach(self, atoms, optimizable, opt, stage=2, setup_time=0.0):
+        """Wrap the components of atoms and record each step of opt."""
+        self.setup_stage.append(stage)
+        self.setup_time.append(setup_time)
+        self._atoms = atoms
+        self._stage = stage
+        self._timers = {component: 0.0 for component in self.COMPONENTS}
+        self._forces = None
+        self._positions = atoms.get_positions()
+        self._last = time.perf_counter()
+
+        self._wrap(atoms.calc, "calculate", "model")
+        for constraint in atoms.constraints:
+            if isinstance(constraint, FixSymmetry):
+                for method in ["adjust_positions", "adjust_cell", "adjust_forces", "adjust_stress"]:
+                    self._wrap(constraint, method, "symmetry")
+
+        if optimizable is atoms:
+            self._wrap(atoms, "get_forces", capture=True)
+        else:
+            self._wrap(optimizable, "get_forces", "filter", capture=True)
+            self._wrap(optimizable, "set_positions", "filter")
+
+        opt.attach(self.record, interval=1, opt=opt)
+
+    def record(self, opt):
+        """Observer of the optimizer, close the current step."""
+        now = time.perf_counter()
+        step_time = now - self._last
+        positions = self._atoms.get_positions()
+        forces = self._forces if self._forces is not None else self._atoms.get_forces()
+
+        self.steps["stage"].append(self._stage)
+        self.steps["step"].append(opt.nsteps)
+        self.steps["time"].append(step_time)
+        for component in ["model", "symmetry", "filter"]:
+            self.steps[component].append(self._timers[component])
+        self.steps["optimizer"].append(step_time - sum(self._timers.values()))
+        self.steps["fmax"].append(np.linalg.norm(forces, axis=1).max())
+        self.steps["energy"].append(self._atoms.get_potential_energy())
+        self.steps["step_length"].append(np.linalg.norm(positions - self._positions, axis=1).max())
+
+        self._timers = {component: 0.0 for component in self.COMPONENTS}
+        self._positions = positions
+        # The time of this observer goes to the optimizer of the next step.
+        self._last = now
+
+    def detach(self):
+        """Restore the wrapped methods."""
+        for obj, method, original in reversed(self._wrapped):
+            if original is None:
+                delattr(obj, method)
+            else:
+                setattr(obj, method, original)
+        self._wrapped = []
+        self._stack = []
+
+    def save(self):
+        """Write the record to folder/name.npz."""
+        os.makedirs(self.folder, exist_ok=True)
+        arrays = {field: np.array(values) for field, values in self.steps.items()}
+        arrays["setup_stage"] = np.array(self.setup_stage)
+        arrays["setup_time"] = np.array(self.setup_time)
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, self.path)
+
+        return self.path
+
+
+def profile_summary(paths):
+    """Print a table with the time of each component for the .npz records in paths."""
+    header = f"{'structure':>24s} {'steps':>6s} {'time (s)':>10s} {'ms/step':>9s}"
+    header += "".join(f" {component:>10s}" for component in StepProfiler.COMPONENTS)
+    print(header)
+
+    totals = {field: 0.0 for field in ["time", "steps"] + StepProfiler.COMPONENTS}
+
+    def row(name, values):
+        line = f"{name:>24s} {int(values['steps']):6d} {values['time']:10.3f}"
+        line += f" {1000.0 * values['time'] / max(values['steps'], 1):9.2f}"
+        for component in StepProfiler.COMPONENTS:
+            line += f" {100.0 * values[component] / max(values['time'], 1e-12):9.1f}%"
+        print(line)
+
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        with np.load(path) as record:
+            values = {field: float(np.sum(record[field])) for field in ["time"] + StepProfiler.COMPONENTS}
+            values["steps"] = len(record["step"])
+        row(os.path.basename(path)[:-4][-24:], values)
+        for field, value in values.items():
+            totals[field] += value
+
+    row("total", totals)
+
+
+class SymmetryReducedFilter(Filter):
+    """
+    Relaxation in the free Wyckoff parameters and the symmetry-allowed lattice strains.
+
+    The displacements of each orbit are generated from its representative atom, only the
+    directions left invariant by the site symmetry are free. The strains are the symmetric
+    tensors invariant under the point group. Both bases are orthonormal in Cartesian coordinates,
+    the strain parameters are scaled by cell_factor (number of atoms) as in FrechetCellFilter. The
+    positions of the filter are the parameters (padded with zeros to a multiple of 3) and its
+    energy is the enthalpy E + PV.
+
+    The cell and positions of atoms are first symmetrized (refine_symmetry at symprec): the reduced
+    coordinates cannot remove a distortion that breaks the symmetry, a rattled structure would
+    stay distorted and converge slowly to a higher energy. It wins on strained cells with few free
+    parameters (strained rutile: 36 LBFGS steps instead of 6733 with FixSymmetry), on rattled
+    structures it can take more steps (rattled rutile: 3633 instead of 2366), so it is not the
+    default of the scripts.
+
+    ValueError is raised if spglib cannot find the symmetry or nothing can move.
+    """
+
+    def __init__(
+        self, atoms, symprec=0.01, relax_cell=True, scalar_pressure=0.0, hydrostatic_strain=False,
+        cell_factor=None, symmetry_cache=None
+    ):
+        """Build the bases of the reduced coordinates from the symmetry of atoms."""
+        Filter.__init__(self, atoms, indices=np.arange(len(atoms)))
+        try:
+            operations = None
+            if symmetry_cache is not None:
+                operations = symmetry_cache.lineage_operations(atoms, symprec)
+            if operations is not None:
+                symmetrize_positions(atoms, *operations)
+                rotations, translations, symm_map = operations
+            else:
+                refine_symmetry(atoms, symprec)
+                if symmetry_cache is not None:
+                    rotations, translations, symm_map = symmetry_cache.operations(atoms, symprec)
+                else:
+                    rotations, translations, symm_map = prep_symmetry(atoms, symprec)
+        except Exception as error:
+            raise ValueError(f"symmetry detection failed: {error}")
+
+        self.n_operations = len(rotations)
+        self.scalar_pressure = scalar_pressure
+        self.cell_factor = float(len(atoms)) if cell_factor is None else cell_factor
+        self.orig_cell = atoms.get_cell().array.copy()
+        self.orig_scaled_positions = atoms.get_scaled_positions(wrap=False)
+        self._inv_orig_cell = np.linalg.inv(self.orig_cell)
+
+        # Free displacements of each orbit, fractional coordinates.
+        n_atoms = len(atoms)
+        symm_map = np.array(symm_map)
+        columns = []
+        assigned = np.zeros(n_atoms, dtype=bool)
+        for i in range(n_atoms):
+            if assigned[i]:
+                continue
+            orbit = np.unique(symm_map[:, i])
+            assigned[orbit] = True
+            site = rotations[symm_map[:, i] == i].mean(axis=0)
+            u, s, vt = np.linalg.svd(site)
+            for direction in u[:, s > 1e-3].T:
+                column = np.zeros((n_atoms, 3))
+                for j in orbit:
+                    k = np.nonzero(symm_map[:, i] == j)[0][0]
+                    column[j] = rotations[k] @ direction
+                columns.append((column @ self.orig_cell).ravel())
+
+        if len(columns) > 0:
+            self.position_basis, _ = np.linalg.qr(np.array(columns).T)
+        else:
+            self.position_basis = np.zeros((3 * n_atoms, 0))
+
+        # Strains invariant under the point group, Cartesian coordinates. Without relax_cell the
+        # cell is fixed, also with hydrostatic_strain (the stress may not be computed).
+        strains = []
+        if relax_cell and hydrostatic_strain:
+            strains = [np.eye(3) / np.sqrt(3.0)]
+        elif relax_cell:
+            lattice = self.orig_cell.T
+            cartesian = [lattice @ rot @ np.linalg.inv(lattice) for rot in rotations]
+            for a, b in [(0, 0), (1, 1), (2, 2), (1, 2), (0, 2), (0, 1)]:
+                strain = np.zeros((3, 3))
+                strain[a, b] = strain[b, a] = 1.0
+                strains.append(np.mean([rot @ strain @ rot.T for rot in cartesian], axis=0).ravel())
+            u, s, vt = np.linalg.svd(np.array(strains), full_matrices=False)
+            strains = [vector.reshape(3, 3) for vector in vt[s > 1e-6 * s.max()]]
+            # Keep them symmetric, the rotations of a slightly distorted cell are not exact.
+            strains = [(strain + strain.T) / np.linalg.norm(strain + strain.T) for strain in strains]
+        self.strain_basis = np.array(strains).reshape(-1, 3, 3)
+        if self.n_position + self.n_strain == 0:
+            raise ValueError("no free coordinates in the symmetry-reduced relaxation")
+
+        self._x = np.zeros(self.n_position + self.n_strain)
+
+    @property
+    def n_position(self):
+        return self.position_basis.shape[1]
+
+    @property
+    def n_strain(self):
+        return len(self.strain_basis)
+
+    def describe(self):
+        """Return the size of the reduced problem."""
+        return (
+            f"{self.n_operations} symmetry operations, {self.n_position} free atomic coordinates"
+            f" and {self.n_strain} lattice strains instead of {3 * len(self.atoms) + 6}"
+        )
+
+    def _deform(self):
+        """Return the deformation gradient of the current strain parameters."""
+        strain = np.tensordot(self._x[self.n_position:] / self.cell_factor, self.strain_basis, axes=1)
+        return np.eye(3) + strain
+
+    def _pad(self, vector):
+        return np.concatenate([vector, np.zeros(-len(vector) % 3)]).reshape(-1, 3)
+
+    def __len__(self):
+        return (len(self._x) + 2) // 3
+
+    def get_positions(self):
+        return self._pad(self._x)
+
+    def set_positions(self, new, **kwargs):
+        self._x = np.array(new).ravel()[:len(self._x)]
+        cell = self.orig_cell @ self._deform()
+        displacements = (self.position_basis @ self._x[:self.n_position]).reshape(-1, 3)
+        scaled_positions = self.orig_scaled_positions + displacements @ self._inv_orig_cell
+        self.atoms.set_cell(cell, scale_atoms=False)
+        self.atoms.set_positions(scaled_positions @ cell, **kwargs)
+
+    def get_potential_energy(self, force_consistent=True):
+        energy = self.atoms.get_potential_energy(force_consistent=force_consistent)
+        return energy + self.scalar_pressure * self.atoms.get_volume()
+
+    def get_forces(self, **kwargs):
+        deform = self._deform()
+        forces = self.atoms.get_forces(**kwargs) @ deform
+        generalized = [self.position_basis.T @ forces.ravel()]
+        if self.n_strain > 0:
+            volume = self.atoms.get_volume()
+            stress = self.atoms.get_stress(voigt=False) + self.scalar_pressure * np.eye(3)
+            gradient = volume * stress @ np.linalg.inv(deform).T
+            generalized.append(-np.tensordot(self.strain_basis, gradient, axes=2) / self.cell_factor)
+
+        return self._pad(np.concatenate(generalized))
+
+
+def symmetry_reduced_filter(atoms, **kwargs):
+    """Return a SymmetryReducedFilter of atoms, None if its symmetry cannot be used."""
+    try:
+        return SymmetryReducedFilter(atoms, **kwargs)
+    except ValueError as error:
+        print(error)
+        return None
+
+
+def symmetry_map(atoms, rotations, translations, distances=False):
+    """
+    Return the image of each atom under each operation (as prep_symmetry), shape (n_ops, n_atoms).
+
+    With distances the images are matched to atoms of the same element in Cartesian space and the
+    largest distance (A) between an image and its atom is returned too.
+    """
+    scaled_positions = atoms.get_scaled_positions()
+    numbers = atoms.get_atomic_numbers()
+    lattice = atoms.cell.array
+    symm_map = np.zeros((len(rotations), len(atoms)), dtype=int)
+    max_distance = 0.0
+    for k, (rot, trans) in enumerate(zip(rotations, translations)):
+        images = scaled_positions @ rot.T + trans
+        delta = scaled_positions[np.newaxis, :, :] - images[:, np.newaxis, :]
+        delta -= np.round(delta)
+        if distances:
+            norms = np.linalg.norm(delta @ lattice, axis=2)
+            norms[numbers[:, np.newaxis] != numbers[np.newaxis, :]] = np.inf
+        else:
+            norms = np.linalg.norm(delta, axis=2)
+        symm_map[k] = np.argmin(norms, axis=1)
+        max_distance = max(max_distance, float(norms[np.arange(len(atoms)), symm_map[k]].max(initial=0.0)))
+
+    if distances:
+        return symm_map, max_distance
+    return symm_map
+
+
+def symmetrize_positions(atoms, rotations, translations, symm_map):
+    """Average the positions of atoms over the images of the operations (refine_symmetry without spglib)."""
+    scaled_positions = atoms.get_scaled_positions(wrap=False)
+    shifts = np.zeros_like(scaled_positions)
+    for rot, trans, images_of in zip(rotations, translations, symm_map):
+        delta = scaled_positions @ rot.T + trans - scaled_positions[images_of]
+        shifts[images_of] += delta - np.round(delta)
+    atoms.set_scaled_positions(scaled_positions + shifts / len(rotations))
+
+
+class SymmetryCache:
+    """
+    Cache of the spglib analysis of structures, in memory and in sqlite if path is given.
+
+    The key is the structure as it is (atom order kept, the Wyckoff letters and the equivalent
+    atoms are given per atom) and the tolerances. A dataset holds the space group, the Wyckoff
+    positions, the symmetry operations and the standardized (conventional) cell. The cells of the
+    spglib functions (spglib_cell, e.g. the primitive) and other derived results (memo) are cached
+    under their own keys, only when they are asked for.
+
+    The relaxation stages move the atoms, so their exact keys never repeat: the last datasets of
+    each Atoms object of this process are kept (lineage) and reused for its next geometry while
+    their operations still map the structure onto itself within the asked symprec (a relaxation
+    with FixSymmetry keeps them) and were found at the same or a looser symprec, without calling
+    spglib. The standardized cell of such a dataset
+    is the one of the earlier geometry.
+    """
+
+    ARRAYS = [
+        "wyckoffs", "equivalent_atoms", "rotations", "translations", "std_lattice", "std_positions",
+        "std_types"
+    ]
+
+    def __init__(self, path="symmetry_cache.sqlite", max_entries=100000, decimals=8, commit_interval=100):
+        """Open (or create) the cache, path None keeps it in memory only."""
+        self.path = path
+        self.max_entries = max_entries
+        self.decimals = decimals
+        self.commit_interval = commit_interval
+        self.hits = 0
+        self.misses = 0
+        self._memory = {}
+        self._lineage = {}
+        self._uncommitted = 0
+
+        self._db = None
+        if path is not None:
+            # relax_config runs in the thread of func_timeout, one thread uses it at a time.
+            self._db = sqlite3.connect(path, timeout=60.0, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS datasets ("
+                "key TEXT PRIMARY KEY, accessed REAL, n_atoms INTEGER, number INTEGER, dataset TEXT)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def _cell(atoms):
+        """Return the spglib cell (lattice, scaled positions, numbers) of atoms or of a cell."""
+        if isinstance(atoms, ase.Atoms):
+            return atoms.cell.array, atoms.get_scaled_positions(wrap=False), atoms.get_atomic_numbers()
+        return tuple(np.asarray(value) for value in atoms[:3])
+
+    def key(self, atoms, symprec=1e-5, angle_tolerance=-1.0, name=""):
+        """Return the key of a structure (Atoms or spglib cell), the tolerances and a name."""
+        lattice, positions, numbers = self._cell(atoms)
+        sha = hashlib.sha256()
+        sha.update(np.ascontiguousarray(numbers, dtype=np.int64).tobytes())
+        sha.update(" ".join(
+            f"{x:.{self.decimals}f}" for x in np.round(lattice, self.decimals).ravel() + 0.0
+        ).encode())
+        sha.update(" ".join(
+            f"{x:.{self.decimals}f}" for x in np.round(positions, self.decimals).ravel() + 0.0
+        ).encode())
+        sha.update(f"{symprec:g} {angle_tolerance:g}".encode())
+        if name:
+            sha.update(name.encode())
+
+        return sha.hexdigest()
+
+    def _get(self, key):
+        """Return the entry of key (memory, then sqlite), None if it is not cached."""
+        entry = self._memory.get(key)
+        if entry is None and self._db is not None:
+            row = self._db.execute("SELECT dataset FROM datasets WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                entry = json.loads(row[0])
+                self._db.execute("UPDATE datasets SET accessed = ? WHERE key = ?", (time.time(), key))
+                self._remember(key, entry)
+
+        return entry
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        if self.max_entries is not None and len(self._memory) > self.max_entries:
+            # Oldest first.
+            self._memory.pop(next(iter(self._memory)))
+
+    def _put(self, key, entry, n_atoms, number=-1):
+        """Keep a new entry, the sqlite writes are committed every commit_interval entries."""
+        self._remember(key, entry)
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?)",
+                (key, time.time(), n_atoms, number, json.dumps(entry))
+            )
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_interval:
+                self._db.commit()
+                self._uncommitted = 0
+
+    def _compute(self, atoms, symprec, angle_tolerance):
+        """Run spglib, return the dataset as a dictionary (number 0 if no symmetry was found)."""
+        import spglib
+
+        cell = (atoms.cell.array, atoms.get_scaled_positions(), atoms.get_atomic_numbers())
+        dataset = spglib.get_symmetry_dataset(cell, symprec=symprec, angle_tolerance=angle_tolerance)
+        if dataset is None:
+            return {"number": 0}
+
+        entry = {
+            "number": int(dataset.number),
+            "international": dataset.international,
+            "hall": dataset.hall,
+            "pointgroup": dataset.pointgroup
+        }
+        for name in self.ARRAYS:
+            value = getattr(dataset, name)
+            entry[name] = value.tolist() if isinstance(value, np.ndarray) else list(value)
+
+        return entry
+
+    def _holds(self, atoms, entry, symprec):
+        """Return True if the operations of entry are symmetries of atoms within symprec."""
+        if entry.get("number", 0) == 0 or len(entry["wyckoffs"]) != len(atoms):
+            return False
+
+        rotations = np.array(entry["rotations"])
+        metric = atoms.cell.array @ atoms.cell.array.T
+        tolerance = 2.0 * symprec * max(atoms.cell.lengths())
+        for rot in rotations:
+            if np.abs(rot.T @ metric @ rot - metric).max() > tolerance:
+                return False
+
+        _, distance = symmetry_map(atoms, rotations, np.array(entry["translations"]), distances=True)
+        return distance <= symprec
+
+    def _from_lineage(self, atoms, symprec):
+        """Return a dataset of a previous geometry of atoms still valid for this one, None if there is none."""
+        ref, keys = self._lineage.get(id(atoms), (None, []))
+        if ref is None or ref() is not atoms:
+            return None
+
+        for key, found_symprec in reversed(keys):
+            # A dataset found at a tighter tolerance may miss operations.
+            entry = self._memory.get(key)
+            if entry is not None and found_symprec >= symprec and self._holds(atoms, entry, symprec):
+                return entry
+
+        return None
+
+    def _follow(self, atoms, key, symprec):
+        """Add key (found at symprec) to the lineage of atoms (the last 4 keys)."""
+        ref, keys = self._lineage.get(id(atoms), (None, []))
+        if ref is None or ref() is not atoms:
+            # Dead objects, their id can be reused.
+            self._lineage = {
+                obj_id: value for obj_id, value in self._lineage.items() if value[0]() is not None
+            }
+            ref, keys = weakref.ref(atoms), []
+        if (key, symprec) not in keys:
+            keys = (keys + [(key, symprec)])[-4:]
+        self._lineage[id(atoms)] = (ref, keys)
+
+    def dataset(self, atoms, symprec=1e-5, angle_tolerance=-1.0):
+        """Return the cached dataset of atoms (attributes as the spglib one), None if spglib fails."""
+        key = self.key(atoms, symprec, angle_tolerance)
+        entry = self._get(key)
+        if entry is None and angle_tolerance == -1.0:
+            entry = self._from_lineage(atoms, symprec)
+            if entry is not None:
+                self._remember(key, entry)
+        if entry is None:
+            entry = self._compute(atoms, symprec, angle_tolerance)
+            self._put(key, entry, len(atoms), entry["number"])
+            self.misses += 1
+        else:
+            self.hits += 1
+        if entry["number"] != 0 and angle_tolerance == -1.0:
+            self._follow(atoms, key, symprec)
+
+        if entry["number"] == 0:
+            return None
+
+        return SimpleNamespace(**{
+            name: np.array(value) if name in self.ARRAYS else value for name, value in entry.items()
+        })
+
+    def check(self, atoms, symprec=1e-6, verbose=False):
+        """Same as ase check_symmetry, the dataset is taken from the cache."""
+        dataset = self.dataset(atoms, symprec)
+        if verbose and dataset is not None:
+            print(
+                "symmetry: prec", symprec, "got symmetry group number", dataset.number,
+                ", international (Hermann-Mauguin)", dataset.international, ", Hall ", dataset.hall
+            )
+        return dataset
+
+    def operations(self, atoms, symprec=0.01):
+        """Same as ase prep_symmetry, return the rotations, translations and the map of the atoms."""
+        dataset = self.dataset(atoms, symprec)
+        if dataset is None:
+            raise ValueError(f"spglib found no symmetry at symprec {symprec}")
+
+        return dataset.rotations, dataset.translations, symmetry_map(
+            atoms, dataset.rotations, dataset.translations
+        )
+
+    def lineage_operations(self, atoms, symprec=0.01):
+        """Return the operations of a previous geometry of atoms still valid for this one, or None."""
+        entry = self._from_lineage(atoms, symprec)
+        if entry is None:
+            return None
+
+        self.hits += 1
+        self._remember(self.key(atoms, symprec), entry)
+        rotations, translations = np.array(entry["rotations"]), np.array(entry["translations"])
+        return rotations, translations, symmetry_map(atoms, rotations, translations)
+
+    def memo(self, name, atoms, compute, symprec=1e-5, angle_tolerance=-1.0):
+        """Return compute() (a JSON value) cached under name, the structure and the tolerances."""
+        key = self.key(atoms, symprec, angle_tolerance, name=name)
+        entry = self._get(key)
+        if entry is None:
+            entry = {"value": compute()}
+            self._put(key, entry, len(self._cell(atoms)[2]))
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return entry["value"]
+
+    def spglib_cell(self, function, cell, symprec=1e-5, angle_tolerance=-1.0, **options):
+        """
+        Return the cell of spglib.<function> (standardize_cell, refine_cell, find_primitive) of cell.
+
+        cell is an Atoms object or a spglib cell, None is returned if spglib fails.
+        """
+        import spglib
+
+        def compute():
+            result = getattr(spglib, function)(
+                self._cell(cell), symprec=symprec, angle_tolerance=angle_tolerance, **options
+            )
+            return None if result is None else [np.asarray(value).tolist() for value in result]
+
+        name = function + " " + " ".join(f"{option}={value}" for option, value in sorted(options.items()))
+        result = self.memo(name, cell, compute, symprec, angle_tolerance)
+        if result is None:
+            return None
+
+        return np.array(result[0]), np.array(result[1]), np.array(result[2])
+
+    def primitive(self, atoms, symprec=1e-5, angle_tolerance=-1.0):
+        """Return the standardized primitive cell of atoms (ase Atoms), None if spglib fails."""
+        primitive = self.spglib_cell(
+            "standardize_cell", atoms, symprec, angle_tolerance, to_primitive=True, no_idealize=False
+        )
+        if primitive is None:
+            return None
+
+        return ase.Atoms(numbers=primitive[2], cell=primitive[0], scaled_positions=primitive[1], pbc=True)
+
+    def evict(self):
+        """Remove the least used entries above max_entries."""
+        if self.max_entries is not None and self._db is not None:
+            self._db.execute(
+                "DELETE FROM datasets WHERE key IN (SELECT key FROM datasets ORDER BY accessed DESC "
+                "LIMIT -1 OFFSET ?)", (self.max_entries,)
+            )
+            self._db.commit()
+
+    def __len__(self):
+        if self._db is None:
+            return len(self._memory)
+        return self._db.execute("SELECT COUNT(*) FROM datasets").fetchone()[0]
+
+    def summary(self):
+        """Return the hits and misses of this run."""
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self)}
+
+    def close(self):
+        """Evict the old entries and close the database."""
+        if self._db is not None:
+            self._db.commit()
+            self.evict()
+            self._db.close()
+
+
+class CachedFixSymmetry(FixSymmetry):
+    """
+    FixSymmetry whose symmetry operations are taken from a SymmetryCache.
+
+    If the operations of a previous geometry of atoms (SymmetryCache lineage, e.g. the previous
+    relaxation stage) still hold, the positions are symmetrized with them and spglib is not
+    called. Otherwise the initial symmetry is refined as in FixSymmetry. Copies of the
+    constraint are plain FixSymmetry objects.
+    """
+
+    def __init__(self, atoms, symprec=0.01, adjust_positions=True, adjust_cell=True, cache=None):
+        """Refine the symmetry of atoms and get its operations (from the cache if given)."""
+        if cache is None:
+            FixSymmetry.__init__(
+                self, atoms, symprec=symprec, adjust_positions=adjust_positions, adjust_cell=adjust_cell
+            )
+            return
+
+        self.atoms = atoms.copy()
+        self.symprec = symprec
+        self.verbose = False
+        operations = cache.lineage_operations(atoms, symprec)
+        if operations is not None:
+            symmetrize_positions(atoms, *operations)
+        else:
+            refine_symmetry(atoms, symprec)
+            operations = cache.operations(atoms, symprec)
+        self.rotations, self.translations, self.symm_map = operations
+        self.do_adjust_positions = adjust_positions
+        self.do_adjust_cell = adjust_cell
+
+
+class GammaHessian:
+    """
+    Hessian of a periodic structure at the Gamma point of its cell by finite displacements.
+
+    Each irreducible atom (one per orbit of the space group) is displaced by +-delta along x, y
+    and z, the rows of the other atoms of its orbit are obtained with the symmetry operations. The
+    forces of all the displaced structures are given at once to assemble, they can be evaluated in
+    batches. Without symmetry (or if spglib fails) every atom is displaced.
+    """
+
+    def __init__(self, atoms, delta=0.01, symprec=1e-3, symmetry_cache=None):
+        """Find the irreducible atoms of atoms."""
+        # Without constraints, FixSymmetry would symmetrize the displacements.
+        self.atoms = ase.Atoms(
+            numbers=atoms.get_atomic_numbers(),
+            positions=atoms.get_positions(),
+            cell=atoms.get_cell(),
+            pbc=atoms.pbc,
+            masses=atoms.get_masses()
+        )
+        self.delta = delta
+        n_atoms = len(atoms)
+        try:
+            if symmetry_cache is not None:
+                # atoms, not the copy: the operations of its relaxation are reused.
+                rotations, translations, symm_map = symmetry_cache.operations(atoms, symprec)
+            else:
+                rotations, translations, symm_map = prep_symmetry(self.atoms, symprec)
+            symm_map = np.array(symm_map)
+        except Exception as error:
+            print(f"No symmetry for the Hessian ({error}), all the atoms are displaced")
+            rotations = np.eye(3, dtype=int)[np.newaxis]
+            symm_map = np.arange(n_atoms)[np.newaxis]
+
+        # Rotations in Cartesian coordinates, positions are row vectors (x = f L).
+        lattice = self.atoms.cell.array
+        self.rotations = np.array([lattice.T @ rot @ np.linalg.inv(lattice.T) for rot in rotations])
+        self.symm_map = symm_map
+        self.irreducible = []
+        assigned = np.zeros(n_atoms, dtype=bool)
+        for i in range(n_atoms):
+            if not assigned[i]:
+                self.irreducible.append(i)
+                assigned[np.unique(symm_map[:, i])] = True
+        self.hessian = None
+
+    def displacements(self):
+        """Return the displaced structures, +delta and -delta for each irreducible atom and direction."""
+        structures = []
+        for i in self.irreducible:
+            for direction in range(3):
+                for sign in [1.0, -1.0]:
+                    displaced = self.atoms.copy()
+                    displaced.positions[i, direction] += sign * self.delta
+                    structures.append(displaced)
+
+        return structures
+
+    def assemble(self, forces):
+        """Build the Hessian (eV/A^2) from the forces of the displaced structures (same order)."""
+        n_atoms = len(self.atoms)
+        blocks = np.zeros((n_atoms, n_atoms, 3, 3))
+        for n, i in enumerate(self.irreducible):
+            # rows[m, a, b] = d2E / du_ia du_mb
+            rows = np.zeros((n_atoms, 3, 3))
+            for direction in range(3):
+                plus = np.asarray(forces[6 * n + 2 * direction])
+                minus = np.asarray(forces[6 * n + 2 * direction + 1])
+                rows[:, direction, :] = -(plus - minus) / (2.0 * self.delta)
+            for j in np.unique(self.symm_map[:, i]):
+                k = np.nonzero(self.symm_map[:, i] == j)[0][0]
+                rot = self.rotations[k]
+                blocks[j, self.symm_map[k]] = rot @ rows @ rot.T
+
+        hessian = blocks.transpose(0, 2, 1, 3).reshape(3 * n_atoms, 3 * n_atoms)
+        self.hessian = 0.5 * (hessian + hessian.T)
+        return self.hessian
+
+    def modes(self):
+        """
+        Return the frequencies (THz, negative for imaginary modes) and the displacement patterns.
+
+        The three translations of the periodic cell are projected out. The patterns (columns) are
+        Cartesian displacements normalized to 1.
+        """
+        masses = np.repeat(self.atoms.get_masses(), 3)
+        dynamical = self.hessian / np.sqrt(np.outer(masses, masses))
+
+        translations = np.zeros((3, len(masses)))
+        for direction in range(3):
+            translations[direction, direction::3] = np.sqrt(masses[direction::3])
+        translations /= np.linalg.norm(translations, axis=1)[:, np.newaxis]
+        projector = np.eye(len(masses)) - translations.T @ translations
+        eigenvalues, eigenvectors = np.linalg.eigh(projector @ dynamical @ projector)
+
+        overlap = np.linalg.norm(translations @ eigenvectors, axis=0)
+        keep = np.sort(np.argsort(overlap)[:len(masses) - 3])
+        eigenvalues = eigenvalues[keep]
+        patterns = eigenvectors[:, keep] / np.sqrt(masses)[:, np.newaxis]
+        patterns /= np.linalg.norm(patterns, axis=0)
+
+        # sqrt(eV / A^2 / amu) in THz
+        factor = np.sqrt(units._e / units._amu) * 1e10 / (2.0 * np.pi) / 1e12
+        frequencies = np.sign(eigenvalues) * np.sqrt(np.abs(eigenvalues)) * factor
+
+        return frequencies, patterns